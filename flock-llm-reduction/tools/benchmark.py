@@ -0,0 +1,256 @@
+"""
+Reduction Benchmark
+
+Times the reduction analyzer phase by phase over the LLM queries of the
+datasets next to this directory:
+
+    for every <dataset>/sql/llm_queries/*.sql
+    against <dataset>/data/samples and <dataset>/data/original_data
+
+Each data directory is loaded once (the ``load`` time, through the
+Parquet load cache unless ``--no-cache``); each query is then analyzed
+``--repeat`` times and every phase keeps its fastest time.  The phases are
+those QueryReducer.analyze_query() records in ``timings``: LLM stripping,
+parsing, local predicates, folding, HAVING analysis, the bottom-up and
+top-down semi-join passes, counting and reporting (``other`` is the rest
+of the wall time).
+
+Every run is appended to a JSON history file (a list of runs, each with
+its commit, settings and results) and compared with the latest earlier
+run of the same settings, so regressions show up across commits.
+
+``--pairwise`` runs the bottom-up pass with one semi-join per child
+instead of one multiway semi-join per parent, to compare the two;
+``--star-only`` keeps the queries that have such a parent (a hub with
+several children in the join tree), where the two differ.
+
+Usage:
+    python benchmark.py [--datasets openflights goodbooks] [--variants samples original_data]
+                        [--queries GLOB] [--star-only] [--repeat N] [--key-only] [--pairwise]
+                        [--history FILE]
+"""
+
+import io
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+from pathlib import Path
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import duckdb
+
+from reduction_analyzer import QueryReducer
+
+# Root holding the dataset directories
+ROOT = Path(__file__).resolve().parent.parent
+
+# Report columns: (phase, header); unlisted phases are summed into 'other'
+PHASES = [
+    ('strip_llm', 'Strip'),
+    ('parse', 'Parse'),
+    ('local_predicates', 'Preds'),
+    ('fold', 'Fold'),
+    ('having', 'Having'),
+    ('semi_join_bottom_up', 'Up'),
+    ('semi_join_top_down', 'Down'),
+    ('counting', 'Count'),
+    ('report', 'Report'),
+]
+
+# A query is flagged when it is this much slower than in the previous run
+REGRESSION_RATIO = 1.2
+REGRESSION_MIN_SECONDS = 0.005
+
+# ============================================================================
+# Runs
+# ============================================================================
+
+def _commit() -> Optional[str]:
+    """Short hash of the checked-out commit, None outside a git checkout."""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, check=True,
+                              capture_output=True, text=True).stdout.strip() or None
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_query(reducer: QueryReducer, query_file: Path, repeat: int) -> Dict[str, object]:
+    """Fastest time of every phase (and in total) over ``repeat`` analyses."""
+    phases: Dict[str, float] = {}
+    total = None
+    for _ in range(max(repeat, 1)):
+        reducer.out = io.StringIO()
+        start = time.perf_counter()
+        try:
+            reducer.analyze_query(str(query_file), show_queries=False)
+        except Exception as e:
+            return {'query': query_file.name, 'error': str(e)}
+        finally:
+            reducer.out = None
+        seconds = time.perf_counter() - start
+        total = seconds if total is None else min(total, seconds)
+        for phase, phase_seconds in reducer.timings.items():
+            phases[phase] = min(phases.get(phase, phase_seconds), phase_seconds)
+    return {'query': query_file.name, 'total': total, 'phases': phases}
+
+
+def hubs(reducer: QueryReducer, query_file: Path) -> Dict[str, int]:
+    """Nodes with two or more children in the query's join tree, with their child counts."""
+    graph = reducer.parse_join_graph(reducer.remove_llm_calls(query_file.read_text()))
+    parent_of, _, _ = graph.reduction_tree()
+    children: Dict[str, int] = {}
+    for parent in parent_of.values():
+        if parent is not None:
+            children[parent] = children.get(parent, 0) + 1
+    return {node: count for node, count in children.items() if count > 1}
+
+
+def benchmark_data(dataset: str, variant: str, repeat: int, key_only: bool,
+                   use_cache: bool, multiway: bool = True, pattern: str = '*.sql',
+                   star_only: bool = False) -> Optional[Dict[str, object]]:
+    """
+    Load one data directory and benchmark the queries of its dataset
+    matching ``pattern`` (with ``star_only``, only those with hubs).
+    """
+    data_dir = ROOT / dataset / 'data' / variant
+    queries = sorted((ROOT / dataset / 'sql' / 'llm_queries').glob(pattern))
+    reducer = QueryReducer(key_only=key_only, multiway=multiway, out=io.StringIO())
+    if star_only:
+        queries = [query for query in queries if hubs(reducer, query)]
+    if not data_dir.is_dir() or not queries:
+        reducer.conn.close()
+        return None
+    start = time.perf_counter()
+    reducer.load_data_dynamic(str(data_dir),
+                              cache_dir=str(data_dir / '.reduction_cache') if use_cache else None)
+    load = time.perf_counter() - start
+    results = [benchmark_query(reducer, query, repeat) for query in queries]
+    reducer.conn.close()
+    return {'dataset': dataset, 'variant': variant, 'load': load, 'queries': results}
+
+
+# ============================================================================
+# History
+# ============================================================================
+
+def _settings(run: Dict[str, object]) -> tuple:
+    return run['key_only'], run['repeat'], run.get('multiway', True)
+
+
+def load_history(path: Path) -> List[Dict[str, object]]:
+    if not path.exists():
+        return []
+    with path.open(encoding='utf-8') as f:
+        return json.load(f)
+
+
+def previous_run(history: List[Dict[str, object]], run: Dict[str, object]) -> Optional[Dict[str, object]]:
+    """The latest run in ``history`` with the settings of ``run``."""
+    for earlier in reversed(history):
+        if _settings(earlier) == _settings(run):
+            return earlier
+    return None
+
+
+def _totals(run: Optional[Dict[str, object]]) -> Dict[tuple, float]:
+    """(dataset, variant, query) -> total seconds of a run."""
+    if run is None:
+        return {}
+    return {(data['dataset'], data['variant'], q['query']): q['total']
+            for data in run['results'] for q in data['queries'] if 'total' in q}
+
+
+def format_run(run: Dict[str, object], previous: Optional[Dict[str, object]]) -> str:
+    """Per-phase report of a run, with each query's change since ``previous``."""
+    before = _totals(previous)
+    against = f"vs {previous.get('commit') or previous['timestamp']}" if previous else "no earlier run"
+    lines = [f"Benchmark at {run.get('commit') or 'unknown commit'} "
+             f"(best of {run['repeat']}{', key-only' if run['key_only'] else ''}"
+             f"{'' if run.get('multiway', True) else ', pairwise'}; times in ms, {against})"]
+    header = f"{'Query':<34} " + " ".join(f"{title:>7}" for _, title in PHASES) + f" {'Other':>7} {'Total':>8}  Change"
+    for data in run['results']:
+        lines.append("=" * len(header))
+        lines.append(f"{data['dataset']}/{data['variant']}  (load {data['load'] * 1000:,.0f} ms)")
+        lines.append(header)
+        lines.append("-" * len(header))
+        for q in data['queries']:
+            if 'error' in q:
+                lines.append(f"{q['query']:<34} ⚠ {q['error'].splitlines()[0]}")
+                continue
+            phases = q['phases']
+            listed = [phases.get(phase, 0.0) for phase, _ in PHASES]
+            other = max(q['total'] - sum(phases.values()), 0.0) + sum(
+                seconds for phase, seconds in phases.items() if phase not in dict(PHASES))
+            line = (f"{q['query'][:34]:<34} " + " ".join(f"{s * 1000:>7.1f}" for s in listed)
+                    + f" {other * 1000:>7.1f} {q['total'] * 1000:>8.1f}")
+            old = before.get((data['dataset'], data['variant'], q['query']))
+            if old:
+                change = (q['total'] - old) / old * 100
+                flag = (" ⚠ regression" if q['total'] > old * REGRESSION_RATIO
+                        and q['total'] - old > REGRESSION_MIN_SECONDS else "")
+                line += f"  {change:+.1f}%{flag}"
+            lines.append(line)
+    return "\n".join(lines) + "\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the reduction analyzer phase by phase over the dataset queries')
+    parser.add_argument('--datasets', nargs='+', default=['openflights', 'goodbooks'],
+                        help='Dataset directories to run (default: openflights goodbooks)')
+    parser.add_argument('--variants', nargs='+', default=['samples', 'original_data'],
+                        help='Data directories of each dataset (default: samples original_data)')
+    parser.add_argument('--queries', default='*.sql', metavar='GLOB',
+                        help='Query files of each dataset to run (default: *.sql)')
+    parser.add_argument('--star-only', action='store_true',
+                        help='Only run queries whose join tree has a node with several children')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Analyses per query; each phase keeps its fastest (default: 3)')
+    parser.add_argument('--key-only', action='store_true',
+                        help='Benchmark key-only semi-joins')
+    parser.add_argument('--pairwise', action='store_true',
+                        help='One semi-join per child in the bottom-up pass instead of '
+                             'one multiway semi-join per parent')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Load from CSV, bypassing the Parquet load cache')
+    parser.add_argument('--history', default=str(Path(__file__).resolve().parent / 'benchmark_history.json'),
+                        help='JSON history file the run is appended to (default: tools/benchmark_history.json)')
+    parser.add_argument('--no-history', action='store_true',
+                        help='Do not read or write the history file')
+    args = parser.parse_args()
+
+    run = {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'duckdb': duckdb.__version__,
+        'key_only': args.key_only,
+        'multiway': not args.pairwise,
+        'repeat': args.repeat,
+        'results': [],
+    }
+    for dataset in args.datasets:
+        for variant in args.variants:
+            data = benchmark_data(dataset, variant, args.repeat, args.key_only, not args.no_cache,
+                                  multiway=not args.pairwise, pattern=args.queries,
+                                  star_only=args.star_only)
+            if data is None:
+                print(f"⚠ Skipping {dataset}/{variant}: no data or queries", file=sys.stderr)
+                continue
+            run['results'].append(data)
+
+    history = [] if args.no_history else load_history(Path(args.history))
+    print(format_run(run, previous_run(history, run)), end='')
+    if not args.no_history:
+        history.append(run)
+        with open(args.history, 'w', encoding='utf-8') as f:
+            json.dump(history, f, indent=1)
+        print(f"✓ Appended to {args.history}")
+
+
+if __name__ == '__main__':
+    main()
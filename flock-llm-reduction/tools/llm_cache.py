@@ -0,0 +1,412 @@
+"""
+LLM Result Memoization
+
+Rewrites a Flock query into a script whose per-row LLM calls first look up
+a persistent DuckDB table of earlier results, so that only contexts never
+seen before are sent to the model:
+
+    1. create the memo table (and its hit/miss log) if it does not exist,
+       and drop entries older than the TTL
+    2. probe: run the query with every memoized call replaced by its key
+       and the columns it reads, keeping each distinct context once
+    3. log hits and misses, refresh the hit entries, and call the model
+       once per missing context, storing the results
+    4. evict the least recently used entries beyond the capacity
+    5. run the query with every memoized call replaced by a memo lookup
+
+The key is the MD5 of the call's model and prompt arguments serialized
+with ``to_json``.  The prompt struct holds the prompt text and the values
+of its ``context_columns``, so two rows share an entry exactly when the
+model would receive the same request.  The lookup keeps the original call
+as a fallback (``COALESCE`` only evaluates it for rows still NULL), so the
+script returns the query's results even when the probe and the query do
+not see the same rows, e.g. under a LIMIT without ORDER BY.
+
+Only scalar calls (llm_complete, llm_filter, llm_embedding) that are
+aliased items of the outermost SELECT list are memoized.  Aggregate calls
+in that list (llm_reduce, llm_rerank, ...) still run as written; a query
+with LLM calls anywhere else is not rewritten, because the probe could not
+reproduce its rows without calling the model.
+
+``distinct_context_query`` applies the same probe and lookup within a
+single statement and without a memo table: each call is evaluated in a
+materialized CTE once per distinct context of the probe and joined back
+to the query's rows by key.
+
+``plan_calls`` and ``distinct_contexts`` are the probe on its own, for
+running the calls some other way (see llm_pipeline).
+"""
+
+import re
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+# ============================================================================
+# Call Sites
+# ============================================================================
+
+# Memoizable functions and the type their VARCHAR-stored result is read as
+RESULT_TYPES = {
+    'llm_complete': 'VARCHAR',
+    'llm_filter': 'BOOLEAN',
+    'llm_embedding': 'FLOAT[]',
+}
+
+# Functions called once per row (as opposed to once per group)
+PER_ROW_FUNCTIONS = tuple(RESULT_TYPES)
+
+# Strings and comments (skipped), SELECT/FROM, LLM calls and parentheses
+_TOKEN_PATTERN = re.compile(r"""
+    (?P<skip>'(?:[^']|'')*'|"(?:[^"]|"")*"|--[^\n]*|/\*.*?\*/)
+  | (?P<call>\bllm_\w+)\s*\(
+  | (?P<keyword>\b(?:SELECT|FROM)\b)
+  | (?P<open>\()
+  | (?P<close>\))
+""", re.VERBOSE | re.DOTALL | re.IGNORECASE)
+
+_ALIAS_PATTERN = re.compile(r'\s+AS\s+(\w+)', re.IGNORECASE)
+_ITEM_START_PATTERN = re.compile(r'(?:,|\bSELECT|\bDISTINCT)\s*$', re.IGNORECASE)
+_COMMENT_PATTERN = re.compile(r'--[^\n]*|/\*.*?\*/', re.DOTALL)
+
+
+class MemoCall(NamedTuple):
+    """An LLM call site in the query text."""
+    function: str            # e.g. llm_complete
+    alias: str               # name of the SELECT item it is, '' if none
+    args: Tuple[str, ...]    # argument texts
+    start: int               # span of the call in the query text
+    end: int
+    in_select_list: bool     # inside the outermost SELECT list
+
+
+def _split_args(text: str) -> Tuple[str, ...]:
+    """Split the text between a call's parentheses at top-level commas."""
+    args: List[str] = []
+    depth = 0
+    current = 0
+    for m in re.finditer(r"'(?:[^']|'')*'|[(\[{]|[)\]}]|,", text):
+        token = m.group(0)
+        if token in '([{':
+            depth += 1
+        elif token in ')]}':
+            depth -= 1
+        elif token == ',' and depth == 0:
+            args.append(text[current:m.start()].strip())
+            current = m.end()
+    args.append(text[current:].strip())
+    return tuple(args)
+
+
+def find_calls(query: str) -> List[MemoCall]:
+    """
+    LLM call sites of ``query`` in textual order, nested calls included.
+
+    The outermost SELECT list is the text between the first SELECT at
+    nesting depth 0 and the FROM that follows it at depth 0; a call is an
+    item of it when it starts at depth 0 after ``SELECT``, ``DISTINCT`` or
+    a comma and is followed by ``AS alias``.
+    """
+    calls: List[MemoCall] = []
+    depth = 0
+    state = 'before'          # before / in / after the outermost SELECT list
+    open_calls: List[Tuple[str, int, int, bool]] = []  # (function, start, depth, in list)
+    for m in _TOKEN_PATTERN.finditer(query):
+        kind = m.lastgroup
+        if kind == 'keyword' and depth == 0:
+            keyword = m.group('keyword').upper()
+            if keyword == 'SELECT' and state == 'before':
+                state = 'in'
+            elif keyword == 'FROM' and state == 'in':
+                state = 'after'
+        elif kind == 'call':
+            open_calls.append((m.group('call').lower(), m.start(), depth, state == 'in'))
+            depth += 1
+        elif kind == 'open':
+            depth += 1
+        elif kind == 'close':
+            depth -= 1
+            if open_calls and open_calls[-1][2] == depth:
+                function, start, call_depth, in_list = open_calls.pop()
+                alias = ''
+                alias_match = _ALIAS_PATTERN.match(query, m.end())
+                before = _COMMENT_PATTERN.sub('', query[:start])
+                if (in_list and call_depth == 0 and alias_match
+                        and _ITEM_START_PATTERN.search(before)):
+                    alias = alias_match.group(1)
+                open_paren = query.index('(', start)
+                calls.append(MemoCall(function, alias, _split_args(query[open_paren + 1:m.start()]),
+                                      start, m.end(), in_list))
+    calls.sort(key=lambda call: call.start)
+    return calls
+
+
+def _replace_spans(query: str, replacements: List[Tuple[int, int, str]]) -> str:
+    """Apply non-overlapping (start, end, text) replacements."""
+    for start, end, text in sorted(replacements, reverse=True):
+        query = query[:start] + text + query[end:]
+    return query
+
+
+def prepend_ctes(query: str, ctes: str) -> Optional[str]:
+    """
+    Put the comma-separated CTE definitions ``ctes`` in front of the
+    query's own WITH clause, or open one before its first SELECT.  None if
+    the query has neither.
+    """
+    for m in re.finditer(r"('(?:[^']|'')*'|--[^\n]*|/\*.*?\*/)|\b(WITH(?:\s+RECURSIVE)?|SELECT)\b",
+                         query, re.DOTALL | re.IGNORECASE):
+        if m.group(2) is None:
+            continue
+        if m.group(2).upper() == 'SELECT':
+            return f"{query[:m.start()]}WITH {ctes}\n{query[m.start():]}"
+        return f"{query[:m.end()]} {ctes},\n{query[m.end():].lstrip()}"
+    return None
+
+
+def _key(call: MemoCall) -> str:
+    """Key of a call's request: hash of its function, model and prompt arguments."""
+    return (f"md5(to_json({{'function': '{call.function}', "
+            f"'model': {call.args[0]}, 'prompt': {call.args[1]}}}))")
+
+
+def _probe_struct(key: str, columns: Sequence[str]) -> str:
+    """
+    The probe's replacement for a call: its key plus the columns it
+    reads, ``b.title`` kept as field ``title`` of a struct ``b`` so the
+    call's own text resolves against the probe rows.
+    """
+    fields: Dict[str, List[str]] = {}
+    plain: List[str] = []
+    for column in columns:
+        parts = column.split('.')
+        if len(parts) >= 2:
+            fields.setdefault(parts[-2], []).append(parts[-1])
+        else:
+            plain.append(column)
+    items = [f"'__key': {key}"]
+    for qualifier, names in fields.items():
+        inner = ', '.join(f"'{name}': {qualifier}.{name}" for name in names)
+        items.append(f"'{qualifier}': {{{inner}}}")
+    items.extend(f"'{name}': {name}" for name in plain)
+    return "{" + ", ".join(items) + "}"
+
+
+def distinct_contexts(call: MemoCall, probe: str) -> str:
+    """
+    One probe row per distinct key of ``call``.  Contexts that differ only
+    in columns the prompt does not distinguish (e.g. through ``lower()``)
+    share a key, and any one of them stands for the request.
+    """
+    return (f"SELECT DISTINCT ON (__key) * FROM (\n"
+            f"SELECT UNNEST({call.alias}) FROM (\n{probe}\n))")
+
+
+class CallPlan(NamedTuple):
+    """The memoizable calls of a query and its probe and lookup forms."""
+    memoized: List[MemoCall]
+    probe: str     # every memoized call replaced by _probe_struct, other calls by NULL
+    final: str     # every memoized call replaced by its lookup
+    snapshot: str  # every memoized call replaced by _probe_struct, other calls kept
+
+
+def plan_calls(query: str, context_columns: Dict[Tuple[str, str], Sequence[str]],
+                lookup: Callable[[MemoCall, str], str]) -> Union[CallPlan, str]:
+    """
+    Find the memoizable calls of ``query`` (already stripped of its final
+    semicolon) and build its probe and, with ``lookup(call, key)``, its
+    final form; the reason as a string if there is nothing to memoize.
+
+    The snapshot form is the query's own rows with each memoized call's
+    probe struct in place of its result, for callers that run the probe
+    and the lookup over one materialized copy of the rows.
+    """
+    calls = find_calls(query)
+    if not calls:
+        return "no LLM calls"
+    if not all(call.in_select_list for call in calls):
+        return "LLM calls outside the outermost SELECT list"
+    memoized = [call for call in calls
+                if call.alias and call.function in RESULT_TYPES and len(call.args) >= 2]
+    if not memoized:
+        return "no per-row LLM call among the SELECT items"
+
+    # Outermost calls only: nested ones go away with their enclosing call
+    outermost = [call for call in calls
+                 if not any(o.start < call.start and call.end <= o.end for o in calls)]
+    probe_edits = []
+    lookup_edits = []
+    snapshot_edits = []
+    for call in outermost:
+        if call in memoized:
+            key = _key(call)
+            struct = _probe_struct(key, context_columns.get((call.function, call.alias), ()))
+            probe_edits.append((call.start, call.end, struct))
+            lookup_edits.append((call.start, call.end, lookup(call, key)))
+            snapshot_edits.append((call.start, call.end, struct))
+        else:
+            probe_edits.append((call.start, call.end, 'NULL'))
+    return CallPlan(memoized, _replace_spans(query, probe_edits), _replace_spans(query, lookup_edits),
+                    _replace_spans(query, snapshot_edits))
+
+
+# ============================================================================
+# Memoized Query Script
+# ============================================================================
+
+class MemoRewrite(NamedTuple):
+    """Result of LlmMemo.rewrite() and distinct_context_query()."""
+    script: Optional[str]   # None when the query is not memoized
+    memoized: List[str]     # aliases of the memoized calls
+    reason: str             # why the query is not memoized
+
+
+class LlmMemo:
+    """
+    Memo table settings and the query rewrite that uses them.
+
+    Entries live in ``table`` (key, function, result, created, last_used,
+    hits); every run of a memoized query appends its per-call hit and miss
+    counts to ``<table>_stats``.  Entries older than ``ttl_days`` are
+    dropped and at most ``capacity`` entries are kept, evicting the least
+    recently used ones; None disables either limit.
+    """
+
+    def __init__(self, table: str = "llm_memo", ttl_days: Optional[float] = 30,
+                 capacity: Optional[int] = 100_000):
+        self.table = table
+        self.stats_table = f"{table}_stats"
+        self.ttl_days = ttl_days
+        self.capacity = capacity
+
+    def rewrite(self, query: str, label: str,
+                context_columns: Dict[Tuple[str, str], Sequence[str]]) -> MemoRewrite:
+        """
+        Rewrite ``query`` into the memoized script described in the module
+        docstring.
+
+        ``context_columns`` maps (function, alias) of each call to the
+        column references it reads (``LlmCall.context_columns`` of the SQL
+        front-end): the probe keeps exactly those columns, so the original
+        call text can be evaluated once per distinct context.  ``label``
+        names the query in the stats table.
+        """
+        query = query.strip().rstrip(';').rstrip()
+        plan = plan_calls(query, context_columns,
+                           lambda call, key: self._lookup(call, key, query))
+        if isinstance(plan, str):
+            return MemoRewrite(None, [], plan)
+        memoized = plan.memoized
+
+        names = [call.alias for call in memoized]
+        parts = [
+            f"-- LLM results of {label} memoized in {self.table}, written by reduction_analyzer.py\n"
+            f"-- Memoized calls: {', '.join(f'{c.alias} ({c.function})' for c in memoized)}",
+            self.setup_sql(),
+        ]
+        for i, call in enumerate(memoized, start=1):
+            probe_table = f"{self.table}_probe_{i}"
+            parts.append(
+                f"-- {call.alias}: distinct contexts, hits and misses, model calls for the misses\n"
+                f"CREATE OR REPLACE TEMP TABLE {probe_table} AS\n"
+                f"{distinct_contexts(call, plan.probe)};\n"
+                f"INSERT INTO {self.stats_table}\n"
+                f"SELECT '{label.replace(chr(39), chr(39) * 2)}', '{call.alias}', now(),\n"
+                f"       count(*) FILTER (WHERE __key IN (SELECT key FROM {self.table})),\n"
+                f"       count(*) FILTER (WHERE __key NOT IN (SELECT key FROM {self.table}))\n"
+                f"FROM {probe_table};\n"
+                f"UPDATE {self.table} SET last_used = now(), hits = hits + 1\n"
+                f"WHERE key IN (SELECT __key FROM {probe_table});\n"
+                f"INSERT INTO {self.table}\n"
+                f"SELECT __key, '{call.function}', CAST({query[call.start:call.end]} AS VARCHAR),\n"
+                f"       now(), now(), 0\n"
+                f"FROM {probe_table}\n"
+                f"WHERE __key NOT IN (SELECT key FROM {self.table});\n"
+                f"DROP TABLE {probe_table};"
+            )
+        eviction = self.eviction_sql()
+        if eviction:
+            parts.append(eviction)
+        parts.append(plan.final + ";")
+        return MemoRewrite("\n\n".join(parts) + "\n", names, "")
+
+    def setup_sql(self) -> str:
+        """Create the memo and stats tables, then drop expired entries."""
+        sql = (
+            f"CREATE TABLE IF NOT EXISTS {self.table} (\n"
+            f"  key VARCHAR PRIMARY KEY, function VARCHAR, result VARCHAR,\n"
+            f"  created TIMESTAMP, last_used TIMESTAMP, hits BIGINT\n"
+            f");\n"
+            f"CREATE TABLE IF NOT EXISTS {self.stats_table} (\n"
+            f"  query VARCHAR, call VARCHAR, run_at TIMESTAMP, hits BIGINT, misses BIGINT\n"
+            f");"
+        )
+        if self.ttl_days is not None:
+            sql += (f"\nDELETE FROM {self.table}\n"
+                    f"WHERE created < now() - INTERVAL {int(self.ttl_days * 86400)} SECOND;")
+        return sql
+
+    def eviction_sql(self) -> Optional[str]:
+        """Drop the least recently used entries beyond the capacity."""
+        if self.capacity is None:
+            return None
+        return (f"DELETE FROM {self.table} WHERE key IN (\n"
+                f"  SELECT key FROM {self.table} ORDER BY last_used DESC, key OFFSET {self.capacity}\n"
+                f");")
+
+    def stats(self, conn, label: Optional[str] = None) -> List[Tuple[str, str, int, int, float]]:
+        """
+        Hit/miss totals per (query, call) from the stats table of ``conn``,
+        as (query, call, hits, misses, hit rate).
+        """
+        where = "WHERE query = ?" if label is not None else ""
+        return conn.execute(f"""
+            SELECT query, call, SUM(hits)::BIGINT, SUM(misses)::BIGINT,
+                   COALESCE(SUM(hits) / NULLIF(SUM(hits) + SUM(misses), 0), 0)
+            FROM {self.stats_table} {where}
+            GROUP BY query, call ORDER BY query, call
+        """, [label] if label is not None else []).fetchall()
+
+    # ------------------------------------------------------------------------
+
+    def _lookup(self, call: MemoCall, key: str, query: str) -> str:
+        """The final query's replacement for a call: memo hit, else the call."""
+        stored = f"(SELECT result FROM {self.table} WHERE key = {key})"
+        result_type = RESULT_TYPES[call.function]
+        if result_type != 'VARCHAR':
+            stored = f"CAST({stored} AS {result_type})"
+        return f"COALESCE({stored}, {query[call.start:call.end]})"
+
+
+# ============================================================================
+# Distinct-Context Query
+# ============================================================================
+
+def distinct_context_query(query: str,
+                           context_columns: Dict[Tuple[str, str], Sequence[str]]) -> MemoRewrite:
+    """
+    Rewrite ``query`` so that each memoizable call runs once per distinct
+    context: a ``<alias>__contexts`` CTE evaluates the call over the
+    distinct contexts of the probe, and the query looks its result up by
+    key (the call stays as the fallback, as in the memoized script).
+
+    ``context_columns`` is as for LlmMemo.rewrite().  The query runs twice,
+    as the probe and as itself, which trades a second evaluation of its
+    joins for the model calls saved on repeated contexts.
+    """
+    query = query.strip().rstrip(';').rstrip()
+
+    def lookup(call: MemoCall, key: str) -> str:
+        return (f"COALESCE((SELECT result FROM {call.alias}__contexts WHERE __key = {key}), "
+                f"{query[call.start:call.end]})")
+
+    plan = plan_calls(query, context_columns, lookup)
+    if isinstance(plan, str):
+        return MemoRewrite(None, [], plan)
+    ctes = ",\n".join(
+        f"{call.alias}__contexts AS MATERIALIZED (\n"
+        f"SELECT __key, {query[call.start:call.end]} AS result FROM (\n"
+        f"{distinct_contexts(call, plan.probe)}\n)\n)"
+        for call in plan.memoized)
+    rewritten = prepend_ctes(plan.final, ctes)
+    if rewritten is None:
+        return MemoRewrite(None, [], "no SELECT")
+    return MemoRewrite(rewritten + "\n", [call.alias for call in plan.memoized], "")
@@ -0,0 +1,158 @@
+"""
+LLM Payload Estimation
+
+Estimates the bytes and tokens a Flock query's LLM calls send, from the
+lengths of their prompts and context values.  The byte counts come from
+DuckDB (``strlen`` over the context expressions, summed over the join
+that feeds the calls); a token model turns them into tokens:
+
+    - TokenModel: a fixed number of tokens per byte (0.25 by default,
+      about four bytes per token for English text and BPE vocabularies)
+    - TokenizerModel: the ratio measured by a local tokenizer on a sample
+      of the call's actual prompt and context values
+
+A call's payload counts its prompt once per request and the UTF-8 bytes
+of every context value (the ``'data'`` entries of ``context_columns``, as
+text).  Column names and Flock's own prompt template are left out.
+
+Aggregate calls (llm_reduce, llm_rerank, ...) pack the tuples of a group
+into as few requests as the model's context window allows, so their API
+calls and round trips depend on group sizes and tuple payloads:
+``batch_plan_sql`` simulates that batching group by group.
+"""
+
+from typing import Callable, List, NamedTuple, Optional, Sequence
+
+# ============================================================================
+# Token Models
+# ============================================================================
+
+class TokenModel:
+    """Fixed tokens-per-byte ratio."""
+
+    # Sample values a model needs to measure its ratio (0: none)
+    sample_size = 0
+
+    def __init__(self, tokens_per_byte: float = 0.25):
+        self.tokens_per_byte = tokens_per_byte
+
+    @property
+    def description(self) -> str:
+        return f"~{self.tokens_per_byte:g} tokens per byte"
+
+    def ratio(self, samples: Sequence[str]) -> float:
+        """Tokens per byte for text like ``samples``."""
+        return self.tokens_per_byte
+
+
+class TokenizerModel(TokenModel):
+    """
+    Tokens-per-byte ratio measured by a tokenizer on sample values, e.g.
+    ``TokenizerModel(tiktoken.get_encoding('cl100k_base').encode, 'cl100k_base')``.
+
+    Tokenizing every value would take a Python call per row, so only the
+    ratio is measured and the byte totals still come from SQL.  Without
+    samples the fixed ratio of TokenModel applies.
+    """
+
+    sample_size = 1000
+
+    def __init__(self, encode: Callable[[str], Sequence], name: str,
+                 tokens_per_byte: float = 0.25):
+        super().__init__(tokens_per_byte)
+        self.encode = encode
+        self.name = name
+
+    @property
+    def description(self) -> str:
+        return f"tokens measured with {self.name}"
+
+    def ratio(self, samples: Sequence[str]) -> float:
+        text = "\n".join(samples)
+        size = len(text.encode('utf-8'))
+        if size == 0:
+            return self.tokens_per_byte
+        return len(self.encode(text)) / size
+
+
+def tiktoken_model(encoding: str = "cl100k_base") -> TokenizerModel:
+    """TokenizerModel for a tiktoken encoding (needs the tiktoken package)."""
+    try:
+        import tiktoken
+    except ImportError as e:
+        raise ImportError(f"--tokenizer {encoding} needs the tiktoken package "
+                          f"(pip install tiktoken)") from e
+    return TokenizerModel(tiktoken.get_encoding(encoding).encode, encoding)
+
+
+# ============================================================================
+# Payload Estimates
+# ============================================================================
+
+class CallPayload(NamedTuple):
+    """Payload of one LLM call site before and after reduction."""
+    label: str                     # alias (function) of the call
+    before_bytes: int              # over the join of the base tables
+    after_bytes: int               # over the join of the reduced tables
+    distinct_bytes: Optional[int]  # every distinct context sent once, if counted
+    tokens_per_byte: float
+    exact: bool                    # False when some WHERE conditions were not applied
+
+    def tokens(self, byte_count: Optional[int]) -> Optional[int]:
+        return None if byte_count is None else round(byte_count * self.tokens_per_byte)
+
+
+def byte_length_sql(expressions: Sequence[str]) -> str:
+    """SQL for the total text length in bytes of ``expressions`` in one row."""
+    if not expressions:
+        return "0"
+    return " + ".join(f"COALESCE(strlen(CAST({expr} AS VARCHAR)), 0)" for expr in expressions)
+
+
+def payload_bytes(prompt_bytes: int, requests: int, context_bytes: List[int]) -> int:
+    """Prompt once per request plus all context bytes."""
+    return prompt_bytes * requests + sum(context_bytes)
+
+
+# ============================================================================
+# Batch Planning
+# ============================================================================
+
+class BatchPlan(NamedTuple):
+    """Expected API calls of one aggregate LLM call site."""
+    label: str          # alias (function) of the call
+    groups: int
+    tuples: int         # rows of the join over all groups
+    tokens: int         # the prompt once per API call plus every tuple
+    api_calls: int
+    round_trips: int    # API calls of the group needing the most
+    exact: bool         # False when some WHERE conditions were not applied
+
+
+def batch_plan_sql(groups_sql: str, prompt_tokens: float, tokens_per_byte: float,
+                   context_window: int, merge: bool) -> str:
+    """
+    SQL simulating how an aggregate call batches the tuples of each group.
+
+    ``groups_sql`` gives one row per group with its tuple count ``n`` and
+    context bytes ``b``.  A batch holds as many tuples as fit in the
+    context window next to the prompt (at least one), taking every tuple
+    to be of its group's mean size.  With ``merge`` (llm_reduce), a group
+    needing more than one batch takes one more call to combine the batch
+    results.  Returns (groups, tuples, bytes, API calls, most API calls of
+    one group).
+    """
+    capacity = max(context_window - prompt_tokens, 1)
+    extra = "CASE WHEN batches > 1 THEN 1 ELSE 0 END" if merge else "0"
+    return f"""
+        SELECT COUNT(*), SUM(n)::BIGINT, SUM(b)::BIGINT, SUM(calls)::BIGINT, MAX(calls)::BIGINT
+        FROM (
+            SELECT n, b, batches + {extra} AS calls
+            FROM (
+                SELECT n, COALESCE(b, 0) AS b,
+                       CEIL(n / GREATEST(1, FLOOR({capacity} /
+                            GREATEST(COALESCE(b, 0) * {tokens_per_byte} / n, 1e-9))))::BIGINT AS batches
+                FROM ({groups_sql}) WHERE n > 0
+            )
+        )
+    """
@@ -0,0 +1,501 @@
+"""
+LLM Execution Pipeline
+
+Runs the per-row LLM calls of a (reduced) Flock query outside DuckDB, with
+controlled concurrency, instead of Flock's row-at-a-time evaluation:
+
+    1. probe: the query's rows are materialized once into a snapshot
+       table, with every memoizable call replaced by its key and the
+       columns it reads (as in llm_cache); the distinct contexts not yet
+       in the memo table are streamed out of it in batches (Arrow record
+       batches when pyarrow is installed, ``fetchmany`` otherwise)
+    2. a pool of asyncio workers sends one request per context to an
+       endpoint, throttled by a token bucket, retrying failed requests
+       with exponential backoff and answering repeated requests from an
+       on-disk cache
+    3. results are written back into the memo table (LlmMemo's schema) in
+       batches as they arrive, by a single writer task
+    4. the snapshot's rows are read back with every memoized call looked
+       up in the memo table, and optionally stored in an output table
+
+The final query reads the snapshot instead of running the query again, so
+it sees exactly the rows the probe saw, even under a LIMIT without ORDER
+BY.
+
+Endpoints are async callables ``endpoint(function, model, prompt)`` with
+``model`` and ``prompt`` as JSON text, as the query would have passed them
+to Flock:
+
+    - HttpEndpoint: POSTs ``{"function", "model", "prompt"}`` to a URL and
+      reads ``{"result": ...}`` back
+    - MockEndpoint: MockFlock's deterministic results, in process, with
+      simulated latency and failures
+    - serve_mock(): MockEndpoint's results behind a local HTTP server, for
+      testing HttpEndpoint
+
+Contexts whose requests still fail after the last retry are left out of
+the memo table and read as NULL; every context of the snapshot without a
+memo entry at the end of the run is counted as a failure.  Aggregate calls
+(llm_reduce, ...) are not run by the pipeline; the snapshot evaluates them
+as written.
+
+Usage:
+    python llm_pipeline.py QUERY.sql --data-dir DIR (--endpoint URL | --mock) [--output-table T]
+"""
+
+import json
+import time
+import random
+import asyncio
+import argparse
+import threading
+import urllib.request
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+import duckdb
+
+from llm_cache import RESULT_TYPES, LlmMemo, MemoCall, distinct_contexts, plan_calls
+from mock_flock import MockFlock
+
+# ============================================================================
+# Rate Limiting and Caching
+# ============================================================================
+
+class TokenBucket:
+    """
+    At most ``rate`` requests per second on average, in bursts of up to
+    ``capacity`` requests.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """Wait for a token and take it."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class ResultCache:
+    """
+    Results by request key in a JSON-lines file: loaded once, appended to
+    as results arrive, so an interrupted run keeps what it got.
+    """
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self._results: Dict[str, object] = {}
+        if self.path.exists():
+            with self.path.open(encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._results[entry['key']] = entry['result']
+
+    def __len__(self) -> int:
+        return len(self._results)
+
+    def get(self, key: str) -> Tuple[bool, object]:
+        """(found, result) of ``key``."""
+        return key in self._results, self._results.get(key)
+
+    def put(self, key: str, result: object) -> None:
+        self._results[key] = result
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.path.open('a', encoding='utf-8') as f:
+            f.write(json.dumps({'key': key, 'result': result}) + "\n")
+
+
+# ============================================================================
+# Endpoints
+# ============================================================================
+
+class EndpointError(Exception):
+    """A request the endpoint did not answer; retried by the pipeline."""
+
+
+class MockEndpoint:
+    """
+    MockFlock's results for per-row calls, after ``latency_ms``; a
+    ``failure_rate`` fraction of requests fails (seeded, so runs repeat).
+    """
+
+    def __init__(self, mock: Optional[MockFlock] = None, latency_ms: float = 0.0,
+                 failure_rate: float = 0.0, seed: int = 0):
+        self.mock = mock or MockFlock()
+        self.latency_ms = latency_ms
+        self.failure_rate = failure_rate
+        self.requests = 0
+        self._random = random.Random(seed)
+
+    async def __call__(self, function: str, model: str, prompt: str):
+        self.requests += 1
+        if self.latency_ms:
+            await asyncio.sleep(self.latency_ms / 1000)
+        if self._random.random() < self.failure_rate:
+            raise EndpointError(f"mock failure of {function}")
+        return self.mock.complete(function, model, prompt)
+
+
+class HttpEndpoint:
+    """JSON over HTTP: POST ``{"function", "model", "prompt"}``, read ``{"result"}``."""
+
+    def __init__(self, url: str, timeout_s: float = 60.0):
+        self.url = url
+        self.timeout_s = timeout_s
+
+    async def __call__(self, function: str, model: str, prompt: str):
+        body = json.dumps({'function': function, 'model': json.loads(model),
+                           'prompt': json.loads(prompt)}).encode('utf-8')
+        return await asyncio.to_thread(self._post, body)
+
+    def _post(self, body: bytes):
+        request = urllib.request.Request(self.url, data=body, method='POST',
+                                         headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout_s) as response:
+                return json.loads(response.read())['result']
+        except (OSError, ValueError, KeyError) as e:
+            raise EndpointError(f"{self.url}: {e}") from e
+
+
+def serve_mock(endpoint: MockEndpoint, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """
+    Serve ``endpoint`` over HTTP in a background thread (``port`` 0: any
+    free port, see ``server.server_address``).  Failures answer 503.
+    Stop with ``server.shutdown()``.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            try:
+                # Compact JSON, as DuckDB's to_json writes it
+                result = asyncio.run(endpoint(request['function'],
+                                              json.dumps(request['model'], separators=(',', ':')),
+                                              json.dumps(request['prompt'], separators=(',', ':'))))
+                status, body = 200, {'result': result}
+            except EndpointError as e:
+                status, body = 503, {'error': str(e)}
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# ============================================================================
+# Pipeline
+# ============================================================================
+
+class CallRun(NamedTuple):
+    """Pipeline run of one call site."""
+    alias: str
+    function: str
+    requests: int     # distinct contexts not yet in the memo table
+    cached: int       # answered from the on-disk cache
+    api_calls: int    # requests sent to the endpoint, retries included
+    retries: int
+    failures: int     # contexts of the snapshot left without a memo entry
+    seconds: float
+
+
+class PipelineResult(NamedTuple):
+    """Result of LlmPipeline.run()."""
+    final: Optional[str]   # the snapshot read with the memo table, None if not run
+    calls: List[CallRun]
+    reason: str            # why the query was not run
+
+
+def _as_text(result) -> Optional[str]:
+    """A result as the memo table stores it (VARCHAR castable to the call's type)."""
+    if result is None:
+        return None
+    if isinstance(result, bool):
+        return 'true' if result else 'false'
+    if isinstance(result, (list, dict)):
+        return json.dumps(result)
+    return str(result)
+
+
+def _row_batches(result, batch_size: int) -> Iterator[List[tuple]]:
+    """Rows of a DuckDB result in batches, through Arrow when pyarrow is installed."""
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                return
+            yield rows
+    else:
+        reader = (result.to_arrow_reader(batch_size) if hasattr(result, 'to_arrow_reader')
+                  else result.fetch_record_batch(batch_size))
+        for batch in reader:
+            yield list(zip(*(column.to_pylist() for column in batch.columns)))
+
+
+class LlmPipeline:
+    """
+    Settings of the pipeline: ``concurrency`` requests in flight, at most
+    ``rate`` per second (None: unlimited) with bursts of ``burst``, up to
+    ``max_retries`` retries per request after ``backoff_s``, 2 x
+    ``backoff_s``, ...  Contexts are read and results written
+    ``batch_size`` at a time.
+    """
+
+    def __init__(self, endpoint, memo: Optional[LlmMemo] = None, concurrency: int = 8,
+                 rate: Optional[float] = None, burst: Optional[float] = None,
+                 max_retries: int = 3, backoff_s: float = 0.5,
+                 cache: Optional[ResultCache] = None, batch_size: int = 1024):
+        self.endpoint = endpoint
+        self.memo = memo or LlmMemo()
+        self.concurrency = max(concurrency, 1)
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff_s = backoff_s
+        self.cache = cache
+        self.batch_size = max(batch_size, 1)
+
+    def run(self, conn: duckdb.DuckDBPyConnection, query: str,
+            context_columns: Dict[Tuple[str, str], Sequence[str]],
+            output_table: Optional[str] = None) -> PipelineResult:
+        """
+        Run the per-row calls of ``query`` through the endpoint and return
+        the query reading their results from the memo table over the
+        snapshot of the query's rows (``<memo table>_rows``, kept until
+        the next run); with ``output_table``, also store its result there.
+
+        ``context_columns`` is as for LlmMemo.rewrite().
+        """
+        query = query.strip().rstrip(';').rstrip()
+        # The lookups are built over the snapshot below, not over the query
+        plan = plan_calls(query, context_columns, lambda call, key: key)
+        if isinstance(plan, str):
+            return PipelineResult(None, [], plan)
+        conn.execute(self.memo.setup_sql())
+        rows = f"{self.memo.table}_rows"
+        conn.execute(f"CREATE OR REPLACE TABLE {rows} AS\n{plan.snapshot}")
+
+        # Contexts are streamed on their own cursor (with the same schema
+        # search path) so results can be inserted while it is open
+        search_path = conn.execute("SELECT current_setting('search_path')").fetchone()[0]
+        reader = conn.cursor()
+        reader.execute(f"SET search_path = '{search_path}'")
+        runs = []
+        for call in plan.memoized:
+            contexts = reader.execute(
+                f"SELECT __key, to_json({call.args[0]})::VARCHAR, to_json({call.args[1]})::VARCHAR\n"
+                f"FROM (\n{distinct_contexts(call, f'SELECT * FROM {rows}')}\n)\n"
+                f"WHERE __key NOT IN (SELECT key FROM {self.memo.table})")
+            runs.append(asyncio.run(self._run_call(conn, call, _row_batches(contexts, self.batch_size))))
+        reader.close()
+
+        eviction = self.memo.eviction_sql()
+        if eviction:
+            conn.execute(eviction)
+        # Failed requests and entries evicted right away both read as NULL
+        runs = [run._replace(failures=conn.execute(
+                    f"SELECT COUNT(DISTINCT {run.alias}.__key) FROM {rows}\n"
+                    f"WHERE {run.alias}.__key NOT IN (SELECT key FROM {self.memo.table})").fetchone()[0])
+                for run in runs]
+
+        lookups = ", ".join(f"{self._lookup(call, f'{call.alias}.__key')} AS {call.alias}"
+                            for call in plan.memoized)
+        final = f"SELECT * REPLACE ({lookups})\nFROM {rows}\nORDER BY rowid"
+        if output_table:
+            conn.execute(f"CREATE OR REPLACE TABLE {output_table} AS\n{final}")
+        return PipelineResult(final + "\n", runs, "")
+
+    # ------------------------------------------------------------------------
+
+    def _lookup(self, call: MemoCall, key: str) -> str:
+        """The final query's replacement for a call: its memo entry, no fallback."""
+        stored = f"(SELECT result FROM {self.memo.table} WHERE key = {key})"
+        result_type = RESULT_TYPES[call.function]
+        return stored if result_type == 'VARCHAR' else f"CAST({stored} AS {result_type})"
+
+    async def _run_call(self, conn: duckdb.DuckDBPyConnection, call: MemoCall,
+                        batches: Iterator[List[tuple]]) -> CallRun:
+        """
+        Run one call's contexts through the workers.  DuckDB calls block,
+        so reading the batches and inserting the results both run in
+        worker threads (``asyncio.to_thread``) to keep the event loop free
+        for the requests in flight.
+        """
+        start = time.perf_counter()
+        # Failures are counted against the memo table by run()
+        counts = {'requests': 0, 'cached': 0, 'api_calls': 0, 'retries': 0, 'failures': 0}
+        bucket = TokenBucket(self.rate, self.burst) if self.rate else None
+        queue: asyncio.Queue = asyncio.Queue(maxsize=2 * self.batch_size)
+        results: asyncio.Queue = asyncio.Queue()  # unbounded: a failed writer cannot block the workers
+        insert = f"INSERT INTO {self.memo.table} VALUES (?, '{call.function}', ?, now(), now(), 0)"
+
+        async def writer():
+            done: List[Tuple[str, str]] = []
+            while True:
+                item = await results.get()
+                if item is not None:
+                    done.append(item)
+                if done and (item is None or len(done) >= self.batch_size):
+                    await asyncio.to_thread(conn.executemany, insert, done)
+                    done = []
+                if item is None:
+                    return
+
+        async def send(model: str, prompt: str):
+            for attempt in range(self.max_retries + 1):
+                if bucket:
+                    await bucket.acquire()
+                counts['api_calls'] += 1
+                try:
+                    return True, await self.endpoint(call.function, model, prompt)
+                except Exception:
+                    if attempt == self.max_retries:
+                        return False, None
+                    counts['retries'] += 1
+                    await asyncio.sleep(self.backoff_s * 2 ** attempt)
+
+        async def worker():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                key, model, prompt = item
+                found, result = self.cache.get(key) if self.cache is not None else (False, None)
+                if found:
+                    counts['cached'] += 1
+                else:
+                    found, result = await send(model, prompt)
+                    if found and self.cache is not None:
+                        self.cache.put(key, result)
+                if not found:
+                    continue
+                await results.put((key, _as_text(result)))
+
+        writing = asyncio.create_task(writer())
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        while True:
+            rows = await asyncio.to_thread(next, batches, None)
+            if rows is None:
+                break
+            for row in rows:
+                counts['requests'] += 1
+                await queue.put(row)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+        await results.put(None)
+        await writing
+        return CallRun(call.alias, call.function, seconds=time.perf_counter() - start, **counts)
+
+
+def format_pipeline(name: str, result: PipelineResult) -> str:
+    """Report of one pipeline run."""
+    lines = [
+        "=" * 70,
+        f"Query: {name}",
+        "=" * 70,
+    ]
+    if result.final is None:
+        lines.append(f"Not run: {result.reason}")
+    else:
+        lines.append(f"{'Call':<30} {'Requests':<10} {'Cached':<8} {'API calls':<10} "
+                     f"{'Retries':<8} {'Failed':<8} {'Req/s'}")
+        lines.append("-" * 70)
+        for run in result.calls:
+            rate = f"{run.requests / run.seconds:,.1f}" if run.seconds > 0 and run.requests else "-"
+            lines.append(f"{f'{run.alias} ({run.function})':<30} {run.requests:<10,} {run.cached:<8,} "
+                         f"{run.api_calls:<10,} {run.retries:<8,} {run.failures:<8,} {rate}")
+    lines.append("")
+    return "\n".join(lines) + "\n"
+
+
+def main():
+    from reduction_analyzer import QueryReducer
+
+    parser = argparse.ArgumentParser(
+        description='Run the per-row LLM calls of Flock queries through an async, rate-limited pipeline')
+    parser.add_argument('query_files', nargs='+', help='SQL query file(s) to run')
+    parser.add_argument('--data-dir', required=True, help='Directory containing CSV data files')
+    parser.add_argument('--cache-dir', default=None,
+                        help='Parquet load cache directory (default: <data-dir>/.reduction_cache)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Always parse the CSV files, bypassing the load cache')
+    endpoint = parser.add_mutually_exclusive_group(required=True)
+    endpoint.add_argument('--endpoint', metavar='URL', help='HTTP endpoint answering the requests')
+    endpoint.add_argument('--mock', action='store_true', help='Answer requests with mock results')
+    parser.add_argument('--latency-ms', type=float, default=0.0,
+                        help='Simulated latency of every mock request (default: 0)')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='Fraction of mock requests that fail (default: 0)')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='Requests in flight (default: 8)')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='Requests per second (default: unlimited)')
+    parser.add_argument('--retries', type=int, default=3,
+                        help='Retries of a failed request (default: 3)')
+    parser.add_argument('--result-cache', default=None, metavar='FILE',
+                        help='JSON-lines file caching results across runs')
+    parser.add_argument('--memo-table', default='llm_memo',
+                        help='Table the results are written to (default: llm_memo)')
+    parser.add_argument('--output-table', default=None,
+                        help='Store each query result in this table (suffixed _<n> for several queries)')
+    args = parser.parse_args()
+
+    reducer = QueryReducer()
+    cache_dir = None if args.no_cache else (
+        args.cache_dir or str(Path(args.data_dir) / '.reduction_cache')
+    )
+    reducer.load_data_dynamic(args.data_dir, cache_dir=cache_dir)
+    if args.endpoint:
+        client = HttpEndpoint(args.endpoint)
+    else:
+        client = MockEndpoint(latency_ms=args.latency_ms, failure_rate=args.failure_rate)
+    pipeline = LlmPipeline(client, memo=LlmMemo(args.memo_table), concurrency=args.concurrency,
+                           rate=args.rate, max_retries=args.retries,
+                           cache=ResultCache(args.result_cache) if args.result_cache else None)
+
+    for i, query_file in enumerate(args.query_files, start=1):
+        query = Path(query_file).read_text()
+        output_table = args.output_table
+        if output_table and len(args.query_files) > 1:
+            output_table = f"{output_table}_{i}"
+        try:
+            parsed = reducer.parse_query(query)
+            columns = {(call.function, call.alias): call.context_columns
+                       for call in (parsed.llm_calls if parsed else [])}
+            graph = reducer.parse_join_graph(reducer.remove_llm_calls(query), encode_keys=False)
+            rewritten, _ = reducer.rewrite_reduced_query(query, graph)
+            result = pipeline.run(reducer.conn, rewritten or query, columns, output_table)
+        except Exception as e:
+            print(f"⚠ Error running {Path(query_file).name}: {e}\n")
+            continue
+        print(format_pipeline(Path(query_file).name, result), end='')
+        if output_table and result.final is not None:
+            print(f"✓ Results stored in {output_table}\n")
+
+
+if __name__ == '__main__':
+    main()
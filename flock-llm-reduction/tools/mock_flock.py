@@ -0,0 +1,284 @@
+"""
+Mock Flock Extension
+
+Stands in for the Flock DuckDB extension so that Flock queries, original
+and reduced, run end to end without a model, API keys or network:
+
+    - llm_complete, llm_filter, llm_embedding: Python UDFs, called once
+      per row
+    - llm_reduce, llm_rerank, llm_first, llm_last: macros that collect the
+      prompts of each group with ``list()`` and pass them to a Python UDF,
+      so they aggregate like Flock's functions
+
+All functions take Flock's (model, prompt) arguments; both are passed on
+as JSON, so any model and prompt struct shape is accepted.  Outputs are
+deterministic functions of the request (the MD5 of its JSON), and the
+order of a group's tuples does not change them.
+
+Batching and latency: per-row calls are charged one API call per
+``batch_size`` rows, aggregates one per ``batch_size`` tuples of a group
+plus, for llm_reduce, one call merging the batch results.  Every API call
+sleeps ``latency_ms``.
+
+Usage:
+    python mock_flock.py QUERY.sql [...] (--data-dir DIR | --database FILE | --load-script FILE)
+                         [--latency-ms MS] [--batch-size N]
+
+runs every query as written and rewritten over its reduced tables (see
+QueryReducer.rewrite_reduced_query) and reports wall time, LLM call
+counts and throughput for each.
+"""
+
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+
+import duckdb
+
+from reduction_analyzer import QueryReducer
+
+# ============================================================================
+# Mock Functions
+# ============================================================================
+
+# Per-row functions and their result types
+SCALAR_FUNCTIONS = {
+    'llm_complete': 'VARCHAR',
+    'llm_filter': 'BOOLEAN',
+    'llm_embedding': 'FLOAT[]',
+}
+
+# Aggregate functions (all return VARCHAR)
+AGGREGATE_FUNCTIONS = ('llm_reduce', 'llm_rerank', 'llm_first', 'llm_last')
+
+
+class MockStats(NamedTuple):
+    """Calls of one mock function since the last reset."""
+    function: str
+    tuples: int       # rows (per-row functions) or group tuples (aggregates)
+    api_calls: int
+
+
+def _digest(*parts: str) -> str:
+    return hashlib.md5("\x1f".join(parts).encode('utf-8')).hexdigest()
+
+
+class MockFlock:
+    """
+    Deterministic stand-ins for the Flock functions, with call counting,
+    batching and latency.
+    """
+
+    def __init__(self, latency_ms: float = 0.0, batch_size: int = 1,
+                 filter_rate: float = 0.5, embedding_dim: int = 8):
+        self.latency_ms = latency_ms
+        self.batch_size = max(batch_size, 1)
+        # Fraction of requests llm_filter accepts
+        self.filter_rate = filter_rate
+        self.embedding_dim = embedding_dim
+        # DuckDB may call the UDFs from several threads
+        self._lock = threading.Lock()
+        self._tuples: Dict[str, int] = {}
+        self._api_calls: Dict[str, int] = {}
+        self.reset()
+
+    def register(self, conn: duckdb.DuckDBPyConnection) -> None:
+        """Define the Flock functions on ``conn`` (as temporary macros)."""
+        for function, result_type in SCALAR_FUNCTIONS.items():
+            udf = f"__mock_{function}"
+            conn.create_function(udf, self._scalar(function), ['VARCHAR', 'VARCHAR'], result_type,
+                                 side_effects=True)
+            conn.execute(f"CREATE OR REPLACE TEMP MACRO {function}(model, prompt) AS "
+                         f"{udf}(to_json(model)::VARCHAR, to_json(prompt)::VARCHAR)")
+        for function in AGGREGATE_FUNCTIONS:
+            udf = f"__mock_{function}"
+            conn.create_function(udf, self._aggregate(function), ['VARCHAR', 'VARCHAR[]'], 'VARCHAR',
+                                 side_effects=True)
+            conn.execute(f"CREATE OR REPLACE TEMP MACRO {function}(model, prompt) AS "
+                         f"{udf}(to_json(any_value(model))::VARCHAR, list(to_json(prompt)::VARCHAR))")
+
+    def reset(self) -> None:
+        """Zero the call counts."""
+        with self._lock:
+            for function in list(SCALAR_FUNCTIONS) + list(AGGREGATE_FUNCTIONS):
+                self._tuples[function] = 0
+                self._api_calls[function] = 0
+
+    def stats(self) -> List[MockStats]:
+        """Call counts of the functions called since the last reset."""
+        with self._lock:
+            return [MockStats(function, self._tuples[function], self._api_calls[function])
+                    for function in self._tuples if self._tuples[function]]
+
+    def complete(self, function: str, model: str, prompt: str):
+        """
+        Result of a per-row function for one request, ``model`` and
+        ``prompt`` as JSON; not counted as a call.
+        """
+        digest = _digest(function, model, prompt)
+        if function == 'llm_filter':
+            return int(digest[:8], 16) / 2 ** 32 < self.filter_rate
+        if function == 'llm_embedding':
+            rng = random.Random(digest)
+            return [rng.uniform(-1, 1) for _ in range(self.embedding_dim)]
+        return f"mock {function} {digest[:12]}"
+
+    # ------------------------------------------------------------------------
+
+    def _charge(self, function: str, tuples: int, api_calls: Optional[int] = None) -> None:
+        """Count calls and sleep for their latency; ``api_calls`` None: one row of a batch."""
+        with self._lock:
+            if api_calls is None:
+                # One API call at the first row of every batch
+                api_calls = 1 if self._tuples[function] % self.batch_size == 0 else 0
+            self._tuples[function] += tuples
+            self._api_calls[function] += api_calls
+        if api_calls and self.latency_ms:
+            time.sleep(api_calls * self.latency_ms / 1000)
+
+    def _scalar(self, function: str):
+        def call(model: str, prompt: str):
+            self._charge(function, 1)
+            return self.complete(function, model, prompt)
+        return call
+
+    def _aggregate(self, function: str):
+        def call(model: str, prompts: List[str]):
+            prompts = prompts or []
+            batches = -(-len(prompts) // self.batch_size)
+            merges = 1 if function == 'llm_reduce' and batches > 1 else 0
+            self._charge(function, len(prompts), batches + merges)
+            # Rank by a hash of each tuple: independent of the input order,
+            # and llm_first/llm_last agree with llm_rerank
+            ranked = sorted(prompts, key=lambda prompt: _digest(model, prompt))
+            if function == 'llm_reduce':
+                return f"mock {function} {_digest(function, model, *ranked)[:12]}"
+            tuples = [json.loads(prompt).get('context_columns') for prompt in ranked]
+            if function == 'llm_rerank':
+                return json.dumps(tuples)
+            if not tuples:
+                return None
+            return json.dumps(tuples[0] if function == 'llm_first' else tuples[-1])
+        return call
+
+
+# ============================================================================
+# End-to-End Runs
+# ============================================================================
+
+class QueryRun(NamedTuple):
+    """One timed run of a query against the mock functions."""
+    variant: str
+    rows: int
+    seconds: float
+    stats: List[MockStats]
+
+    @property
+    def tuples(self) -> int:
+        return sum(s.tuples for s in self.stats)
+
+    @property
+    def api_calls(self) -> int:
+        return sum(s.api_calls for s in self.stats)
+
+
+def run_query(conn: duckdb.DuckDBPyConnection, mock: MockFlock, query: str,
+              variant: str) -> QueryRun:
+    """Run ``query`` (one or more statements) and count its mock calls."""
+    mock.reset()
+    start = time.perf_counter()
+    result = conn.execute(query.strip().rstrip(';'))
+    rows = len(result.fetchall()) if result.description else 0
+    return QueryRun(variant, rows, time.perf_counter() - start, mock.stats())
+
+
+def run_original_and_reduced(reducer: QueryReducer, mock: MockFlock,
+                             query: str) -> List[QueryRun]:
+    """
+    Run ``query`` as written and, if any of its tables can be replaced by
+    a reduced form, rewritten over its reduced tables.
+    """
+    runs = [run_query(reducer.conn, mock, query, "original")]
+    graph = reducer.parse_join_graph(reducer.remove_llm_calls(query), encode_keys=False)
+    rewritten, _ = reducer.rewrite_reduced_query(query, graph)
+    if rewritten is not None:
+        runs.append(run_query(reducer.conn, mock, rewritten, "reduced"))
+    return runs
+
+
+def format_runs(name: str, runs: List[QueryRun]) -> str:
+    """Report of the runs of one query."""
+    lines = [
+        "=" * 70,
+        f"Query: {name}",
+        "=" * 70,
+        f"{'Variant':<12} {'Wall (s)':<10} {'Rows':<10} {'Tuples':<10} {'API calls':<10} {'Tuples/s'}",
+        "-" * 70,
+    ]
+    for run in runs:
+        rate = f"{run.tuples / run.seconds:,.1f}" if run.seconds > 0 and run.tuples else "-"
+        lines.append(f"{run.variant:<12} {run.seconds:<10.3f} {run.rows:<10,} {run.tuples:<10,} "
+                     f"{run.api_calls:<10,} {rate}")
+        for s in run.stats:
+            lines.append(f"   {s.function}: {s.tuples:,} tuples in {s.api_calls:,} API calls")
+    lines.append("")
+    return "\n".join(lines) + "\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run Flock queries end to end against mock LLM functions')
+    parser.add_argument('query_files', nargs='+', help='SQL query file(s) to run')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--data-dir', help='Directory containing CSV data files')
+    source.add_argument('--database', metavar='FILE',
+                        help='Run over the tables of an existing DuckDB database, attached read-only')
+    source.add_argument('--load-script', metavar='FILE',
+                        help="Load the tables by running a dataset's sql/setup/load.sql, "
+                             'without its Flock and secrets lines')
+    parser.add_argument('--script-dir', metavar='DIR',
+                        help='With --load-script: directory the relative paths of the script '
+                             'resolve against (default: the dataset directory)')
+    parser.add_argument('--cache-dir', default=None,
+                        help='Parquet load cache directory (default: <data-dir>/.reduction_cache)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Always parse the CSV files, bypassing the load cache')
+    parser.add_argument('--latency-ms', type=float, default=0.0,
+                        help='Simulated latency of every API call (default: 0)')
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='Rows or group tuples per API call (default: 1)')
+    parser.add_argument('--filter-rate', type=float, default=0.5,
+                        help='Fraction of rows llm_filter accepts (default: 0.5)')
+    args = parser.parse_args()
+
+    reducer = QueryReducer()
+    if args.database:
+        reducer.attach_database(args.database)
+    elif args.load_script:
+        reducer.run_load_script(args.load_script, base_dir=args.script_dir)
+    else:
+        cache_dir = None if args.no_cache else (
+            args.cache_dir or str(Path(args.data_dir) / '.reduction_cache')
+        )
+        reducer.load_data_dynamic(args.data_dir, cache_dir=cache_dir)
+    mock = MockFlock(latency_ms=args.latency_ms, batch_size=args.batch_size,
+                     filter_rate=args.filter_rate)
+    mock.register(reducer.conn)
+
+    for query_file in args.query_files:
+        query = Path(query_file).read_text()
+        try:
+            runs = run_original_and_reduced(reducer, mock, query)
+        except Exception as e:
+            print(f"⚠ Error running {Path(query_file).name}: {e}\n")
+            continue
+        print(format_runs(Path(query_file).name, runs), end='')
+
+
+if __name__ == '__main__':
+    main()
@@ -6,22 +6,198 @@ Implements the Yannakakis semi-join reduction algorithm for analyzing
 tuple reduction in SQL queries with LLM functions.
 """
 
+import io
 import re
+import json
+import time
+import queue
+import shutil
+import hashlib
+import weakref
+import tempfile
 import duckdb
 from pathlib import Path
-from typing import Dict, List, Set, Tuple, Optional
+from typing import Dict, Iterable, Iterator, List, Set, TextIO, Tuple, Optional
 from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 import argparse
+from contextlib import contextmanager
+
+from llm_cache import PER_ROW_FUNCTIONS, LlmMemo, distinct_context_query, prepend_ctes
+from llm_payload import (BatchPlan, CallPayload, TokenModel, batch_plan_sql, byte_length_sql,
+                         payload_bytes, tiktoken_model)
+from reduction_report import ContextCount, NodeReduction, ReductionReport, write_reports
+from sql_profile import ProfiledConnection, SqlProfiler, format_profile
+from sql_frontend import LlmCall, ParsedQuery, SqlFrontend
+
+
+# One side of an equi-join key: ``t.col``, ``t.col::TYPE`` or
+# ``[TRY_]CAST(t.col AS TYPE)``.  Groups: alias, column, cast type.
+_KEY_SIDE_PATTERNS = [
+    re.compile(r'(?:TRY_)?CAST\s*\(\s*(\w+)\.(\w+)\s+AS\s+(\w+)\s*\)', re.IGNORECASE),
+    re.compile(r'(\w+)\.(\w+)\s*::\s*(\w+)'),
+    re.compile(r'(\w+)\.(\w+)()'),
+]
+
+_INTEGER_TYPES = {
+    'TINYINT', 'SMALLINT', 'INTEGER', 'INT', 'BIGINT', 'HUGEINT',
+    'INT1', 'INT2', 'INT4', 'INT8', 'LONG',
+}
+
+# ``a.x < b.y``-style comparison between two columns, see count_join_result()
+_COMPARISON_PATTERN = re.compile(r'^\s*(\w+)\.(\w+)\s*(<=|>=|<|>)\s*(\w+)\.(\w+)\s*$')
+_FLIPPED_COMPARISON = {'<': '>', '<=': '>=', '>': '<', '>=': '<='}
+
+# Words that can follow a table reference without being its alias
+_CLAUSE_KEYWORDS = {
+    'JOIN', 'WHERE', 'GROUP', 'ORDER', 'HAVING', 'LIMIT', 'OFFSET', 'QUALIFY',
+    'WINDOW', 'ON', 'USING', 'INNER', 'LEFT', 'RIGHT', 'FULL', 'OUTER', 'CROSS',
+    'NATURAL', 'SEMI', 'ANTI', 'ASOF', 'POSITIONAL', 'UNION', 'EXCEPT',
+    'INTERSECT', 'SELECT', 'FROM', 'AS', 'SET', 'AND', 'OR', 'NOT',
+}
+
+# ``FROM table [AS] alias`` / ``JOIN table [AS] alias`` outside strings and
+# comments, see rewrite_reduced_query().  Groups: skipped (string or
+# comment), keyword, table, alias.
+_TABLE_REF_PATTERN = re.compile(r"""
+    ('(?:[^']|'')*'|--[^\n]*|/\*.*?\*/)
+  | \b(FROM|JOIN)\s+(\w+)\b(?!\s*[.(])(?:\s+(?:AS\s+)?(?!(?:%s)\b)(\w+))?
+""" % '|'.join(sorted(_CLAUSE_KEYWORDS)), re.VERBOSE | re.DOTALL | re.IGNORECASE)
+
+# JOINs other than INNER outside strings and comments, see
+# rewrite_reduced_query().  Groups: skipped (string or comment), join type.
+_OUTER_JOIN_PATTERN = re.compile(r"""
+    ('(?:[^']|'')*'|--[^\n]*|/\*.*?\*/)
+  | \b(LEFT|RIGHT|FULL|SEMI|ANTI|NATURAL|ASOF|POSITIONAL)(?:\s+OUTER)?\s+JOIN\b
+""", re.VERBOSE | re.DOTALL | re.IGNORECASE)
+
+# ``name AS (`` of a WITH clause
+_CTE_NAME_PATTERN = re.compile(r'\b(\w+)\s+AS\s+(?:NOT\s+)?(?:MATERIALIZED\s+)?\(', re.IGNORECASE)
+
+# Estimate mode: a key value is sampled when hash(key, seed) % buckets
+# falls below rate * buckets.
+_SAMPLE_BUCKETS = 1_000_000
+_SAMPLE_SEED = 0
+# Below this many sampled surviving keys the normal interval is not
+# trusted and the upper bound falls back to _poisson_upper().
+_SAMPLE_MIN_KEYS = 30
+
+
+def _poisson_upper(count: int) -> float:
+    """97.5 % upper confidence bound of a Poisson mean given ``count``
+    observations (Wilson-Hilferty approximation, 3.67 for 0)."""
+    k = count + 1
+    return k * (1 - 1 / (9 * k) + 1.96 / (3 * k ** 0.5)) ** 3
+
+
+def _parse_key_side(text: str) -> Optional[Tuple[str, str, Optional[str]]]:
+    """Parse one side of a join equality into (alias, column, cast type)."""
+    for pattern in _KEY_SIDE_PATTERNS:
+        m = pattern.fullmatch(text.strip())
+        if m:
+            return m.group(1), m.group(2), (m.group(3).upper() or None)
+    return None
+
+
+def _parse_key_equality(conjunct: str):
+    """
+    Parse ``<key side> = <key side>`` into a pair of (alias, column, cast)
+    tuples, or return None if the conjunct is not a plain key equality.
+    """
+    parts = conjunct.split('=')
+    if len(parts) != 2:
+        return None
+    left, right = _parse_key_side(parts[0]), _parse_key_side(parts[1])
+    if left is None or right is None:
+        return None
+    return left, right
+
+
+def _split_conjuncts(expr: str) -> List[str]:
+    """
+    Split a boolean expression on its top-level ANDs.
+
+    ANDs inside parentheses or string literals, and the AND of a
+    ``BETWEEN x AND y``, are not split on.
+    """
+    conjuncts = []
+    depth = 0
+    start = 0
+    pending_between = False
+    i = 0
+    while i < len(expr):
+        c = expr[i]
+        if c == "'":
+            # Skip the string literal ('' is an escaped quote)
+            i += 1
+            while i < len(expr) and not (expr[i] == "'" and expr[i + 1:i + 2] != "'"):
+                i += 2 if expr[i] == "'" else 1
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif depth == 0 and (c.isalpha() or c == '_') and (i == 0 or not (expr[i - 1].isalnum() or expr[i - 1] == '_')):
+            m = re.match(r'\w+', expr[i:])
+            word = m.group(0).upper()
+            if word == 'BETWEEN':
+                pending_between = True
+            elif word == 'AND':
+                if pending_between:
+                    pending_between = False
+                else:
+                    conjuncts.append(expr[start:i])
+                    start = i + 3
+            i += len(word)
+            continue
+        i += 1
+    conjuncts.append(expr[start:])
+    return [c.strip() for c in conjuncts if c.strip()]
 
 
 class JoinGraph:
-    """Represents the join graph of a query."""
+    """
+    Represents the join graph of a query.
+
+    Edges are kept in ``edges`` as (table1, table2, join_condition) tuples,
+    with at most one edge per pair of nodes: the condition is the full
+    conjunction of every predicate that joins the pair.  An adjacency
+    index (node -> neighbour -> position in ``edges``) gives O(1)
+    neighbour and condition lookups.
+    """
     
     def __init__(self):
         self.nodes = set()  # table names (or aliases for self-join instances)
-        self.edges = []  # list of (table1, table2, join_condition)
+        self._edges: List[Tuple[str, str, str]] = []  # list of (table1, table2, join_condition)
+        self._adjacency: Dict[str, Dict[str, int]] = defaultdict(dict)
         self.aliases = {}  # table -> alias mapping
         self.node_base_table = {}  # node_id -> actual DB table name (for self-joins)
+        self.folded: Dict[str, List[str]] = {}  # folded node -> original member nodes
+        # node -> single-table WHERE conjuncts, when known from the SQL front-end
+        self.local_predicates: Optional[Dict[str, List[str]]] = None
+        # Query conditions the graph does not apply (cross-table filters
+        # other than key equalities, subquery filters): the join it
+        # describes may be larger than the query's.
+        self.unapplied: List[str] = []
+        # JOINs other than INNER (LEFT, RIGHT, FULL, SEMI, ...): their ON
+        # clauses are not edges, as they do not filter the preserved side
+        self.outer_joins = 0
+        # Nodes on the NULL-supplying side of an outer join: a predicate
+        # such as ``b.x IS NULL`` also holds for NULL-extended rows, so
+        # local predicates are never pushed down into them
+        self.nullable: Set[str] = set()
+
+    @property
+    def edges(self) -> List[Tuple[str, str, str]]:
+        """All edges as (table1, table2, join_condition) tuples."""
+        return self._edges
+
+    @edges.setter
+    def edges(self, edges: Iterable[Tuple[str, str, str]]):
+        """Replace all edges, merging edges between the same pair of nodes."""
+        self._edges = []
+        self._adjacency = defaultdict(dict)
+        for table1, table2, condition in edges:
+            self.add_edge(table1, table2, condition)
 
     def add_node(self, table: str, alias: Optional[str] = None):
         """Add a table node to the graph, with optional alias."""
@@ -32,52 +208,581 @@ class JoinGraph:
     def add_edge(self, table1: str, table2: str, condition: str):
         """Add an edge (join) between two tables.
         
-        Duplicate edges between the same pair of nodes are ignored to
-        prevent multi-condition JOINs (e.g. ON a.x = b.x AND a.y = b.y)
-        from causing false cycle detection.
-        """
-        pair = frozenset((table1, table2))
-        for t1, t2, _ in self.edges:
-            if frozenset((t1, t2)) == pair:
-                return  # edge already exists for this pair
-        self.edges.append((table1, table2, condition))
+        If the pair is already joined, the new condition is ANDed onto the
+        existing edge instead of adding a second edge, so multi-condition
+        JOINs (e.g. ON a.x = b.x AND a.y = b.y) become one composite-key
+        edge rather than a false cycle.
+        """
+        index = self._adjacency[table1].get(table2)
+        if index is None:
+            index = len(self._edges)
+            self._edges.append((table1, table2, condition))
+            self._adjacency[table1][table2] = index
+            self._adjacency[table2][table1] = index
+            return
+        t1, t2, existing = self._edges[index]
+        known = _split_conjuncts(existing)
+        extra = [c for c in _split_conjuncts(condition) if c not in known]
+        if extra:
+            merged = " AND ".join([existing] + extra) if existing else " AND ".join(extra)
+            self._edges[index] = (t1, t2, merged)
         
     def is_cyclic(self) -> bool:
         """
-        Check if join graph is cyclic.
-        A graph is cyclic if: #edges >= #nodes (and graph is non-empty)
+        Check if join graph is cyclic, in the α-acyclicity sense used by
+        Yannakakis: the graph is cyclic iff GYO ear removal (join_tree())
+        cannot reduce its hypergraph.
         """
         if not self.nodes:
             return False
-        return len(self.edges) >= len(self.nodes)
+        return self.join_tree() is None
+
+    def _hypergraph(self) -> Tuple[Dict[str, Set[object]], Dict[Tuple[str, object], str],
+                                   Dict[Tuple[str, str], object]]:
+        """
+        Hypergraph view of the join graph for GYO.
+
+        Join attributes are equivalence classes of key columns: every
+        equality ``a.x = b.y`` puts (a, x) and (b, y) in the same class,
+        transitively.  Each node becomes the hyperedge of the classes of
+        its key columns.  An edge that has a non-equality conjunct (or no
+        parseable key at all) also gets a private attribute shared only by
+        its two nodes, which forces them to be adjacent in the join tree.
+
+        Returns (node -> attributes, (node, attribute) -> key expression,
+        (node, column) -> attribute).
+        """
+        union: Dict[Tuple[str, str], Tuple[str, str]] = {}
+
+        def _find(col: Tuple[str, str]) -> Tuple[str, str]:
+            while union.setdefault(col, col) != col:
+                col = union[col]
+            return col
+
+        sides: List[Tuple[str, str, str]] = []  # (node, column, expression)
+        hyperedges: Dict[str, Set[object]] = {node: set() for node in self.nodes}
+        for t1, t2, cond in self._edges:
+            residual = not _split_conjuncts(cond)
+            for conjunct in _split_conjuncts(cond):
+                equality = _parse_key_equality(conjunct)
+                if equality is None or {equality[0][0], equality[1][0]} != {t1, t2}:
+                    residual = True
+                    continue
+                (a1, c1, _), (a2, c2, _) = equality
+                expr1, expr2 = (part.strip() for part in conjunct.split('='))
+                sides.extend([(a1, c1, expr1), (a2, c2, expr2)])
+                union[_find((a1, c1))] = _find((a2, c2))
+            if residual:
+                private = ('~', t1, t2)
+                hyperedges.setdefault(t1, set()).add(private)
+                hyperedges.setdefault(t2, set()).add(private)
+
+        key_exprs: Dict[Tuple[str, object], str] = {}
+        column_attrs: Dict[Tuple[str, str], object] = {}
+        for node, column, expr in sides:
+            attr = _find((node, column))
+            hyperedges.setdefault(node, set()).add(attr)
+            key_exprs.setdefault((node, attr), expr)
+            column_attrs[(node, column)] = attr
+        return hyperedges, key_exprs, column_attrs
+
+    def _gyo(self) -> Tuple[Dict[str, Optional[str]], Set[str]]:
+        """
+        GYO ear removal.
+
+        Repeatedly (1) drop attributes that occur in a single hyperedge and
+        (2) remove an ear: a hyperedge contained in another one (its
+        witness, which becomes its parent).  A hyperedge left with no
+        attributes is the root of its connected component.  The graph is
+        α-acyclic iff every hyperedge can be removed.
+
+        Returns (node -> parent for removed nodes, nodes left over).
+        """
+        remaining = {node: set(attrs) for node, attrs in self._hypergraph()[0].items()}
+        parent: Dict[str, Optional[str]] = {}
+        while remaining:
+            counts: Dict[object, int] = defaultdict(int)
+            for attrs in remaining.values():
+                for attr in attrs:
+                    counts[attr] += 1
+            for attrs in remaining.values():
+                attrs.difference_update([a for a in attrs if counts[a] == 1])
+
+            ear = witness = None
+            for node in sorted(remaining):
+                attrs = remaining[node]
+                if not attrs:
+                    ear = node
+                    break
+                candidates = [m for m in remaining if m != node and attrs <= remaining[m]]
+                if candidates:
+                    # Prefer a witness that is joined to the ear directly
+                    neighbors = self.get_neighbors(node)
+                    ear = node
+                    witness = min(candidates, key=lambda m: (m not in neighbors, m))
+                    break
+            if ear is None:
+                break
+            parent[ear] = witness
+            del remaining[ear]
+        return parent, set(remaining)
+
+    def join_tree(self) -> Optional[Dict[str, Optional[str]]]:
+        """
+        Build a join tree by GYO ear removal, or return None if cyclic.
+
+        Returns node -> parent (None for roots).
+        """
+        parent, core = self._gyo()
+        return None if core else parent
+
+    def reduction_tree(self) -> Tuple[Dict[str, Optional[str]], List[str], bool]:
+        """
+        Tree the semi-join passes run over.
+
+        GYO ear removal gives a join tree in which every pair of tables
+        sharing a join attribute is connected through tables that also
+        carry it, which is what makes the full reducer exact.  A cyclic
+        graph falls back to a BFS spanning tree of the join graph (rooted
+        at the highest-degree node), whose non-tree edges are ignored.
+
+        Returns (node -> parent, nodes ordered so that every parent
+        precedes its children, whether it is a true join tree).
+        """
+        parent_of = self.join_tree()
+        is_join_tree = parent_of is not None
+        if parent_of is None:
+            degrees = {t: len(self.get_neighbors(t)) for t in self.nodes}
+            root = max(degrees, key=degrees.get)
+            parent_of = {root: None}
+            visited = {root}
+            queue = deque([root])
+            while queue:
+                node = queue.popleft()
+                for neighbor in self.get_neighbors(node):
+                    if neighbor not in visited:
+                        visited.add(neighbor)
+                        parent_of[neighbor] = node
+                        queue.append(neighbor)
+
+        # Roots (one per connected component) first, then children
+        children: Dict[str, List[str]] = defaultdict(list)
+        for node, parent in sorted(parent_of.items()):
+            if parent is not None:
+                children[parent].append(node)
+        order = [node for node in sorted(parent_of) if parent_of[node] is None]
+        for node in order:
+            order.extend(children[node])
+        return parent_of, order, is_join_tree
+
+    def cyclic_core(self) -> Set[str]:
+        """Nodes GYO cannot remove, i.e. the nodes taking part in a cycle."""
+        return self._gyo()[1]
+
+    def tree_decomposition(self, nodes: Optional[Iterable[str]] = None) -> List[Set[str]]:
+        """
+        Tree decomposition of the join graph restricted to ``nodes``
+        (default: all nodes), by min-degree elimination.
+
+        Eliminating a node yields the bag {node} ∪ its current neighbours;
+        the neighbours are then connected to each other (fill-in).  Only
+        maximal bags are returned.  Every join edge lies inside some bag,
+        and the bags containing a node form a connected subtree, so joining
+        bags on their shared nodes is an acyclic query.  The width of the
+        decomposition is the size of the largest bag minus one.
+        """
+        nodes = set(self.nodes if nodes is None else nodes)
+        adjacency = {node: self.get_neighbors(node) & nodes for node in nodes}
+        bags: List[Set[str]] = []
+        while adjacency:
+            node = min(adjacency, key=lambda n: (len(adjacency[n]), n))
+            neighbors = adjacency.pop(node)
+            bags.append({node} | neighbors)
+            for neighbor in neighbors:
+                adjacency[neighbor] |= neighbors - {neighbor}
+                adjacency[neighbor].discard(node)
+        return [bag for i, bag in enumerate(bags)
+                if not any(bag < other or (bag == other and j < i)
+                           for j, other in enumerate(bags))]
+
+    def tree_join_condition(self, child: str, parent: str) -> Optional[str]:
+        """
+        Join condition for a join-tree edge.
+
+        Uses the explicit condition between the two nodes when there is
+        one, plus an equality for every join attribute they share that it
+        does not already cover (the attribute may be shared only through
+        other tables, e.g. a.x = b.x, b.x = c.x links a and c on x).
+        """
+        hyperedges, key_exprs, column_attrs = self._hypergraph()
+        conjuncts = _split_conjuncts(self.get_join_condition(child, parent) or '')
+        covered = set()
+        for conjunct in conjuncts:
+            equality = _parse_key_equality(conjunct)
+            if equality is not None:
+                alias, column, _ = equality[0]
+                covered.add(column_attrs.get((alias, column)))
+        shared = hyperedges.get(child, set()) & hyperedges.get(parent, set())
+        for attr in sorted(shared, key=repr):
+            if attr in covered or (child, attr) not in key_exprs:
+                continue
+            conjuncts.append(f"{key_exprs[(child, attr)]} = {key_exprs[(parent, attr)]}")
+        return " AND ".join(conjuncts) or None
     
     def get_neighbors(self, table: str) -> Set[str]:
         """Get all tables joined with this table."""
-        neighbors = set()
-        for t1, t2, _ in self.edges:
-            if t1 == table:
-                neighbors.add(t2)
-            elif t2 == table:
-                neighbors.add(t1)
-        return neighbors
+        return set(self._adjacency.get(table, ()))
     
     def get_join_condition(self, table1: str, table2: str) -> Optional[str]:
         """Get join condition between two tables."""
-        for t1, t2, cond in self.edges:
-            if (t1 == table1 and t2 == table2) or (t1 == table2 and t2 == table1):
-                return cond
-        return None
+        index = self._adjacency.get(table1, {}).get(table2)
+        return None if index is None else self._edges[index][2]
+
+    def get_join_keys(self, table1: str, table2: str) -> List[Tuple[str, str]]:
+        """
+        Column pairs (table1 column, table2 column) of every key equality
+        in the join condition between two tables, casts stripped.
+        """
+        keys = []
+        for conjunct in _split_conjuncts(self.get_join_condition(table1, table2) or ''):
+            equality = _parse_key_equality(conjunct)
+            if equality is None:
+                continue
+            (a1, c1, _), (a2, c2, _) = equality
+            if (a1, a2) == (table1, table2):
+                keys.append((c1, c2))
+            elif (a1, a2) == (table2, table1):
+                keys.append((c2, c1))
+        return keys
+
+
+class LoadCache:
+    """
+    On-disk Parquet cache of parsed CSV files.
+
+    Every CSV is stored as one Parquet file, and ``manifest.json`` records
+    for each CSV (keyed by its resolved path) the size, mtime and SHA-256
+    of the content it was built from.  An entry is reused when size and
+    mtime still match, or, if only the mtime changed, when the content
+    hash still matches.  Anything else is re-parsed and re-cached.
+    """
+
+    MANIFEST = "manifest.json"
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        manifest_path = self.cache_dir / self.MANIFEST
+        try:
+            self.entries = json.loads(manifest_path.read_text())
+        except (FileNotFoundError, ValueError):
+            self.entries = {}
+
+    @staticmethod
+    def file_hash(path: Path) -> str:
+        """SHA-256 of a file's content, read in 1 MiB chunks."""
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def lookup(self, csv_path: Path) -> Optional[Path]:
+        """Return the cached Parquet file for csv_path, or None on a miss."""
+        entry = self.entries.get(str(csv_path.resolve()))
+        if entry is None:
+            return None
+        parquet = self.cache_dir / entry['parquet']
+        if not parquet.exists():
+            return None
+        stat = csv_path.stat()
+        if stat.st_size != entry['size']:
+            return None
+        if stat.st_mtime_ns != entry['mtime_ns']:
+            # Touched but possibly unchanged: fall back to the content hash
+            if self.file_hash(csv_path) != entry['sha256']:
+                return None
+            entry['mtime_ns'] = stat.st_mtime_ns
+            self.save()
+        return parquet
+
+    def parquet_path(self, csv_path: Path, sha256: str) -> Path:
+        """Cache file name for a CSV with the given content hash."""
+        return self.cache_dir / f"{csv_path.stem}-{sha256[:16]}.parquet"
+
+    def store(self, csv_path: Path, sha256: str, parquet: Path) -> None:
+        """Record parquet as the cache entry for csv_path."""
+        key = str(csv_path.resolve())
+        old = self.entries.get(key)
+        if old and old['parquet'] != parquet.name:
+            (self.cache_dir / old['parquet']).unlink(missing_ok=True)
+        stat = csv_path.stat()
+        self.entries[key] = {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'sha256': sha256,
+            'parquet': parquet.name,
+        }
+        self.save()
+
+    def save(self) -> None:
+        (self.cache_dir / self.MANIFEST).write_text(json.dumps(self.entries, indent=2))
+
+
+def resource_config(memory_limit: Optional[str] = None, threads: Optional[int] = None,
+                    temp_directory: Optional[str] = None,
+                    preserve_insertion_order: bool = True) -> Dict[str, object]:
+    """
+    DuckDB configuration for the given resource limits, leaving DuckDB's
+    defaults for those not given (``memory_limit`` as DuckDB writes it,
+    e.g. '4GB').
+    """
+    config: Dict[str, object] = {}
+    if memory_limit is not None:
+        config['memory_limit'] = memory_limit
+    if threads is not None:
+        config['threads'] = threads
+    if temp_directory is not None:
+        config['temp_directory'] = temp_directory
+    if not preserve_insertion_order:
+        config['preserve_insertion_order'] = False
+    return config
+
+
+# Statements of a dataset's sql/setup/load.sql that need Flock or its
+# secrets: extension installs/loads, secrets and Flock's model/prompt DDL
+_SETUP_SKIPPED = re.compile(
+    r"^\s*(?:(?:FORCE\s+)?INSTALL|LOAD|UPDATE\s+EXTENSIONS"
+    r"|CREATE\s+(?:OR\s+REPLACE\s+)?(?:PERSISTENT\s+|TEMPORARY\s+)?(?:SECRET|MODEL|PROMPT))\b",
+    re.IGNORECASE,
+)
+
+
+def setup_statements(script: str) -> Tuple[List[str], List[str]]:
+    """
+    Split a setup script into the statements to run and those skipped.
+
+    Dot-commands of the DuckDB shell (``.read secrets.sql``) and the
+    statements matching _SETUP_SKIPPED are skipped; comment lines are
+    dropped.  Statements end at a semicolon at the end of a line.
+    """
+    run, skipped = [], []
+    lines = []
+    for line in script.splitlines():
+        if line.lstrip().startswith('.'):
+            skipped.append(line.strip())
+        elif not line.lstrip().startswith('--'):
+            lines.append(line)
+    for statement in re.split(r";[ \t]*(?:\n|$)", "\n".join(lines)):
+        statement = statement.strip()
+        if statement:
+            (skipped if _SETUP_SKIPPED.match(statement) else run).append(statement)
+    return run, skipped
 
 
 class QueryReducer:
     """Analyzes tuple reduction using semi-join reduction algorithm."""
     
-    def __init__(self, db_path: str = ":memory:"): 
-        self.conn = duckdb.connect(db_path)
+    def __init__(self, db_path: str = ":memory:", key_only: bool = False,
+                 sample_rate: Optional[float] = None,
+                 rewrite: bool = False, verify: bool = False,
+                 memo: Optional[LlmMemo] = None, dedup: bool = False,
+                 payload: bool = False, token_model: Optional[TokenModel] = None,
+                 context_window: Optional[int] = None,
+                 scratch_schema: str = "_scratch",
+                 conn: Optional[duckdb.DuckDBPyConnection] = None,
+                 out: Optional[TextIO] = None, text: bool = True,
+                 profile: bool = False, profile_dir: Optional[str] = None,
+                 memory_limit: Optional[str] = None, threads: Optional[int] = None,
+                 temp_directory: Optional[str] = None,
+                 preserve_insertion_order: bool = True, out_of_core: bool = False,
+                 multiway: bool = True):
+        # Out-of-core mode: base and scratch tables live in a database file
+        # (a temporary one unless db_path names one) and are checkpointed
+        # after loading, so DuckDB can evict them from memory; operators
+        # that exceed ``memory_limit`` spill to ``temp_directory``, and
+        # results need not keep insertion order (which DuckDB otherwise
+        # buffers for).  The settings apply to the whole database, so
+        # workers sharing it inherit them.
+        self.out_of_core = out_of_core
+        self.spill_dir: Optional[str] = None
+        if conn is None:
+            if out_of_core and db_path == ":memory:":
+                self.spill_dir = tempfile.mkdtemp(prefix="reduction_", dir=temp_directory)
+                weakref.finalize(self, shutil.rmtree, self.spill_dir, ignore_errors=True)
+                db_path = str(Path(self.spill_dir) / "reduction.duckdb")
+            self.resources = resource_config(memory_limit, threads, temp_directory,
+                                             preserve_insertion_order and not out_of_core)
+            # An existing connection (e.g. a cursor of another reducer's
+            # database) can be passed in instead of opening db_path.
+            conn = duckdb.connect(db_path, config=self.resources)
+        else:
+            self.resources = {}
+        self.db_path = db_path
+        self.conn = conn
+        # Profile mode: trace every statement of each analysis (see
+        # sql_profile), print a summary after its report and, with
+        # ``profile_dir``, write the statements and DuckDB's profiles there
+        self.profiler = SqlProfiler() if profile else None
+        self.profile_dir = profile_dir
+        if self.profiler is not None:
+            self.conn = ProfiledConnection(self.conn, self.profiler, self)
         self.table_sizes = {}
+        # table -> {'source': 'cache' | 'csv', 'seconds': load time}
+        self.load_stats: Dict[str, Dict[str, object]] = {}
+        # phase -> seconds spent in it by the last analyze_query()
+        self.timings: Dict[str, float] = {}
+        # (table, column, kind) -> encoded key column, see encode_join_keys()
+        self.key_encodings: Dict[Tuple[str, str, str], str] = {}
+        # VARCHAR key columns joined with each other so far: their __dict
+        # columns share a dictionary
+        self._key_dictionary_pairs: List[Tuple[Tuple[str, str], Tuple[str, str]]] = []
+        # Tables copied with encoded key columns into ``keys_schema`` (the
+        # others are views there)
+        self._key_tables: Set[str] = set()
+        # Where reports are written; None means the current sys.stdout
+        self.out = out
+        # Text reports: with False, nothing is printed and analyze_query()
+        # only returns its ReductionReport (warnings collected in it)
+        self.text = text
+        self._warnings: List[str] = []
+        # Key-only mode: semi-joins run over narrow (rowid, join-key)
+        # projections instead of rewriting the full-width tables each step.
+        self.key_only = key_only
+        # Multiway semi-joins: the bottom-up pass reduces each node by all
+        # of its children in one statement (see semi_join_many()) instead
+        # of one semi-join per child.
+        self.multiway = multiway
+        # Estimate mode: reduce hash samples of this fraction of the join
+        # key values instead of the full tables, see estimate_reduction().
+        self.sample_rate = sample_rate
+        # Reduce-and-execute: write each query rewritten over its reduced
+        # tables to reduced/<name> next to it (see rewrite_reduced_query())
+        # and, with ``verify``, check the rewrite returns the baseline rows.
+        self.rewrite = rewrite or verify
+        self.verify = verify
+        # Memoization: write each query as a script that looks its per-row
+        # LLM calls up in a persistent memo table first (see llm_cache)
+        self.memo = memo
+        # Write each query rewritten to call the model once per distinct
+        # context to deduplicated/<name> (see llm_cache)
+        self.dedup = dedup
+        # Payload mode: estimate the bytes and tokens of every LLM call
+        # before and after reduction (see llm_payload)
+        self.payload = payload
+        # Tokens per byte of LLM input, for the payload and batch planning
+        self.token_model = token_model or TokenModel()
+        # Batch planning: simulate how aggregate LLM calls batch their
+        # groups for a context window of this many tokens (see plan_batches())
+        self.context_window = context_window
+        # Per-query isolation: base tables live in ``base_schema`` and are
+        # never modified.  Every table the analysis creates or reduces is
+        # written to ``scratch_schema``, which comes first on the search
+        # path and therefore shadows the base table of the same name.
+        self.base_schema = "main"
+        self.scratch_schema = scratch_schema
+        # encode_join_keys() writes its copies of the base tables here and
+        # makes it the base schema
+        self.keys_schema = "_keys"
+        # DuckDB-parser front-end with its template plan cache
+        self.frontend = SqlFrontend()
+        self._reset_scratch()
+
+    def _print(self, *args, **kwargs) -> None:
+        """
+        print() to this reducer's output stream; warnings (⚠/❌ lines) are
+        also kept for the current report.
+        """
+        if args and isinstance(args[0], str) and args[0].startswith(('⚠', '❌')):
+            self._warnings.append(re.sub(r'^(?:⚠|❌)\s*(?:Note:\s*)?', '', args[0]).strip())
+        if self.text:
+            print(*args, file=self.out, **kwargs)
+
+    @contextmanager
+    def _timed(self, phase: str):
+        """Add the time spent in the block to ``self.timings[phase]``."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[phase] = self.timings.get(phase, 0.0) + time.perf_counter() - start
+
+    def close(self) -> None:
+        """Close the connection and remove the temporary out-of-core database."""
+        self.conn.close()
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    def resource_settings(self) -> Dict[str, object]:
+        """DuckDB's effective resource settings for this reducer's database."""
+        names = ('memory_limit', 'threads', 'temp_directory', 'preserve_insertion_order')
+        values = self.conn.execute(
+            "SELECT " + ", ".join(f"current_setting('{name}')" for name in names)
+        ).fetchone()
+        return dict(zip(names, values))
+
+    def spawn_worker(self, worker_id: int) -> 'QueryReducer':
+        """
+        Create a reducer that shares this reducer's loaded base tables.
+
+        The worker runs on its own cursor (a separate DuckDB connection to
+        the same database) and writes to its own scratch schema, so several
+        workers can analyze queries concurrently while only reading the
+        shared base tables.
+        """
+        worker = QueryReducer(
+            key_only=self.key_only,
+            multiway=self.multiway,
+            sample_rate=self.sample_rate,
+            rewrite=self.rewrite,
+            verify=self.verify,
+            memo=self.memo,
+            dedup=self.dedup,
+            payload=self.payload,
+            token_model=self.token_model,
+            context_window=self.context_window,
+            scratch_schema=f"{self.scratch_schema}_{worker_id}",
+            conn=self.conn.cursor(),
+            text=self.text,
+            profile=self.profiler is not None,
+            profile_dir=self.profile_dir,
+        )
+        worker.base_schema = self.base_schema
+        worker.db_path = self.db_path
+        worker.resources = self.resources
+        worker.out_of_core = self.out_of_core
+        worker._reset_scratch()
+        worker.table_sizes = dict(self.table_sizes)
+        worker.key_encodings = self.key_encodings
+        worker.frontend = self.frontend
+        return worker
+
+    def _scratch(self, table: str) -> str:
+        """Qualified name of ``table`` inside the per-query scratch schema."""
+        return f'{self.scratch_schema}."{table}"'
+
+    def _reset_scratch(self) -> None:
+        """
+        Drop every table created by the previous analysis.
+
+        Reduced and filtered copies only ever exist in the scratch schema,
+        so dropping it restores the original view of all base tables
+        without copying any of them.
+        """
+        self.conn.execute(f"DROP SCHEMA IF EXISTS {self.scratch_schema} CASCADE")
+        self.conn.execute(f"CREATE SCHEMA {self.scratch_schema}")
+        self.conn.execute(
+            f"SET search_path = '{self.scratch_schema},{self.base_schema}'"
+        )
         
-    def load_data_dynamic(self, data_dir: str):
-        """Dynamically load ALL CSV files from directory."""
+    def load_data_dynamic(self, data_dir: str, cache_dir: Optional[str] = None):
+        """
+        Dynamically load ALL CSV files from directory.
+
+        With ``cache_dir`` every CSV is parsed once and kept there as
+        Parquet (see LoadCache); later runs load the Parquet file instead
+        of sniffing and parsing the CSV again, unless the CSV changed.
+        """
         data_path = Path(data_dir)
         
         if not data_path.exists():
@@ -88,31 +793,335 @@ class QueryReducer:
         if not csv_files:
             raise ValueError(f"No CSV files found in: {data_dir}")
         
-        print("=" * 70)
-        print("Loading Data (Dynamic)")
-        print("=" * 70)
+        self._print("=" * 70)
+        self._print("Loading Data (Dynamic)")
+        self._print("=" * 70)
+        self._print_resources()
         
+        cache = LoadCache(cache_dir) if cache_dir else None
+        load_start = time.perf_counter()
+
         for csv_path in csv_files:
             table_name = csv_path.stem # filename without .csv
+            start = time.perf_counter()
             try:
-                self.conn.execute(f"DROP TABLE IF EXISTS {table_name}")
-                self.conn.execute(
-                    f"CREATE TABLE {table_name} AS "
-                    f"SELECT * FROM read_csv_auto('{csv_path}')"
-                )
+                parquet = cache.lookup(csv_path) if cache else None
+                if parquet is not None:
+                    source = 'cache'
+                    self.conn.execute(
+                        f"CREATE OR REPLACE TABLE {self.base_schema}.{table_name} AS "
+                        f"SELECT * FROM read_parquet('{parquet}')"
+                    )
+                else:
+                    source = 'csv'
+                    self.conn.execute(
+                        f"CREATE OR REPLACE TABLE {self.base_schema}.{table_name} AS "
+                        f"SELECT * FROM read_csv_auto('{csv_path}')"
+                    )
+                    if cache:
+                        sha256 = LoadCache.file_hash(csv_path)
+                        parquet = cache.parquet_path(csv_path, sha256)
+                        self.conn.execute(
+                            f"COPY {self.base_schema}.{table_name} "
+                            f"TO '{parquet}' (FORMAT PARQUET)"
+                        )
+                        cache.store(csv_path, sha256, parquet)
                 count = self.conn.execute(
                     f"SELECT COUNT(*) FROM {table_name}"
                 ).fetchone()[0] # fetchone() returns a tuple like (count,), so we take [0]
                 self.table_sizes[table_name] = count
-                print(f"✅ {table_name:<20} {count:>10,} rows") # :> and :< for alignment
+                seconds = time.perf_counter() - start
+                self.load_stats[table_name] = {'source': source, 'seconds': seconds}
+                self._print(f"✅ {table_name:<20} {count:>10,} rows  ({source}, {seconds:.2f}s)") # :> and :< for alignment
             except Exception as e:
-                print(f"❌ {table_name:<20} Error: {e}")
-        
-        print()
-        # Snapshot the freshly-loaded tables so each query analysis can
-        # start from a clean, unmodified copy.
-        self._snapshot_tables()
+                self._print(f"❌ {table_name:<20} Error: {e}")
+
+        if cache:
+            hits = sum(1 for st in self.load_stats.values() if st['source'] == 'cache')
+            self._print(f"Load cache: {hits} hit(s), {len(self.load_stats) - hits} miss(es), "
+                        f"{time.perf_counter() - load_start:.2f}s total")
+        if self.out_of_core:
+            # Write the loaded tables to the database file, so their blocks
+            # can be evicted instead of pinning memory for the whole run
+            self.conn.execute("CHECKPOINT")
+        self._print()
+
+    def _print_resources(self) -> None:
+        """Print the database and its resource settings, when configured."""
+        if self.resources or self.db_path != ":memory:":
+            settings = self.resource_settings()
+            self._print(f"Database: {self.db_path}  (memory limit {settings['memory_limit']}, "
+                        f"{settings['threads']} threads, spilling to "
+                        f"{settings['temp_directory'] or 'memory only'}"
+                        f"{', unordered' if not settings['preserve_insertion_order'] else ''})")
+
+    def _catalog_sizes(self, database: str, schema: str = "main") -> Dict[str, int]:
+        """Row counts of a schema's tables from DuckDB's catalog statistics (no scan)."""
+        return dict(self.conn.execute(
+            "SELECT table_name, estimated_size FROM duckdb_tables() "
+            "WHERE database_name = ? AND schema_name = ? ORDER BY table_name",
+            [database, schema]
+        ).fetchall())
+
+    def attach_database(self, db_file: str, alias: str = "source") -> None:
+        """
+        Use the tables of an existing DuckDB database as base tables.
+
+        The file is attached read-only as ``alias`` and never copied: base
+        tables are read in place, everything the analysis creates goes to
+        the scratch schema, and table sizes come from DuckDB's catalog
+        statistics instead of a COUNT(*) per table.
+        """
+        if not Path(db_file).exists():
+            raise ValueError(f"Database not found: {db_file}")
+
+        self._print("=" * 70)
+        self._print("Attaching Database")
+        self._print("=" * 70)
+        self._print_resources()
+
+        start = time.perf_counter()
+        self.conn.execute(f"ATTACH '{db_file}' AS {alias} (READ_ONLY)")
+        self.base_schema = f"{alias}.main"
+        self._reset_scratch()
+        sizes = self._catalog_sizes(alias)
+        if not sizes:
+            raise ValueError(f"No tables found in: {db_file}")
+        for table_name, count in sizes.items():
+            self.table_sizes[table_name] = count
+            self.load_stats[table_name] = {'source': 'catalog', 'seconds': 0.0}
+            self._print(f"✅ {table_name:<20} {count:>10,} rows  (catalog)")
+        self._print(f"Attached {db_file} read-only as {alias}, "
+                    f"{time.perf_counter() - start:.2f}s total")
+        self._print()
+
+    def run_load_script(self, script_file: str, base_dir: Optional[str] = None) -> None:
+        """
+        Load the base tables with a dataset's setup script (sql/setup/load.sql),
+        so their column types match production exactly (e.g. its
+        ``all_varchar=true`` reads).
+
+        The Flock and secrets lines are skipped (see setup_statements()).
+        Relative file paths in the script resolve against ``base_dir``: by
+        default the dataset directory of ``<dataset>/sql/setup/load.sql``,
+        otherwise the script's own directory.
+        """
+        script_path = Path(script_file).resolve()
+        if not script_path.exists():
+            raise ValueError(f"Load script not found: {script_file}")
+        if base_dir is None:
+            in_setup = script_path.parent.parent.name == 'sql'
+            base_dir = str(script_path.parents[2] if in_setup else script_path.parent)
+        statements, skipped = setup_statements(script_path.read_text())
+
+        self._print("=" * 70)
+        self._print(f"Running Load Script: {script_path.name}")
+        self._print("=" * 70)
+        self._print_resources()
+        for line in skipped:
+            self._print(f"   Skipped: {line.splitlines()[0]}")
+
+        # A new cursor has the default search path, so the script's tables
+        # are created in the base schema rather than the scratch schema
+        cursor = self.conn.cursor()
+        cursor.execute(f"SET file_search_path = '{base_dir}'")
+        start = time.perf_counter()
+        for statement in statements:
+            try:
+                cursor.execute(statement)
+            except Exception as e:
+                self._print(f"❌ {statement.splitlines()[0][:60]}  Error: {e}")
+        database = cursor.execute("SELECT current_database()").fetchone()[0]
+        cursor.close()
+        for table_name, count in self._catalog_sizes(database, self.base_schema).items():
+            self.table_sizes[table_name] = count
+            self.load_stats[table_name] = {'source': 'script', 'seconds': 0.0}
+            self._print(f"✅ {table_name:<20} {count:>10,} rows  (script)")
+        self._print(f"{len(statements)} statement(s) run from {base_dir}, "
+                    f"{time.perf_counter() - start:.2f}s total")
+        if self.out_of_core:
+            self.conn.execute("CHECKPOINT")
+        self._print()
     
+    def _column_types(self, table: str) -> Dict[str, str]:
+        """Column name -> DuckDB type of a base table."""
+        return {
+            row[0]: row[1] for row in self.conn.execute(
+                f"DESCRIBE {self.base_schema}.{table}"
+            ).fetchall()
+        }
+
+    def encode_join_keys(self, query_files: Iterable[str]) -> Dict[Tuple[str, str, str], str]:
+        """
+        Add fixed-width integer versions of the join keys used by a query set.
+
+        Every equi-join conjunct of every query is inspected:
+
+        * ``CAST(a.x AS INTEGER) = CAST(b.y AS INTEGER)`` (or TRY_CAST /
+          ``::INTEGER``) gets a native integer column named after the cast
+          type, ``x__integer``, holding ``TRY_CAST(x AS INTEGER)`` on both
+          tables (``x__bigint`` for BIGINT, and so on).
+        * ``a.x = b.y`` between two VARCHAR columns gets a dictionary id
+          column ``x__dict``.  All columns joined with each other share one
+          dictionary, so equal strings get equal ids.
+
+        parse_join_graph() then rewrites such conjuncts to compare the
+        encoded columns, so semi-joins probe integers instead of casting or
+        hashing strings on every row.  Columns that are already encoded
+        (by an earlier call, or in an attached database) are kept, so the
+        method can run again; a dictionary that gains a column is rebuilt
+        for all of its columns.  Returns every encoding known so far.
+
+        The base tables themselves are not changed: the encoded tables are
+        copies in ``keys_schema``, next to views of the other base tables,
+        and ``keys_schema`` becomes the base schema.
+        """
+        int_keys: Set[Tuple[str, str, str]] = set()
+        dict_pairs = self._key_dictionary_pairs
+        column_types: Dict[str, Dict[str, str]] = {}
+
+        def _type_of(table: str, column: str) -> Optional[str]:
+            if table not in column_types:
+                try:
+                    column_types[table] = self._column_types(table)
+                except Exception:
+                    column_types[table] = {}
+            return column_types[table].get(column)
+
+        for query_file in query_files:
+            try:
+                query = Path(query_file).read_text()
+            except OSError:
+                continue
+            graph = self.parse_join_graph(self.remove_llm_calls(query), encode_keys=False)
+            for _, _, cond in graph.edges:
+                for conjunct in _split_conjuncts(cond):
+                    equality = _parse_key_equality(conjunct)
+                    if equality is None:
+                        continue
+                    (n1, c1, cast1), (n2, c2, cast2) = equality
+                    b1 = graph.node_base_table.get(n1, n1)
+                    b2 = graph.node_base_table.get(n2, n2)
+                    if _type_of(b1, c1) is None or _type_of(b2, c2) is None:
+                        continue
+                    if cast1 and cast1 == cast2 and cast1 in _INTEGER_TYPES:
+                        int_keys.add((b1, c1, cast1))
+                        int_keys.add((b2, c2, cast2))
+                    elif (cast1 is None and cast2 is None
+                          and _type_of(b1, c1) == _type_of(b2, c2) == 'VARCHAR'
+                          and ((b1, c1), (b2, c2)) not in dict_pairs):
+                        dict_pairs.append(((b1, c1), (b2, c2)))
+
+        # Columns joined with each other (transitively) share a dictionary
+        dict_class: Dict[Tuple[str, str], Tuple[str, str]] = {}
+
+        def _find(col: Tuple[str, str]) -> Tuple[str, str]:
+            while dict_class.setdefault(col, col) != col:
+                col = dict_class[col]
+            return col
+
+        for a, b in dict_pairs:
+            dict_class[_find(a)] = _find(b)
+        classes: Dict[Tuple[str, str], List[Tuple[str, str]]] = defaultdict(list)
+        for col in list(dict_class):
+            classes[_find(col)].append(col)
+
+        # table -> list of (select expression, join clause or None)
+        additions: Dict[str, List[Tuple[str, Optional[str]]]] = defaultdict(list)
+        # table -> encoded columns rebuilt in place
+        replaced: Dict[str, List[str]] = defaultdict(list)
+        for table, column, cast in sorted(int_keys):
+            encoded = f"{column}__{cast.lower()}"
+            self.key_encodings[(table, column, cast)] = encoded
+            if _type_of(table, encoded) is not None:
+                continue  # already encoded
+            additions[table].append(
+                (f'TRY_CAST(t."{column}" AS {cast}) AS "{encoded}"', None)
+            )
+
+        for i, members in enumerate(classes.values()):
+            existing = [(tbl, col) for tbl, col in members if _type_of(tbl, f"{col}__dict") is not None]
+            if len(existing) == len(members):
+                for table, column in members:
+                    self.key_encodings[(table, column, 'DICT')] = f"{column}__dict"
+                continue
+            for table, column in existing:
+                replaced[table].append(f"{column}__dict")
+            dictionary = self._scratch(f"__keydict_{i}")
+            values = " UNION ".join(
+                f'SELECT "{col}" AS value FROM {self.base_schema}.{tbl}'
+                for tbl, col in sorted(members)
+            )
+            self.conn.execute(f"""
+                CREATE OR REPLACE TABLE {dictionary} AS
+                SELECT value, row_number() OVER (ORDER BY value) AS id
+                FROM (SELECT DISTINCT value FROM ({values}) v WHERE value IS NOT NULL)
+            """)
+            for table, column in sorted(members):
+                encoded = f"{column}__dict"
+                d = f"d_{len(additions[table])}"
+                additions[table].append(
+                    (f'{d}.id AS "{encoded}"',
+                     f'LEFT JOIN {dictionary} {d} ON t."{column}" = {d}.value')
+                )
+                self.key_encodings[(table, column, 'DICT')] = encoded
+
+        if additions and self.base_schema != self.keys_schema:
+            self.conn.execute(f"DROP SCHEMA IF EXISTS {self.keys_schema} CASCADE")
+            self.conn.execute(f"CREATE SCHEMA {self.keys_schema}")
+            for table in sorted(set(self.table_sizes) | set(additions)):
+                self.conn.execute(f"CREATE VIEW {self.keys_schema}.{table} AS "
+                                  f"SELECT * FROM {self.base_schema}.{table}")
+            self.base_schema = self.keys_schema
+
+        for table, items in additions.items():
+            excluded = ", ".join(f'"{column}"' for column in replaced[table])
+            kept = f"t.* EXCLUDE ({excluded})" if excluded else "t.*"
+            select = ", ".join([kept] + [expr for expr, _ in items])
+            joins = " ".join(join for _, join in items if join)
+            target = f"{self.base_schema}.{table}"
+            # A view cannot be replaced by a table: build next to it
+            staged = target if table in self._key_tables else f'{self.base_schema}."{table}__encoded"'
+            self.conn.execute(f"""
+                CREATE OR REPLACE TABLE {staged} AS
+                SELECT {select} FROM {target} t {joins}
+            """)
+            if staged != target:
+                self.conn.execute(f"DROP VIEW {target}")
+                self.conn.execute(f'ALTER TABLE {staged} RENAME TO "{table}"')
+                self._key_tables.add(table)
+
+        self._reset_scratch()
+        return self.key_encodings
+
+    def _encode_join_condition(self, cond: str, graph: JoinGraph) -> str:
+        """
+        Rewrite the key equalities of a (node-normalized) join condition to
+        compare the columns added by encode_join_keys().  Conjuncts without
+        an encoding for both sides are kept as they are.
+        """
+        if not self.key_encodings:
+            return cond
+        conjuncts = _split_conjuncts(cond)
+        changed = False
+        for i, conjunct in enumerate(conjuncts):
+            equality = _parse_key_equality(conjunct)
+            if equality is None:
+                continue
+            (n1, c1, cast1), (n2, c2, cast2) = equality
+            if cast1 is None and cast2 is None:
+                kind = 'DICT'
+            elif cast1 == cast2 and cast1 in _INTEGER_TYPES:
+                kind = cast1
+            else:
+                continue
+            e1 = self.key_encodings.get((graph.node_base_table.get(n1, n1), c1, kind))
+            e2 = self.key_encodings.get((graph.node_base_table.get(n2, n2), c2, kind))
+            if e1 and e2:
+                conjuncts[i] = f"{n1}.{e1} = {n2}.{e2}"
+                changed = True
+        return " AND ".join(conjuncts) if changed else cond
+
     def remove_llm_calls(self, query: str) -> str:
         """
         Remove all Flock LLM function calls from query.
@@ -269,13 +1278,31 @@ class QueryReducer:
         # No table JOINs at this level, recurse into the subquery
         return self._extract_base_query(inner) # Returns the innermost subquery body that contains the base tables
 
-    def parse_join_graph(self, query: str) -> JoinGraph:
+    def parse_query(self, query: str) -> Optional[ParsedQuery]:
+        """Parse ``query`` with DuckDB's parser (None if it cannot be parsed)."""
+        return self.frontend.parse(query, self.conn)
+
+    def llm_call_sites(self, query: str) -> List[LlmCall]:
+        """Flock LLM function calls in ``query``, at any nesting level."""
+        parsed = self.parse_query(query)
+        return parsed.llm_calls if parsed is not None else []
+
+    def parse_join_graph(self, query: str, encode_keys: bool = True) -> JoinGraph:
         """Extract join graph from query (tables, joins, and conditions).
         
         Supports self-joins: when the same table appears multiple times
         (e.g., FROM employees e1 JOIN employees e2 ON e1.manager_id = e2.id),
         each aliased occurrence becomes a distinct node in the join graph.
+
+        The query is parsed with DuckDB's own parser (see sql_frontend); the
+        regex parser below is the fallback for queries it cannot handle.
+        With ``encode_keys`` False, join conditions keep the query's own
+        columns instead of the encode_join_keys() columns.
         """
+        parsed = self.parse_query(query)
+        if parsed is not None and parsed.tables:
+            return self._graph_from_parsed(parsed, encode_keys)
+
         graph = JoinGraph()
 
         # Strip SQL line-comments so that words inside comments
@@ -307,20 +1334,23 @@ class QueryReducer:
             alias = (raw_alias if raw_alias and raw_alias.upper() not in SQL_KEYWORDS
                      else None)
             table_refs.append((table, alias, None))
+        # JOIN type of each table_refs entry (None for the FROM table)
+        join_types: List[Optional[str]] = [None] * len(table_refs)
 
         # To find each JOIN block like: JOIN table_name [AS alias] ON <join condition>
         join_pattern = (
-            r'(?:INNER\s+)?JOIN\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?\s+ON\s+'
+            r'(?:(INNER|LEFT|RIGHT|FULL)(?:\s+OUTER)?\s+)?JOIN\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?\s+ON\s+'
             r'(.*?)'
-            r'(?=\s+(?:INNER\s+)?JOIN\b|\s+WHERE\b|\s+GROUP\b'
+            r'(?=\s+(?:(?:INNER|LEFT|RIGHT|FULL)(?:\s+OUTER)?\s+)?JOIN\b|\s+WHERE\b|\s+GROUP\b'
             r'|\s+ORDER\b|\s+HAVING\b|\s+LIMIT\b|\s*$)'
         )
         for m in re.finditer(join_pattern, flat_query, re.IGNORECASE | re.DOTALL):
-            table = m.group(1)
-            raw_alias = m.group(2)
+            table = m.group(2)
+            raw_alias = m.group(3)
             alias = (raw_alias if raw_alias and raw_alias.upper() not in SQL_KEYWORDS
                      else None)
-            table_refs.append((table, alias, m.group(3).strip()))
+            table_refs.append((table, alias, m.group(4).strip()))
+            join_types.append((m.group(1) or 'INNER').upper())
 
         # Detect self-joins (same table name appearing more than once)
         _tbl_counts: Dict[str, int] = defaultdict(int)
@@ -337,6 +1367,7 @@ class QueryReducer:
         #            a join condition  ──>  graph node identifier
         alias_map: Dict[str, str] = {}
 
+        ref_nodes: List[str] = []  # graph node of each table_refs entry
         for table, alias, _ in table_refs:
             if table in self_join_tables:
                 # Self-join: each occurrence gets its own node (named by alias)
@@ -352,12 +1383,14 @@ class QueryReducer:
                 if alias:
                     alias_map[alias] = node
             else:
+                node = table
                 graph.nodes.add(table)
                 graph.node_base_table[table] = table
                 if alias and alias != table:
                     graph.aliases[table] = alias
                     alias_map[alias] = table
                 alias_map[table] = table
+            ref_nodes.append(node)
 
         # Phase 3: parse join conditions and add edges
         def _resolve(name: str) -> Optional[str]:
@@ -368,30 +1401,118 @@ class QueryReducer:
                 return name
             return self._alias_to_table(name, graph)
 
-        for table, alias, join_cond in table_refs:
+        def _normalize(cond: str) -> str:
+            """Rewrite every ``alias.`` prefix to ``node.``."""
+            return re.sub(
+                r'\b(\w+)\.',
+                lambda m: f"{_resolve(m.group(1)) or m.group(1)}.",
+                cond,
+            )
+
+        # The regex only sees left-deep joins: the left side of a JOIN is
+        # every table before it
+        for i, join_type in enumerate(join_types):
+            if join_type in ('LEFT', 'FULL'):
+                graph.nullable.add(ref_nodes[i])
+            if join_type in ('RIGHT', 'FULL'):
+                graph.nullable.update(ref_nodes[:i])
+
+        for (table, alias, join_cond), join_type in zip(table_refs, join_types):
             if join_cond is None:
                 continue  # FROM table, no condition
+            if join_type != 'INNER':
+                graph.outer_joins += 1
+                graph.unapplied.extend(_split_conjuncts(_normalize(join_cond)))
+                continue
 
-            # Strip CAST/TRY_CAST wrappers for parsing (keep original for execution)
-            clean_cond = re.sub(r'TRY_CAST\((\w+\.\w+)\s+AS\s+\w+\)', r'\1',
-                                join_cond, flags=re.IGNORECASE)
-            clean_cond = re.sub(r'CAST\((\w+\.\w+)\s+AS\s+\w+\)', r'\1',
-                                clean_cond, flags=re.IGNORECASE)
-            cond_parts = re.findall(r'(\w+)\.(\w+)\s*=\s*(\w+)\.(\w+)', clean_cond)
-
-            for alias1, col1, alias2, col2 in cond_parts:
-                t1 = _resolve(alias1)
-                t2 = _resolve(alias2)
-                if t1 and t2:
-                    # Normalize condition to use node names instead of aliases
-                    cond_normalized = re.sub(
-                        rf'\b{re.escape(alias1)}\.', f'{t1}.', join_cond
-                    )
-                    cond_normalized = re.sub(
-                        rf'\b{re.escape(alias2)}\.', f'{t2}.', cond_normalized
-                    )
-                    graph.add_edge(t1, t2, cond_normalized)
+            conjuncts = []
+            for conjunct in _split_conjuncts(join_cond):
+                refs = []
+                for ident in re.findall(r'\b(\w+)\.\w+', conjunct):
+                    node = _resolve(ident)
+                    if node and node not in refs:
+                        refs.append(node)
+                conjuncts.append((tuple(refs), _normalize(conjunct)))
+            self._add_join_conjuncts(graph, conjuncts, encode_keys)
+
+        return graph
+
+    def _add_join_conjuncts(self, graph: JoinGraph,
+                            conjuncts: Iterable[Tuple[Tuple[str, ...], str]],
+                            encode_keys: bool = True) -> None:
+        """
+        Add the conjuncts of one JOIN's ON clause, given as (referenced
+        nodes, node-qualified SQL), to the graph.
 
+        Each conjunct is attached to the pair of nodes it references, so a
+        JOIN whose condition mentions two earlier tables yields two edges
+        with their own key pairs.
+        """
+        pairs: List[Tuple[str, str]] = []
+        local: List[Tuple[str, str]] = []  # (node, conjunct) on one node
+        for refs, conjunct in conjuncts:
+            if len(refs) == 2:
+                if encode_keys:
+                    conjunct = self._encode_join_condition(conjunct, graph)
+                graph.add_edge(refs[0], refs[1], conjunct)
+                pairs.append((refs[0], refs[1]))
+            elif len(refs) == 1:
+                local.append((refs[0], conjunct))
+
+            else:
+                graph.unapplied.append(conjunct)
+
+        # Single-table conjuncts of an ON clause (e.g. ``AND t.flag = 'Y'``)
+        # filter the join they belong to.
+        for node, conjunct in local:
+            attached = False
+            for t1, t2 in pairs:
+                if node in (t1, t2):
+                    graph.add_edge(t1, t2, conjunct)
+                    attached = True
+            if not attached:
+                graph.unapplied.append(conjunct)
+
+    def _graph_from_parsed(self, parsed: ParsedQuery, encode_keys: bool = True) -> JoinGraph:
+        """
+        Build the join graph from the SQL front-end's parse.
+
+        Besides the ON clauses of INNER joins, key equalities between two
+        tables in WHERE (implicit ``FROM a, b WHERE a.x = b.y`` joins)
+        become edges, and the single-table WHERE conjuncts are kept in
+        ``graph.local_predicates`` for _apply_local_predicates.  The ON
+        clauses of outer (and SEMI/ANTI) joins are left unapplied: a LEFT
+        JOIN keeps the left rows its condition does not match, so neither
+        side may be reduced by it.
+        """
+        graph = JoinGraph()
+        for ref in parsed.tables:
+            graph.nodes.add(ref.node)
+            graph.node_base_table[ref.node] = ref.table
+            if ref.node == ref.table and ref.alias and ref.alias != ref.table:
+                graph.aliases[ref.table] = ref.alias
+
+        for conjuncts, join_type in zip(parsed.joins, parsed.join_types):
+            if join_type == 'INNER':
+                self._add_join_conjuncts(graph, conjuncts, encode_keys)
+            else:
+                graph.outer_joins += 1
+                graph.unapplied.extend(conjunct for _, conjunct in conjuncts)
+        graph.nullable.update(parsed.nullable)
+
+        graph.local_predicates = defaultdict(list)
+        for refs, conjunct in parsed.where:
+            if len(refs) == 1 and refs[0] in graph.nullable:
+                graph.unapplied.append(conjunct)
+            elif len(refs) == 1:
+                graph.local_predicates[refs[0]].append(conjunct)
+            elif len(refs) == 2 and _parse_key_equality(conjunct) is not None:
+                if encode_keys:
+                    conjunct = self._encode_join_condition(conjunct, graph)
+                graph.add_edge(refs[0], refs[1], conjunct)
+            else:
+                graph.unapplied.append(conjunct)
+        graph.unapplied.extend(parsed.skipped)
         return graph
     
     def _alias_to_table(self, alias: str, graph: JoinGraph) -> Optional[str]:
@@ -423,12 +1544,12 @@ class QueryReducer:
         for node, base_table in graph.node_base_table.items():
             if node != base_table:
                 try:
-                    self.conn.execute(f'DROP TABLE IF EXISTS "{node}"')
                     self.conn.execute(
-                        f'CREATE TABLE "{node}" AS SELECT * FROM {base_table}'
+                        f'CREATE OR REPLACE TABLE {self._scratch(node)} AS '
+                        f'SELECT * FROM {base_table}'
                     )
                 except Exception as e:
-                    print(f"⚠ Error creating self-join copy {node} "
+                    self._print(f"⚠ Error creating self-join copy {node} "
                           f"(from {base_table}): {e}")
     
     def semi_join(self, left_table: str, right_table: str, join_condition: str):
@@ -442,13 +1563,12 @@ class QueryReducer:
             WHERE EXISTS (SELECT 1 FROM right WHERE join_condition)
         
         This REDUCES left_table to only tuples that join with right_table.
+        The reduced version is written to the scratch schema, where it
+        shadows the (untouched) base table for the rest of the analysis.
         """
         try:
-            temp_name = f"{left_table}_reduced"
-            
-            self.conn.execute(f"DROP TABLE IF EXISTS {temp_name}")
             self.conn.execute(f"""
-                CREATE TABLE {temp_name} AS
+                CREATE OR REPLACE TABLE {self._scratch(left_table)} AS
                 SELECT DISTINCT l.*
                 FROM {left_table} l
                 WHERE EXISTS (
@@ -456,141 +1576,370 @@ class QueryReducer:
                     WHERE {join_condition}
                 )
             """)
-            
-            # Replace original table with reduced version
-            self.conn.execute(f"DROP TABLE {left_table}")
-            self.conn.execute(f"ALTER TABLE {temp_name} RENAME TO {left_table}")
-            
         except Exception as e:
-            print(f"⚠ Semi-join error ({left_table} ⋉ {right_table}): {e}")
-    
-    def fold_cyclic_graph(self, graph: JoinGraph) -> JoinGraph:
+            self._print(f"⚠ Semi-join error ({left_table} ⋉ {right_table}): {e}")
+
+    def semi_join_many(self, left_table: str, right_tables: List[Tuple[str, str]]):
         """
-        Folding: Transform cyclic graph to acyclic
-        
-        If join graph has cycles (#edges >= #nodes):
-            1. Repeatedly join pairs of connected tables
-            2. Replace joined tables with their join result in the graph
-            3. Continue until graph becomes acyclic (#edges < #nodes)
-            4. Then apply Yannakakis algorithm
-        
-        Heuristic: Choose tables with highest degree (most connections)
+        Multiway semi-join: left_table ⋉ right_1 ⋉ ... ⋉ right_k in one
+        statement, for (right table, join condition) pairs.
+
+        Each right table gets its own EXISTS (with its own ``r`` alias), so
+        the left table is scanned and rewritten once instead of once per
+        right table.  The EXISTS keep the order of ``right_tables``, which
+        is the order DuckDB probes them in.  If the statement fails, the
+        semi-joins are retried one at a time so only the failing one is
+        lost.
+
+        Key-only semi-joins delete from the key table rather than rewrite
+        it, and stay one DELETE per right table: a combined DELETE (NOT
+        EXISTS ... OR NOT EXISTS ...) was measured slower.
         """
-        while graph.is_cyclic():
-            # Choose two connected tables with highest degrees
-            degrees = {t: len(graph.get_neighbors(t)) for t in graph.nodes}
-            table1 = max(degrees, key=degrees.get)
-            neighbors = graph.get_neighbors(table1)
-            
-            if not neighbors:
-                break
-                
-            table2 = max(neighbors, key=lambda t: degrees[t])
-            
-            # Join the two tables
-            join_cond = graph.get_join_condition(table1, table2)
-            if not join_cond:
-                break
-            
-            joined_name = f"{table1}_JOIN_{table2}"
-            
+        if self.key_only or len(right_tables) == 1:
+            semi_join = self.semi_join_keys if self.key_only else self.semi_join
+            for right_table, join_condition in right_tables:
+                semi_join(left_table, right_table, join_condition)
+            return
+        exists = "\n                  AND ".join(
+            f"EXISTS (SELECT 1 FROM {right_table} r WHERE {join_condition})"
+            for right_table, join_condition in right_tables)
+        try:
+            self.conn.execute(f"""
+                CREATE OR REPLACE TABLE {self._scratch(left_table)} AS
+                SELECT DISTINCT l.*
+                FROM {left_table} l
+                WHERE {exists}
+            """)
+        except duckdb.Error as e:
+            rights = ", ".join(right_table for right_table, _ in right_tables)
+            self._print(f"⚠ Multiway semi-join error ({left_table} ⋉ {rights}): {e}; "
+                        f"retrying one semi-join at a time")
+            for right_table, join_condition in right_tables:
+                self.semi_join(left_table, right_table, join_condition)
+
+    def _build_key_tables(self, graph: JoinGraph):
+        """
+        Key-only mode: project every node down to its row id plus the
+        columns referenced by its join conditions.
+
+        Each node ``T`` gets a table ``T__keys(__rid, <join-key columns>)``.
+        The key columns keep their original names, so join conditions
+        written against ``l.``/``r.`` aliases run unchanged on the key tables.
+        """
+        for node in graph.nodes:
+            key_cols = set()
+            for neighbor in graph.get_neighbors(node):
+                cond = graph.get_join_condition(node, neighbor) or ''
+                key_cols.update(re.findall(rf'\b{re.escape(node)}\.(\w+)', cond))
+            projection = ', '.join(['rowid AS __rid'] + [f'"{c}"' for c in sorted(key_cols)])
             try:
-                # Rewrite join condition to use t1/t2 aliases because the CREATE TABLE
-                # statement aliases the tables as t1 and t2, so the join condition must
-                # reference these aliases instead of the original table names.
-                # E.g. table1 = "books", table2 = "authors", join_cond = "books.author_id = authors.id"
-                # becomes "t1.author_id = t2.id"
-                fold_cond = re.sub(rf'\b{re.escape(table1)}\.', 't1.', join_cond) # tabl1.col -> t1.col
-                fold_cond = re.sub(rf'\b{re.escape(table2)}\.', 't2.', fold_cond) # table2.col -> t2.col
-                self.conn.execute(f"""
-                    CREATE TABLE {joined_name} AS
-                    SELECT * FROM {table1} t1
-                    JOIN {table2} t2 ON {fold_cond}
-                """)
-                
-                # Update graph: remove old tables, add joined table
-                graph.nodes.remove(table1)
-                graph.nodes.remove(table2)
-                graph.nodes.add(joined_name)
-                
-                # Maintain node_base_table for the merged node
-                graph.node_base_table[joined_name] = joined_name
-                graph.node_base_table.pop(table1, None)
-                graph.node_base_table.pop(table2, None)
-                
-                # Update edges: drop the edge between the two folded tables,
-                # redirect remaining edges to the joined table, and rewrite
-                # conditions so old table names point to the joined table.
-                new_edges = []
-                for t1, t2, cond in graph.edges:
-                    # Skip the edge that connected the two now-merged tables
-                    if {t1, t2} == {table1, table2}:
-                        continue
-                    # If a condition said table1.col or table2.col, rewrite it to joined_name.col
-                    cond = re.sub(rf'\b{re.escape(table1)}\.', f'{joined_name}.', cond)
-                    cond = re.sub(rf'\b{re.escape(table2)}\.', f'{joined_name}.', cond)
-                    if t1 == table1 or t1 == table2:
-                        new_edges.append((joined_name, t2, cond))
-                    elif t2 == table1 or t2 == table2:
-                        new_edges.append((t1, joined_name, cond))
-                    else:
-                        new_edges.append((t1, t2, cond))
-                graph.edges = new_edges
-                
+                self.conn.execute(
+                    f'CREATE OR REPLACE TABLE {self._scratch(node + "__keys")} AS '
+                    f'SELECT {projection} FROM "{node}"'
+                )
             except Exception as e:
-                print(f"⚠ Fold error: {e}")
-                break
-        
+                self._print(f"⚠ Error building key table for {node}: {e}")
+
+    def semi_join_keys(self, left_table: str, right_table: str, join_condition: str):
+        """
+        Key-only semi-join: left_table ⋉ right_table over the key tables.
+
+        Instead of rebuilding the left table, rows whose keys have no match
+        on the right are deleted from ``<left>__keys``.  The cost of a step
+        therefore depends on the width of the join keys, not of the rows.
+        """
+        try:
+            self.conn.execute(f"""
+                DELETE FROM "{left_table}__keys" l
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM "{right_table}__keys" r
+                    WHERE {join_condition}
+                )
+            """)
+        except Exception as e:
+            self._print(f"⚠ Semi-join error ({left_table} ⋉ {right_table}): {e}")
+
+    def _finish_key_tables(self, graph: JoinGraph, materialize: bool):
+        """
+        Key-only mode: turn the surviving row-id sets back into results.
+
+        With ``materialize`` each node is rebuilt once from its surviving
+        row ids, so callers see the same reduced tables as in the classic
+        mode.  Otherwise the base tables are left alone and only the key
+        tables are counted.
+        """
+        if not materialize:
+            return
+        for node in graph.nodes:
+            try:
+                self.conn.execute(f"""
+                    CREATE OR REPLACE TABLE {self._scratch(node)} AS
+                    SELECT * FROM "{node}"
+                    WHERE rowid IN (SELECT __rid FROM "{node}__keys")
+                """)
+                self.conn.execute(f'DROP TABLE {self._scratch(node + "__keys")}')
+            except Exception as e:
+                self._print(f"⚠ Error materializing reduced {node}: {e}")
+    
+    def decompose_cyclic_graph(self, graph: JoinGraph) -> JoinGraph:
+        """
+        Decomposition: replace the cyclic core by a tree of bags.
+
+        The nodes GYO cannot remove (JoinGraph.cyclic_core) are split into
+        bags with JoinGraph.tree_decomposition.  Each bag's join is
+        materialized once, key-only: one ``<member>__rid`` column per member
+        plus the ``<member>__<column>`` columns that edges leaving the core
+        still need.  Bags sharing members are joined on those row ids, and
+        edges from outside nodes are redirected to a bag holding their core
+        endpoints, so the resulting graph is acyclic and Yannakakis over it
+        reduces every member exactly.  Intermediate size is bounded by the
+        bag joins rather than by a chain of pairwise folds.
+
+        ``graph.folded`` maps each bag to its members for reporting.  On
+        failure the graph is returned unchanged.  Local predicates must
+        already have been applied.
+        """
+        core = graph.cyclic_core()
+        if not core:
+            return graph
+        bags = [sorted(bag) for bag in graph.tree_decomposition(core)]
+        bag_names = [f"_bag{i}" for i in range(1, len(bags) + 1)]
+
+        new_edges = []
+        outer_edges: Dict[str, List[Tuple[str, str, str]]] = defaultdict(list)
+        for t1, t2, cond in graph.edges:
+            if t1 in core and t2 in core:
+                continue  # joined inside a bag
+            if t1 in core or t2 in core:
+                outer, inner = (t2, t1) if t1 in core else (t1, t2)
+                outer_edges[outer].append((inner, outer, cond))
+            else:
+                new_edges.append((t1, t2, cond))
+
+        # Attach each outside node to a bag holding all of its core
+        # neighbours when there is one, else each edge to the first bag
+        # holding its endpoint.
+        needed: Dict[str, Set[Tuple[str, str]]] = defaultdict(set)
+        for outer, edges in sorted(outer_edges.items()):
+            inners = {inner for inner, _, _ in edges}
+            shared = [name for name, bag in zip(bag_names, bags) if inners <= set(bag)]
+            for inner, _, cond in edges:
+                bag_name = shared[0] if shared else next(
+                    name for name, bag in zip(bag_names, bags) if inner in bag)
+                columns = re.findall(rf'\b{re.escape(inner)}\.(\w+)', cond)
+                needed[bag_name].update((inner, column) for column in columns)
+                cond = re.sub(rf'\b{re.escape(inner)}\.(\w+)',
+                              lambda m, n=inner, b=bag_name: f'{b}.{n}__{m.group(1)}', cond)
+                new_edges.append((bag_name, outer, cond))
+
+        for i, (name, bag) in enumerate(zip(bag_names, bags)):
+            conds = [cond for t1, t2, cond in graph.edges if t1 in bag and t2 in bag]
+            projection = [f'{member}.rowid AS "{member}__rid"' for member in bag]
+            projection += [f'{member}."{column}" AS "{member}__{column}"'
+                           for member, column in sorted(needed[name])]
+            where = f"WHERE {' AND '.join(conds)}" if conds else ""
+            try:
+                self.conn.execute(f"""
+                    CREATE OR REPLACE TABLE {self._scratch(name)} AS
+                    SELECT {', '.join(projection)}
+                    FROM {', '.join(bag)}
+                    {where}
+                """)
+            except Exception as e:
+                self._print(f"⚠ Decomposition error ({name}): {e}")
+                return graph
+            # Bags sharing members join on the members' row ids
+            for other_name, other in zip(bag_names[:i], bags[:i]):
+                shared_members = sorted(set(bag) & set(other))
+                if shared_members:
+                    new_edges.append((other_name, name, ' AND '.join(
+                        f'{other_name}.{m}__rid = {name}.{m}__rid' for m in shared_members)))
+
+        graph.nodes -= core
+        for name, bag in zip(bag_names, bags):
+            graph.nodes.add(name)
+            graph.node_base_table[name] = name
+            graph.folded[name] = bag
+        graph.edges = new_edges
+        return graph
+
+    def _estimate_join_size(self, graph: JoinGraph, table1: str, table2: str,
+                            sizes: Dict[str, int], ndvs: Dict[Tuple[str, str], int]) -> float:
+        """
+        Estimated |table1 ⋈ table2| under the usual independence assumption:
+
+            |T1| · |T2| / Π max(ndv(T1.k), ndv(T2.k))   over the key pairs k
+
+        Non-equality conjuncts are ignored, so the estimate is an upper
+        bound for edges that carry them.  ``sizes`` and ``ndvs`` cache row
+        and distinct counts between calls.
+        """
+        for table in (table1, table2):
+            if table not in sizes:
+                sizes[table] = self.conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+
+        def _ndv(table: str, column: str) -> int:
+            if (table, column) not in ndvs:
+                ndvs[(table, column)] = self.conn.execute(
+                    f'SELECT approx_count_distinct("{column}") FROM "{table}"'
+                ).fetchone()[0]
+            return ndvs[(table, column)]
+
+        estimate = float(sizes[table1]) * sizes[table2]
+        for col1, col2 in graph.get_join_keys(table1, table2):
+            estimate /= max(_ndv(table1, col1), _ndv(table2, col2), 1)
+        return estimate
+
+    def fold_cyclic_graph(self, graph: JoinGraph) -> JoinGraph:
+        """
+        Folding: Transform cyclic graph to acyclic
+        
+        If join graph has cycles (see JoinGraph.is_cyclic):
+            1. Repeatedly join pairs of connected tables
+            2. Replace joined tables with their join result in the graph
+            3. Continue until GYO reduces the graph (it is α-acyclic)
+            4. Then apply Yannakakis algorithm
+        
+        Heuristic: among the edges inside the cyclic core, fold the pair
+        with the smallest estimated join size (see _estimate_join_size),
+        breaking ties by degree.
+
+        The folded table keeps only what the rest of the analysis needs:
+        one ``<member>__rid`` row-id column per original node it contains,
+        and the columns still referenced by other join conditions, renamed
+        to ``<member>__<column>``.  ``graph.folded`` maps every folded node
+        to its members so reductions can be reported per original table.
+        Local predicates must already have been applied.
+        """
+        sizes: Dict[str, int] = {}
+        ndvs: Dict[Tuple[str, str], int] = {}
+
+        while graph.is_cyclic():
+            core = graph.cyclic_core()
+            candidates = [(t1, t2) for t1, t2, _ in graph.edges if t1 in core and t2 in core]
+            if not candidates:
+                break
+            degrees = {t: len(graph.get_neighbors(t)) for t in graph.nodes}
+            try:
+                table1, table2 = min(candidates, key=lambda pair: (
+                    self._estimate_join_size(graph, pair[0], pair[1], sizes, ndvs),
+                    -(degrees[pair[0]] + degrees[pair[1]]), pair))
+            except Exception as e:
+                self._print(f"⚠ Fold error: {e}")
+                break
+
+            join_cond = graph.get_join_condition(table1, table2)
+            joined_name = f"{table1}_JOIN_{table2}"
+
+            # Output column for every column of the two inputs that a
+            # remaining edge still references: base columns are prefixed
+            # with their node, columns of folded inputs are already prefixed.
+            renamed: Dict[str, Dict[str, str]] = {table1: {}, table2: {}}
+            for t1, t2, cond in graph.edges:
+                if {t1, t2} == {table1, table2}:
+                    continue
+                for table in (table1, table2):
+                    for column in re.findall(rf'\b{re.escape(table)}\.(\w+)', cond):
+                        renamed[table][column] = (
+                            column if table in graph.folded else f"{table}__{column}")
+
+            projection = []
+            for table, alias in ((table1, 't1'), (table2, 't2')):
+                if table in graph.folded:
+                    projection += [f'{alias}."{m}__rid"' for m in graph.folded[table]]
+                else:
+                    projection.append(f'{alias}.rowid AS "{table}__rid"')
+                projection += [f'{alias}."{column}" AS "{name}"'
+                               for column, name in sorted(renamed[table].items())]
+
+            try:
+                # Rewrite join condition to use t1/t2 aliases because the CREATE TABLE
+                # statement aliases the tables as t1 and t2, so the join condition must
+                # reference these aliases instead of the original table names.
+                # E.g. table1 = "books", table2 = "authors", join_cond = "books.author_id = authors.id"
+                # becomes "t1.author_id = t2.id"
+                fold_cond = re.sub(rf'\b{re.escape(table1)}\.', 't1.', join_cond) # tabl1.col -> t1.col
+                fold_cond = re.sub(rf'\b{re.escape(table2)}\.', 't2.', fold_cond) # table2.col -> t2.col
+                self.conn.execute(f"""
+                    CREATE OR REPLACE TABLE {self._scratch(joined_name)} AS
+                    SELECT {', '.join(projection)}
+                    FROM {table1} t1
+                    JOIN {table2} t2 ON {fold_cond}
+                """)
+                sizes[joined_name] = self.conn.execute(
+                    f'SELECT COUNT(*) FROM "{joined_name}"').fetchone()[0]
+            except Exception as e:
+                self._print(f"⚠ Fold error: {e}")
+                break
+
+            # Update graph: remove old tables, add joined table
+            graph.nodes.remove(table1)
+            graph.nodes.remove(table2)
+            graph.nodes.add(joined_name)
+            graph.node_base_table[joined_name] = joined_name
+            graph.folded[joined_name] = (graph.folded.pop(table1, [table1]) +
+                                         graph.folded.pop(table2, [table2]))
+
+            # Update edges: drop the edge between the two folded tables,
+            # redirect remaining edges to the joined table, and rewrite
+            # table1.col / table2.col to the joined table's output columns.
+            new_edges = []
+            for t1, t2, cond in graph.edges:
+                if {t1, t2} == {table1, table2}:
+                    continue
+                for table in (table1, table2):
+                    cond = re.sub(rf'\b{re.escape(table)}\.(\w+)',
+                                  lambda m, t=table: f'{joined_name}.{renamed[t][m.group(1)]}',
+                                  cond)
+                new_edges.append((joined_name if t1 in (table1, table2) else t1,
+                                  joined_name if t2 in (table1, table2) else t2,
+                                  cond))
+            graph.edges = new_edges
+
         return graph
     
-    def yannakakis_reduction(self, graph: JoinGraph) -> Dict[str, Tuple[int, int, float]]:
+    def yannakakis_reduction(self, graph: JoinGraph,
+                             materialize: bool = True) -> Dict[str, Tuple[int, int, float]]:
         """
         Yannakakis' Semi-Join Reduction
         
         Given an acyclic join graph, reduce all tables to only tuples
         that participate in the final join result using semi-joins.
+
+        In key-only mode (``QueryReducer(key_only=True)``) the semi-joins run
+        on ``<node>__keys`` projections and the reduced tables are built once
+        at the end, or not at all when ``materialize`` is False.  Key-only
+        mode counts rows rather than DISTINCT rows, so tables holding exact
+        duplicate rows report those duplicates as surviving.
         
         Returns: Dict of {table_name: (original_size, reduced_size, reduction_pct)}
         """
         if not graph.nodes:
             return {}
+
+        if self.key_only:
+            self._build_key_tables(graph)
+            semi_join = self.semi_join_keys
+        else:
+            semi_join = self.semi_join
         
         # ================================================================
-        # STEP 0: Choose Root Node
+        # STEP 0: Build the Join Tree
         # ================================================================
-        # Select an arbitrary node as root (heuristic: highest degree)
-        # This establishes a tree structure for traversal
-        
-        degrees = {t: len(graph.get_neighbors(t)) for t in graph.nodes}
-        root = max(degrees, key=degrees.get)
-        
+        # GYO join tree, or a BFS spanning tree for a cyclic graph that
+        # reaches here unfolded (see JoinGraph.reduction_tree).
+
+        parent_of, order, is_join_tree = graph.reduction_tree()
+        join_condition = graph.tree_join_condition if is_join_tree else graph.get_join_condition
+
         # ================================================================
         # STEP 1: Bottom-Up Pass (Leaves → Root)
         # ================================================================
-        # BFS to build the traversal order AND record each node's parent in
-        # the BFS spanning tree.  Using consecutive BFS pairs as parent/child
-        # is only correct for chains; for general trees the parent pointer
-        # must be tracked explicitly.
-        
-        visited = set()
-        queue = deque([root])
-        bfs_order = []
-        # Track explicit parent relationships
-        parent_of: Dict[str, Optional[str]] = {root: None}
-        
-        while queue:
-            node = queue.popleft()
-            if node in visited:
-                continue
-            visited.add(node)
-            bfs_order.append(node)
-            
-            for neighbor in graph.get_neighbors(node):
-                if neighbor not in visited:
-                    # Record parent before enqueueing
-                    parent_of[neighbor] = node
-                    queue.append(neighbor)
-        
+        # Roots (one per connected component) have no parent and are
+        # skipped by the passes.
+
+        tree_edges = [node for node in order if parent_of[node] is not None]
+
         def _rewrite_cond(cond: str, left_table: str, right_table: str) -> str:
             """
             Replace exact table-name prefixes with the l./r. aliases that
@@ -608,12 +1957,27 @@ class QueryReducer:
             return cond
 
         # Traverse in REVERSE (bottom-up: leaves to root)
-        # For each child, reduce its PARENT: parent ⋉ child
-        for node in reversed(bfs_order[1:]): # skip root (index 0)
-            parent = parent_of[node]
-            join_cond = graph.get_join_condition(parent, node)
-            if join_cond:
-                self.semi_join(parent, node, _rewrite_cond(join_cond, parent, node))
+        # For each child, reduce its PARENT: parent ⋉ child.  In multiway
+        # mode each parent is reduced by all of its children at once, when
+        # its turn comes (every child precedes it in reverse order).
+        with self._timed('semi_join_bottom_up'):
+            if self.multiway:
+                # Children keep the order the pairwise pass applies them in
+                children: Dict[str, List[Tuple[str, str]]] = defaultdict(list)
+                for node in reversed(tree_edges):
+                    parent = parent_of[node]
+                    join_cond = join_condition(node, parent)
+                    if join_cond:
+                        children[parent].append((node, _rewrite_cond(join_cond, parent, node)))
+                for node in reversed(order):
+                    if children[node]:
+                        self.semi_join_many(node, children[node])
+            else:
+                for node in reversed(tree_edges):
+                    parent = parent_of[node]
+                    join_cond = join_condition(node, parent)
+                    if join_cond:
+                        semi_join(parent, node, _rewrite_cond(join_cond, parent, node))
         
         # ================================================================
         # STEP 2: Top-Down Pass (Root → Leaves)
@@ -621,12 +1985,16 @@ class QueryReducer:
         # Traverse in FORWARD order (top-down: root to leaves)
         # For each child, reduce the CHILD: child ⋉ parent
         
-        for node in bfs_order[1:]: # skip root
-            parent = parent_of[node]
-            join_cond = graph.get_join_condition(node, parent)
-            if join_cond:
-                self.semi_join(node, parent, _rewrite_cond(join_cond, node, parent))
+        with self._timed('semi_join_top_down'):
+            for node in tree_edges:
+                parent = parent_of[node]
+                join_cond = join_condition(node, parent)
+                if join_cond:
+                    semi_join(node, parent, _rewrite_cond(join_cond, node, parent))
         
+        if self.key_only:
+            self._finish_key_tables(graph, materialize)
+
         # ================================================================
         # STEP 3: Calculate Reduction Statistics (Definition 2.2)
         # ================================================================
@@ -636,25 +2004,619 @@ class QueryReducer:
         #   - Reduction %: ((|Ti| - |Ti'|) / |Ti|) × 100%
         
         reductions = {}
-        for table in graph.nodes:
-            # For self-join nodes the graph node name is the alias (e.g. "e1")
-            # but the original size is stored under the base table name.
-            base = graph.node_base_table.get(table, table)
-            original_size = self.table_sizes.get(base, 0)
-            try:
-                reduced_size = self.conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
-            except:
-                reduced_size = 0
-            
-            if original_size > 0:
-                reduction_pct = ((original_size - reduced_size) / original_size) * 100
+        for node in graph.nodes:
+            counted = f"{node}__keys" if self.key_only and not materialize else node
+            members = graph.folded.get(node)
+            if members:
+                # A folded node has one row per combination of member rows,
+                # so each member survives with its distinct row ids.
+                source = f'"{node}"'
+                if counted != node:
+                    source += f' WHERE rowid IN (SELECT __rid FROM "{counted}")'
+                select = ', '.join(f'COUNT(DISTINCT "{m}__rid")' for m in members)
+                try:
+                    counts = dict(zip(members, self.conn.execute(
+                        f'SELECT {select} FROM {source}').fetchone()))
+                except:
+                    counts = dict.fromkeys(members, 0)
             else:
-                reduction_pct = 0.0
-            
-            reductions[table] = (original_size, reduced_size, reduction_pct)
+                try:
+                    counts = {node: self.conn.execute(
+                        f'SELECT COUNT(*) FROM "{counted}"').fetchone()[0]}
+                except:
+                    counts = {node: 0}
+
+            for table, reduced_size in counts.items():
+                # For self-join nodes the graph node name is the alias (e.g. "e1")
+                # but the original size is stored under the base table name.
+                base = graph.node_base_table.get(table, table)
+                original_size = self.table_sizes.get(base, 0)
+
+                if original_size > 0:
+                    reduction_pct = ((original_size - reduced_size) / original_size) * 100
+                else:
+                    reduction_pct = 0.0
+
+                reductions[table] = (original_size, reduced_size, reduction_pct)
         
         return reductions
     
+    def count_join_result(self, graph: JoinGraph,
+                          key_tables: bool = False) -> Tuple[Optional[int], bool]:
+        """
+        Number of rows of the join, counted without materializing it.
+
+        Counting DP over the join tree, leaves to root: every node is
+        aggregated to the columns of its join condition towards its parent
+        plus a weight ``__w``, the number of join results of its subtree
+        per value of those columns:
+
+            w = Σ over the node's rows of  Π over children  w(matching child group)
+
+        The root's total is the join size (components that are not joined
+        multiply, as a cross product would).  Each step is one GROUP BY
+        over a table joined with its children's aggregates, so no step is
+        larger than a pairwise join of grouped tables.  Children are
+        joined on their full condition, so non-equality conjuncts are
+        counted exactly too; a condition made of key equalities plus one
+        comparison ``a.x < b.y`` (the usual "pairs" self-join) is answered
+        from running sums of the child's weights through an ASOF join
+        instead of enumerating the pairs.
+
+        With ``key_tables`` the key-only ``<node>__keys`` tables are counted
+        (the rows surviving a key-only reduction); otherwise the node tables
+        themselves, which must not have been through the DISTINCT semi-joins
+        of the classic mode, as those drop duplicate rows.
+
+        Returns (count, or None on error; whether it is exact).  It is
+        exact only when the graph is a join tree and applies every
+        condition of the query.  On a graph that is still cyclic the edges
+        outside the spanning tree are not applied, and conditions in
+        ``graph.unapplied`` are not either: the count is an upper bound.
+        Outer joins are not edges, so their sides are counted as a cross
+        product: the count is only an estimate.
+        """
+        if not graph.nodes:
+            return None, False
+        parent_of, order, is_join_tree = graph.reduction_tree()
+        join_condition = graph.tree_join_condition if is_join_tree else graph.get_join_condition
+        children: Dict[str, List[str]] = defaultdict(list)
+        for node in order:
+            if parent_of[node] is not None:
+                children[parent_of[node]].append(node)
+
+        def _columns(node: str, cond: str) -> List[str]:
+            found = re.finditer(rf'\b{re.escape(node)}\.(?:"([^"]+)"|(\w+))', cond)
+            return sorted({m.group(1) or m.group(2) for m in found})
+
+        def _range_condition(child: str, node: str, cond: str):
+            """
+            (equalities, node column, op, child column) when ``cond`` is
+            plain column equalities plus one comparison node.x op child.y.
+            """
+            equalities, comparisons = [], []
+            for conjunct in _split_conjuncts(cond):
+                equality = _parse_key_equality(conjunct)
+                if equality is not None:
+                    (a1, _, cast1), (a2, _, cast2) = equality
+                    if {a1, a2} == {child, node} and not cast1 and not cast2:
+                        equalities.append(conjunct)
+                        continue
+                match = _COMPARISON_PATTERN.match(conjunct)
+                if match is None or {match.group(1), match.group(4)} != {child, node}:
+                    return None
+                comparisons.append(match)
+            if len(comparisons) != 1:
+                return None
+            m = comparisons[0]
+            if m.group(1) == node:
+                return equalities, m.group(2), m.group(3), m.group(5)
+            return equalities, m.group(5), _FLIPPED_COMPARISON[m.group(3)], m.group(2)
+
+        def _join_child(child: str, node: str, joins: List[str],
+                        factors: List[str], filters: List[str]) -> None:
+            cond = join_condition(child, node) or "TRUE"
+            weights = self._scratch(child + "__w")
+            ranged = _range_condition(child, node, cond)
+            if ranged is None:
+                joins.append(f' JOIN {weights} AS "{child}" ON {cond}')
+                factors.append(f'"{child}".__w')
+                return
+            # Running sum of the child's weights along y within each key
+            # group; the ASOF join picks the last y below (or at) x.
+            equalities, x, op, y = ranged
+            partition = ', '.join(f'"{col}"' for col in _columns(child, ' AND '.join(equalities)))
+            over = f"PARTITION BY {partition} " if partition else ""
+            running = self._scratch(child + "__cum")
+            self.conn.execute(
+                f'CREATE OR REPLACE TABLE {running} AS SELECT *, SUM(__w) OVER '
+                f'({over}ORDER BY "{y}" ROWS UNBOUNDED PRECEDING) AS __cum '
+                f'FROM {weights} WHERE "{y}" IS NOT NULL'
+            )
+            # child.y < node.x for "node.x > child.y" and "node.x <= child.y"
+            strict = op in ('>', '<=')
+            asof = f'"{node}"."{x}" {">" if strict else ">="} "{child}"."{y}"'
+            on = ' AND '.join(equalities + [asof])
+            if op in ('>', '>='):
+                joins.append(f' ASOF JOIN {running} AS "{child}" ON {on}')
+                factors.append(f'"{child}".__cum')
+                return
+            # y above x: the key group's total minus the running sum
+            totals, alias = self._scratch(child + "__tot"), f'"{child}__t"'
+            group_by = f" GROUP BY {partition}" if partition else ""
+            self.conn.execute(
+                f'CREATE OR REPLACE TABLE {totals} AS SELECT '
+                f'{partition + ", " if partition else ""}SUM(__w) AS __w FROM {running}{group_by}'
+            )
+            on_totals = re.sub(rf'\b{re.escape(child)}\.', f'{alias}.', ' AND '.join(equalities))
+            joins.append(f' JOIN {totals} AS {alias} ON {on_totals or "TRUE"}')
+            joins.append(f' ASOF LEFT JOIN {running} AS "{child}" ON {on}')
+            factors.append(f'({alias}.__w - COALESCE("{child}".__cum, 0))')
+            filters.append(f'"{node}"."{x}" IS NOT NULL')
+
+        total = 1
+        try:
+            for node in reversed(order):
+                source = f'"{node}__keys"' if key_tables else f'"{node}"'
+                joins: List[str] = []
+                factors = ['CAST(1 AS HUGEINT)']
+                filters: List[str] = []
+                for child in children[node]:
+                    _join_child(child, node, joins, factors, filters)
+                weight = ' * '.join(factors)
+                where = f" WHERE {' AND '.join(filters)}" if filters else ""
+                parent = parent_of[node]
+                if parent is None:
+                    count = self.conn.execute(
+                        f'SELECT SUM({weight}) FROM {source} AS "{node}"{"".join(joins)}{where}'
+                    ).fetchone()[0]
+                    total *= count or 0
+                    continue
+                columns = [f'"{node}"."{col}"' for col in
+                           _columns(node, join_condition(node, parent) or '')]
+                group_by = f" GROUP BY {', '.join(columns)}" if columns else ""
+                self.conn.execute(
+                    f'CREATE OR REPLACE TABLE {self._scratch(node + "__w")} AS '
+                    f'SELECT {"".join(c + ", " for c in columns)}SUM({weight}) AS __w '
+                    f'FROM {source} AS "{node}"{"".join(joins)}{where}{group_by}'
+                )
+        except Exception as e:
+            self._print(f"⚠ Error counting the join result: {e}")
+            return None, False
+        finally:
+            for node in order:
+                for suffix in ("__w", "__cum", "__tot"):
+                    self.conn.execute(f'DROP TABLE IF EXISTS {self._scratch(node + suffix)}')
+        return int(total), is_join_tree and not graph.unapplied and not graph.outer_joins
+
+    def count_groups(self, graph: JoinGraph, group_by: List[str]) -> Tuple[Optional[int], bool]:
+        """
+        Number of groups a reduced join produces for ``group_by``, when all
+        the GROUP BY columns come from one (unfolded) node.
+
+        After a full reduction every surviving row of that node is part of
+        some join result, so the groups are its distinct GROUP BY values.
+        Must run after yannakakis_reduction().
+
+        Returns (count, or None otherwise; whether it is exact), exact
+        under the same conditions as count_join_result(): a join tree of
+        INNER joins with every condition applied.  Otherwise some of the
+        surviving rows may join nothing and the count is an upper bound.
+        """
+        nodes = {column.split('.', 1)[0] for column in group_by}
+        if len(nodes) != 1 or not all('.' in column for column in group_by):
+            return None, False
+        node = nodes.pop()
+        if node not in graph.nodes or node in graph.folded:
+            return None, False
+        source = f'"{node}"'
+        if self.key_only:
+            source += f' WHERE rowid IN (SELECT __rid FROM "{node}__keys")'
+        try:
+            count = self.conn.execute(
+                f'SELECT COUNT(*) FROM (SELECT DISTINCT {", ".join(group_by)} '
+                f'FROM (SELECT * FROM {source}) AS "{node}")'
+            ).fetchone()[0]
+        except Exception:
+            return None, False
+        _, _, is_join_tree = graph.reduction_tree()
+        return count, is_join_tree and not graph.unapplied and not graph.outer_joins
+
+    def count_distinct_contexts(self, graph: JoinGraph, expressions: List[str]) -> Optional[int]:
+        """
+        Number of distinct values of an LLM call's context ``expressions``
+        (node-qualified, see ``LlmCall.context_expressions``) over a reduced
+        join: the number of model calls the query needs when each distinct
+        context is sent once.
+
+        Must run after yannakakis_reduction().  Returns None when the
+        contexts cannot be counted, see _distinct_contexts_sql().
+        """
+        select = self._distinct_contexts_sql(graph, expressions)
+        if select is None:
+            return None
+        try:
+            return self.conn.execute(f'SELECT COUNT(*) FROM ({select})').fetchone()[0]
+        except Exception:
+            return None
+
+    def _distinct_contexts_sql(self, graph: JoinGraph, expressions: List[str]) -> Optional[str]:
+        """
+        SELECT DISTINCT of ``expressions`` (as ``__c0``, ``__c1``, ...) over
+        the reduced tables of a join tree.
+
+        After a full reduction, the join of any connected part of the join
+        tree projects onto the same rows as the whole join, so only the
+        nodes the expressions read and the tree paths between them are
+        joined.  None for a graph that is not a join tree (or has folded
+        nodes), or for expressions reading no node or nodes of different
+        components.
+        """
+        parent_of, _, is_join_tree = graph.reduction_tree()
+        if not is_join_tree or graph.folded or not expressions:
+            return None
+        nodes = {node for expr in expressions for node in self._expression_nodes(graph, expr)}
+        if not nodes:
+            return None
+
+        # Smallest subtree holding the nodes: their paths up to the lowest
+        # common ancestor
+        paths = []
+        for node in sorted(nodes):
+            path = [node]
+            while parent_of.get(path[-1]) is not None:
+                path.append(parent_of[path[-1]])
+            paths.append(path)
+        if len({path[-1] for path in paths}) != 1:
+            return None
+        common = set.intersection(*(set(path) for path in paths))
+        top = next(node for node in paths[0] if node in common)
+        subtree = sorted({node for path in paths for node in path[:path.index(top) + 1]})
+
+        sources = [f'{self._reduced_source(node)} AS "{node}"' for node in subtree]
+        conditions = [graph.tree_join_condition(node, parent_of[node])
+                      for node in subtree if node != top]
+        where = " AND ".join(f"({c})" for c in conditions if c) or "TRUE"
+        columns = ", ".join(f"{expr} AS __c{i}" for i, expr in enumerate(expressions))
+        return f'SELECT DISTINCT {columns} FROM {", ".join(sources)} WHERE {where}'
+
+    @staticmethod
+    def _expression_nodes(graph: JoinGraph, expr: str) -> Set[str]:
+        """Graph nodes a node-qualified expression reads."""
+        return {qualifier for qualifier in re.findall(r'"?(\w+)"?\."?\w+"?', expr)
+                if qualifier in graph.nodes}
+
+    def _reduced_source(self, node: str) -> str:
+        """The reduced rows of ``node`` as a subquery (key-only mode: by row id)."""
+        source = f'"{node}"'
+        if self.key_only:
+            source += f' WHERE rowid IN (SELECT __rid FROM "{node}__keys")'
+        return f"(SELECT * FROM {source})"
+
+    def estimate_payload(self, graph: JoinGraph, calls: List[LlmCall], group_by: List[str],
+                         token_model: TokenModel) -> List[CallPayload]:
+        """
+        Bytes each LLM call sends, over the join of the base tables and
+        over the join of the reduced ones (see llm_payload).
+
+        A call sees the rows of the join that feeds it, so both payloads
+        are summed over that join, one scan per state for all calls: a
+        per-row call sends its prompt once per join row, an aggregate call
+        once per ``group_by`` group of the join, or once without GROUP BY
+        (a lower bound: plan_batches() splits groups too large for one
+        request).  The reduction keeps the join as it is, so "before"
+        only differs by the rows the local predicates drop (and by
+        duplicate rows, which the classic semi-joins keep one copy of).
+        When its distinct contexts can be counted, the payload of sending
+        each of them once is given too.  The WHERE conditions the graph
+        does not apply are added to both joins; if that fails they are
+        left out and the payloads are upper bounds.  Must run after
+        yannakakis_reduction(); an empty list for a graph with folded
+        nodes.
+        """
+        if graph.folded or not calls:
+            return []
+        nodes = sorted(graph.nodes)
+        conditions = [condition for _, _, condition in graph.edges]
+        sums = "".join(f", SUM({byte_length_sql(call.context_expressions)})::BIGINT"
+                       for call in calls)
+        if group_by:
+            # row() keeps groups with NULL values, which COUNT would skip
+            sums += f", COUNT(DISTINCT row({', '.join(group_by)}))"
+        sources = {
+            "before": ", ".join(f'{self.base_schema}.{graph.node_base_table.get(node, node)} AS "{node}"'
+                                for node in nodes),
+            "after": ", ".join(f'{self._reduced_source(node)} AS "{node}"' for node in nodes),
+        }
+
+        # One scan per state: join rows, per-call byte totals and groups
+        for extra, exact in ((graph.unapplied, not graph.outer_joins), ([], False)):
+            where = " AND ".join(f"({c})" for c in conditions + extra) or "TRUE"
+            try:
+                totals = {state: self.conn.execute(
+                    f"SELECT COUNT(*){sums} FROM {source} WHERE {where}").fetchone()
+                    for state, source in sources.items()}
+            except Exception:
+                if not extra:
+                    raise
+                continue
+            break
+
+        payloads = []
+        for i, call in enumerate(calls):
+            prompt_bytes = len((call.prompt or "").encode('utf-8'))
+            per_row = call.function in PER_ROW_FUNCTIONS
+            before, after = (
+                payload_bytes(prompt_bytes,
+                              totals[state][0] if per_row else
+                              totals[state][len(calls) + 1] if group_by else 1,
+                              [totals[state][i + 1] or 0])
+                for state in ("before", "after"))
+            distinct = None
+            select = self._distinct_contexts_sql(graph, list(call.context_expressions)) if per_row else None
+            if select is not None:
+                columns = [f"__c{j}" for j in range(len(call.context_expressions))]
+                count, total = self.conn.execute(
+                    f"SELECT COUNT(*), SUM({byte_length_sql(columns)})::BIGINT FROM ({select})"
+                ).fetchone()
+                distinct = payload_bytes(prompt_bytes, count, [total or 0])
+            samples = [call.prompt] if call.prompt is not None else []
+            if token_model.sample_size and call.context_expressions:
+                text = " || ' ' || ".join(f"COALESCE(CAST({e} AS VARCHAR), '')"
+                                          for e in call.context_expressions)
+                samples += [value for (value,) in self.conn.execute(
+                    f"SELECT * FROM (SELECT {text} FROM {sources['after']} WHERE {where}) "
+                    f"USING SAMPLE reservoir({token_model.sample_size} ROWS) REPEATABLE (42)"
+                ).fetchall()]
+            payloads.append(CallPayload(call.alias or call.function, before, after, distinct,
+                                        token_model.ratio(samples), exact))
+        return payloads
+
+    def plan_batches(self, graph: JoinGraph, calls: List[LlmCall], group_by: List[str],
+                     token_model: TokenModel, context_window: int) -> List[BatchPlan]:
+        """
+        Expected API calls, tokens and round trips of the aggregate LLM
+        calls of a query (see llm_payload.batch_plan_sql).
+
+        The tuples of each group are the rows of the join of the reduced
+        tables, aggregated per ``group_by`` value (one group without
+        GROUP BY) to a count and a byte total, so the join is only built
+        inside that aggregation.  The reduction keeps the join as it is,
+        so the plan is the same one the unreduced query runs into (except
+        that the classic semi-joins keep one copy of duplicate rows, so
+        only key-only mode counts those exactly).  The WHERE conditions
+        the graph does not apply are added to the join; if that fails they
+        are left out and the plan is an upper bound.  With outer joins
+        the plan is never exact.  Must run after yannakakis_reduction();
+        an empty list for a graph with folded nodes.
+        """
+        if graph.folded:
+            return []
+        sources = ", ".join(f'{self._reduced_source(node)} AS "{node}"' for node in sorted(graph.nodes))
+        conditions = [condition for _, _, condition in graph.edges]
+        grouping = f" GROUP BY {', '.join(group_by)}" if group_by else ""
+
+        plans = []
+        for call in calls:
+            if call.function in PER_ROW_FUNCTIONS or not call.context_expressions:
+                continue
+            text = " || ' ' || ".join(f"COALESCE(CAST({e} AS VARCHAR), '')"
+                                      for e in call.context_expressions)
+            # ANDing an outer join's ON clause onto the join would drop its
+            # unmatched rows, so with outer joins the plan is never exact
+            for extra, exact in ((graph.unapplied, not graph.outer_joins), ([], False)):
+                where = " AND ".join(f"({c})" for c in conditions + extra) or "TRUE"
+                join = f"FROM {sources} WHERE {where}"
+                samples = [call.prompt or ""]
+                try:
+                    if token_model.sample_size:
+                        samples += [value for (value,) in self.conn.execute(
+                            f"SELECT * FROM (SELECT {text} {join}) "
+                            f"USING SAMPLE reservoir({token_model.sample_size} ROWS) REPEATABLE (42)"
+                        ).fetchall()]
+                    ratio = token_model.ratio(samples)
+                    prompt_tokens = len((call.prompt or "").encode('utf-8')) * ratio
+                    groups_sql = (f"SELECT COUNT(*) AS n, SUM({byte_length_sql(call.context_expressions)}) AS b "
+                                  f"{join}{grouping}")
+                    groups, tuples, total_bytes, api_calls, round_trips = self.conn.execute(batch_plan_sql(
+                        groups_sql, prompt_tokens, ratio, context_window,
+                        merge=call.function == 'llm_reduce')).fetchone()
+                except Exception:
+                    if not extra:
+                        raise
+                    continue
+                break
+            plans.append(BatchPlan(
+                call.alias or call.function, groups, tuples or 0,
+                round((total_bytes or 0) * ratio + prompt_tokens * (api_calls or 0)),
+                api_calls or 0, round_trips or 0, exact))
+        return plans
+
+    def _build_sampled_tables(self, graph: JoinGraph, predicates: Dict[str, List[str]],
+                              sampled: Dict[str, str], rate: float) -> None:
+        """
+        Create every node's input for one estimate pass in a single scan:
+        its base table, filtered by its local predicates and, for the
+        nodes in ``sampled`` (node -> key expression), restricted to the
+        rows whose key hashes below ``rate``.
+
+        All key expressions of one class go through the same hash, so a
+        key value is either kept in every table or dropped from all of
+        them and the sampled tables still join like the full ones.  Keys
+        of different types (other than integer widths, which hash alike)
+        are hashed as text.
+        """
+        types = set()
+        for node, expr in sampled.items():
+            base = graph.node_base_table.get(node, node)
+            try:
+                types.add(self.conn.execute(
+                    f'DESCRIBE SELECT {expr} FROM {base} AS "{node}"').fetchone()[1])
+            except Exception:
+                types.add(None)
+        as_text = len(types) > 1 and not types <= _INTEGER_TYPES
+        threshold = int(rate * _SAMPLE_BUCKETS)
+
+        for node in sorted(graph.nodes):
+            base = graph.node_base_table.get(node, node)
+            conditions = list(predicates.get(node, []))
+            if node in sampled:
+                key = sampled[node]
+                if as_text:
+                    key = f"CAST({key} AS VARCHAR)"
+                conditions.append(
+                    f"hash({key}, {_SAMPLE_SEED}) % {_SAMPLE_BUCKETS} < {threshold}")
+            if not conditions and base == node:
+                continue
+            where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+            try:
+                self.conn.execute(
+                    f'CREATE OR REPLACE TABLE {self._scratch(node)} AS '
+                    f'SELECT * FROM {base} AS "{node}" {where}'
+                )
+            except Exception as e:
+                self._print(f"⚠ Error sampling {node}: {e}")
+
+    def _surviving_rows(self, graph: JoinGraph, node: str) -> Dict[str, str]:
+        """
+        SELECTs of the rows of each original table that survived the
+        reduction of ``node`` (one entry, or one per member of a folded
+        node or bag), read back from the sampled tables by row id.
+        """
+        if self.key_only:
+            kept = f'rowid IN (SELECT __rid FROM "{node}__keys")'
+        else:
+            kept = None
+        members = graph.folded.get(node)
+        if not members:
+            where = f" WHERE {kept}" if kept else ""
+            return {node: f'SELECT * FROM "{node}"{where}'}
+        source = f'"{node}"' + (f" WHERE {kept}" if kept else "")
+        return {
+            m: f'SELECT * FROM "{m}" WHERE rowid IN (SELECT "{m}__rid" FROM {source})'
+            for m in members
+        }
+
+    def estimate_reduction(self, query: str, rate: float
+                           ) -> Tuple[Dict[str, Tuple[int, int, float]],
+                                      Dict[str, Tuple[int, int]]]:
+        """
+        Estimate the Yannakakis reduction from hash samples of the join keys.
+
+        A pass picks one join attribute (a class of equated key columns,
+        see JoinGraph._hypergraph), keeps the key values hashing below
+        ``rate`` in every table carrying it, and runs the usual pipeline
+        (local predicates, decomposition of cycles, semi-joins) on those
+        samples.  Every join result lives in exactly one key value of the
+        attribute, so a sampled table ends up with exactly the surviving
+        rows of its kept key values, and the Horvitz-Thompson estimate
+
+            N = Σ n_k / p,   Var(N) = (1 - p) / p² · Σ n_k²
+
+        over the survivors n_k of each kept key k is unbiased, with a 95 %
+        normal interval around it.  Tables that do not carry the attribute
+        are left whole and are estimated in a later pass over one of
+        their own attributes; passes are chosen greedily to cover the
+        most rows first.  Tables without any equi-join key are reduced
+        exactly in a final unsampled pass.
+
+        Returns ({table: (original, estimated, pct)},
+                 {table: (low, high)} bounds of the reduced size).
+        """
+        graph = self.parse_join_graph(query)
+        _, key_exprs, _ = graph._hypergraph()
+        carriers: Dict[object, Dict[str, str]] = defaultdict(dict)
+        for (node, attr), expr in key_exprs.items():
+            carriers[attr][node] = expr
+
+        def _size(node: str) -> int:
+            return self.table_sizes.get(graph.node_base_table.get(node, node), 0)
+
+        # Greedy cover of the nodes by join attributes; a pass over None
+        # is exact.  Isolated nodes are never affected by sampling.
+        uncovered = {n for n in graph.nodes if graph.get_neighbors(n)}
+        passes: List[Optional[object]] = []
+        while uncovered:
+            weights = {attr: sum(_size(n) for n in nodes if n in uncovered)
+                       for attr, nodes in carriers.items()}
+            weights = {attr: w for attr, w in weights.items() if w > 0}
+            if not weights:
+                passes.append(None)
+                break
+            attr = max(weights, key=lambda a: (weights[a], sorted(carriers[a])))
+            passes.append(attr)
+            uncovered -= set(carriers[attr])
+        if not passes:
+            passes.append(None)
+
+        # table -> (sampled survivors, N, Var, upper bound)
+        estimates: Dict[str, Tuple[int, float, float, float]] = {}
+        predicates = self._local_predicates(self._extract_base_query(query), graph)
+        for attr in passes:
+            self._reset_scratch()
+            pass_graph = self.parse_join_graph(query)
+            sampled = carriers[attr] if attr is not None else {}
+            self._build_sampled_tables(pass_graph, predicates, sampled, rate)
+            # Largest key group of each sample before reduction, to bound
+            # tables that keep (almost) no sampled key
+            largest: Dict[str, int] = {}
+            for node, key in sampled.items():
+                try:
+                    largest[node] = self.conn.execute(
+                        f'SELECT COALESCE(MAX(n), 0) FROM (SELECT COUNT(*) AS n '
+                        f'FROM "{node}" GROUP BY {key})').fetchone()[0]
+                except Exception:
+                    largest[node] = _size(node)
+            if pass_graph.is_cyclic():
+                pass_graph = self.decompose_cyclic_graph(pass_graph)
+                if pass_graph.is_cyclic():
+                    pass_graph = self.fold_cyclic_graph(pass_graph)
+            self.yannakakis_reduction(pass_graph, materialize=False)
+
+            for node in pass_graph.nodes:
+                for table, rows in self._surviving_rows(pass_graph, node).items():
+                    if table in estimates:
+                        continue
+                    if table in sampled:
+                        sql = (f'SELECT SUM(n), SUM(n * n), COUNT(*), MAX(n) FROM ('
+                               f'SELECT COUNT(*) AS n FROM ({rows}) AS "{table}" '
+                               f'GROUP BY {sampled[table]})')
+                    elif attr is None or not graph.get_neighbors(table):
+                        sql = f'SELECT COUNT(*), 0, 0, 0 FROM ({rows})'
+                    else:
+                        continue
+                    try:
+                        total, squares, keys, group = self.conn.execute(sql).fetchone()
+                    except Exception as e:
+                        self._print(f"⚠ Error counting sample of {table}: {e}")
+                        total, squares, keys, group = 0, 0, 0, 0
+                    total, squares, group = total or 0, squares or 0, group or 0
+                    if table not in sampled:
+                        estimates[table] = (total, float(total), 0.0, float(total))
+                        continue
+                    estimate = total / rate
+                    variance = (1 - rate) / rate ** 2 * squares
+                    upper = estimate + 1.96 * variance ** 0.5
+                    if keys < _SAMPLE_MIN_KEYS and rate < 1:
+                        # Too few key groups for the normal interval: bound
+                        # the surviving keys and take the largest group seen
+                        upper = max(upper, _poisson_upper(keys) / rate
+                                    * max(group, largest.get(table, 0)))
+                    estimates[table] = (total, estimate, variance, upper)
+
+        reductions: Dict[str, Tuple[int, int, float]] = {}
+        intervals: Dict[str, Tuple[int, int]] = {}
+        for table, (observed, estimate, variance, upper) in estimates.items():
+            original_size = _size(table)
+            reduced = min(int(round(estimate)), original_size)
+            # The surviving sampled rows are a hard lower bound
+            low = max(int(estimate - 1.96 * variance ** 0.5), observed)
+            intervals[table] = (min(low, reduced), min(int(upper + 0.5), original_size))
+            reduction_pct = ((original_size - reduced) / original_size * 100
+                             if original_size > 0 else 0.0)
+            reductions[table] = (original_size, reduced, reduction_pct)
+        return reductions, intervals
+
     def compute_having_aware_reduction(self, query: str) -> Optional[Dict[str, Tuple[int, int, float]]]:
         """
         Handle queries with GROUP BY/HAVING by computing actual tuple participation.
@@ -675,27 +2637,36 @@ class QueryReducer:
             (original_size, reduced_size, reduction_pct) tuples, or None if 
             query does not match the expected GROUP BY/HAVING pattern.
         """
-        # Match HAVING count(*) >= N or HAVING count(DISTINCT col) >= N 
-        having_match = re.search(
-            r'HAVING\s+count\s*\(\s*(?:DISTINCT\s+[\w.]+|\*)\s*\)\s*>=\s*(\d+)',
-            query, re.IGNORECASE
-        )
-        
-        if not having_match:
-            return None # No HAVING clause, use standard method
-        
-        min_count = int(having_match.group(1)) # The N in "HAVING count(*) >= N"
-        
-        # Find GROUP BY clause
-        group_match = re.search(
-            r'GROUP\s+BY\s+(.*?)(?=\s+HAVING\b)',
-            query, re.IGNORECASE | re.DOTALL
-        )
-        
-        if not group_match:
-            return None
-        
-        group_cols = group_match.group(1).strip() # E.g. "c.id"
+        parsed = self.parse_query(query)
+        if parsed is not None:
+            # HAVING count(...) >= N and GROUP BY from DuckDB's parse; the
+            # group columns are qualified with graph-node names.
+            if parsed.having_min_count is None or not parsed.group_by:
+                return None
+            min_count = parsed.having_min_count
+            group_cols = ', '.join(parsed.group_by)
+        else:
+            # Match HAVING count(*) >= N or HAVING count(DISTINCT col) >= N 
+            having_match = re.search(
+                r'HAVING\s+count\s*\(\s*(?:DISTINCT\s+[\w.]+|\*)\s*\)\s*>=\s*(\d+)',
+                query, re.IGNORECASE
+            )
+            
+            if not having_match:
+                return None # No HAVING clause, use standard method
+            
+            min_count = int(having_match.group(1)) # The N in "HAVING count(*) >= N"
+            
+            # Find GROUP BY clause
+            group_match = re.search(
+                r'GROUP\s+BY\s+(.*?)(?=\s+HAVING\b)',
+                query, re.IGNORECASE | re.DOTALL
+            )
+            
+            if not group_match:
+                return None
+            
+            group_cols = group_match.group(1).strip() # E.g. "c.id"
         
         # Find the FROM ... JOIN ... ON pattern
         join_match = re.search(
@@ -717,11 +2688,15 @@ class QueryReducer:
         cond_col2 = join_match.group(8)
         
         # Determine parent (grouped) vs child table
-        # The table whose alias appears in GROUP BY is the parent
-        if f"{from_alias}." in group_cols or group_cols.startswith(from_alias):
+        # The table whose alias (or node name) appears in GROUP BY is the parent
+        def _grouped(table: str, alias: str) -> bool:
+            return (f"{alias}." in group_cols or group_cols.startswith(alias)
+                    or re.search(rf'\b{re.escape(table)}\.', group_cols) is not None)
+
+        if _grouped(from_table, from_alias):
             parent_table, parent_alias = from_table, from_alias
             child_table, child_alias = join_table, join_alias
-        elif f"{join_alias}." in group_cols or group_cols.startswith(join_alias):
+        elif _grouped(join_table, join_alias):
             parent_table, parent_alias = join_table, join_alias
             child_table, child_alias = from_table, from_alias
         else:
@@ -751,7 +2726,7 @@ class QueryReducer:
                 ) t
             """).fetchone()[0]
         except Exception as e:
-            print(f"⚠ Error computing parent reduction: {e}")
+            self._print(f"⚠ Error computing parent reduction: {e}")
             parent_reduced = parent_original
         
         if parent_original > 0:
@@ -775,7 +2750,7 @@ class QueryReducer:
                 )
             """).fetchone()[0]
         except Exception as e:
-            print(f"⚠ Error computing child reduction: {e}")
+            self._print(f"⚠ Error computing child reduction: {e}")
             child_reduced = child_original
         
         if child_original > 0:
@@ -802,7 +2777,38 @@ class QueryReducer:
 
         Without this step, every table in a densely-connected schema shows
         0 % reduction because almost every row joins with something.
+
+        The predicates come from the SQL front-end when the graph was built
+        from DuckDB's parse (``graph.local_predicates``), else from the
+        regex split of ``base_query``'s WHERE clause.
+        """
+        for table, local_conditions in self._local_predicates(base_query, graph).items():
+            if table not in graph.nodes or not local_conditions:
+                continue
+            combined_predicate = ' AND '.join(local_conditions)
+            try:
+                self.conn.execute(
+                    f"CREATE OR REPLACE TABLE {self._scratch(table)} AS "
+                    f"SELECT * FROM {table} WHERE {combined_predicate}"
+                )
+            except Exception as e:
+                self._print(f"  Could not apply local predicate to {table}: {e}")
+
+    def _local_predicates(self, base_query: str, graph: 'JoinGraph') -> Dict[str, List[str]]:
+        """Single-table WHERE conditions per node (see _apply_local_predicates)."""
+        if graph.local_predicates is not None:
+            return graph.local_predicates
+        return {table: conditions
+                for table, conditions in self._split_local_predicates(base_query, graph).items()
+                if table not in graph.nullable}
+
+    def _split_local_predicates(self, base_query: str, graph: 'JoinGraph') -> Dict[str, List[str]]:
         """
+        Regex fallback for _apply_local_predicates: single-table conditions
+        of ``base_query``'s WHERE clause per node, rewritten to ``node.col``.
+        """
+        predicates: Dict[str, List[str]] = {}
+
         # Build alias -> table mapping from graph.aliases (which stores table->alias)
         alias_to_table = {alias: table for table, alias in graph.aliases.items()}
         # Tables with no alias use their own name, add them too
@@ -816,7 +2822,7 @@ class QueryReducer:
             base_query, re.IGNORECASE | re.DOTALL
         )
         if not where_match:
-            return
+            return predicates
         where_body = where_match.group(1).strip()
 
         # Split WHERE clause into individual AND conditions
@@ -846,20 +2852,9 @@ class QueryReducer:
                     if not has_other:
                         local_conditions.append(cond)
             
-            if not local_conditions:
-                continue
-                
-            # Combine conditions and rewrite alias.col -> table.col
-            combined_predicate = ' AND '.join(local_conditions)
-            predicate = re.sub(alias_pat, f'{table}.', combined_predicate, flags=re.IGNORECASE)
-            try:
-                temp = f"{table}_filtered"
-                self.conn.execute(f"DROP TABLE IF EXISTS {temp}")
-                self.conn.execute(f"CREATE TABLE {temp} AS SELECT * FROM {table} WHERE {predicate}")
-                self.conn.execute(f"DROP TABLE {table}")
-                self.conn.execute(f"ALTER TABLE {temp} RENAME TO {table}")
-            except Exception as e:
-                print(f"  Could not apply local predicate to {table}: {e}")
+            # Rewrite alias.col -> table.col
+            predicates[table] = [re.sub(alias_pat, f'{table}.', cond, flags=re.IGNORECASE)
+                                 for cond in local_conditions]
 
         # Process tables with no alias (referenced directly as tablename.col)
         for table in graph.nodes:
@@ -882,171 +2877,712 @@ class QueryReducer:
                     if not has_other:
                         local_conditions.append(cond)
             
-            if not local_conditions:
-                continue
-                
-            # Combine conditions (already use table.col notation)
-            combined_predicate = ' AND '.join(local_conditions)
-            try:
-                temp = f"{table}_filtered"
-                self.conn.execute(f"DROP TABLE IF EXISTS {temp}")
-                self.conn.execute(f"CREATE TABLE {temp} AS SELECT * FROM {table} WHERE {combined_predicate}")
-                self.conn.execute(f"DROP TABLE {table}")
-                self.conn.execute(f"ALTER TABLE {temp} RENAME TO {table}")
-            except Exception as e:
-                print(f"  Could not apply local predicate to {table}: {e}")
+            # Conditions already use table.col notation
+            predicates[table] = local_conditions
 
-    def _snapshot_tables(self) -> None:
+        return predicates
+
+    def reduction_ctes(self, query: str, graph: JoinGraph
+                       ) -> Tuple[List[Tuple[str, str]], Dict[str, str]]:
         """
-        Create backup copies of every base table so we can restore them
-        after each query analysis (preventing inter-query state pollution).
-        Each backup is stored as  <table>__snapshot  in the same connection.
+        The semi-join program of yannakakis_reduction() written as CTEs.
+
+        Every node starts from its base table filtered by its local WHERE
+        predicates; each semi-join of the bottom-up and top-down passes is
+        then one more CTE over the previous version of its node, using
+        ``WHERE EXISTS`` so duplicate rows are kept (the classic pass's
+        ``SELECT DISTINCT`` would change the query's result).  ``graph``
+        must be unfolded and keep the query's own join columns (see
+        ``parse_join_graph(encode_keys=False)``).
+
+        Returns (cte name, SELECT) steps in dependency order and the name
+        of each node's final CTE; nodes the program does not reduce (no
+        predicates, no join) have none.
         """
-        for table in list(self.table_sizes.keys()):
-            snap = f"{table}__snapshot"
-            self.conn.execute(f"DROP TABLE IF EXISTS {snap}")
-            self.conn.execute(f"CREATE TABLE {snap} AS SELECT * FROM {table}")
+        predicates = self._local_predicates(self._extract_base_query(query), graph)
+        steps: List[Tuple[str, str]] = []
+        current: Dict[str, str] = {}
+        versions: Dict[str, int] = defaultdict(int)
+
+        def _source(node: str) -> str:
+            return current[node] if current[node] == node else f"{current[node]} AS {node}"
+
+        def _add(node: str, select: str) -> None:
+            name = f"{node}__{versions[node]}"
+            versions[node] += 1
+            steps.append((name, select))
+            current[node] = name
+
+        for node in sorted(graph.nodes):
+            current[node] = graph.node_base_table.get(node, node)
+            conditions = predicates.get(node) or []
+            if conditions:
+                _add(node, f"SELECT * FROM {_source(node)} WHERE {' AND '.join(conditions)}")
+
+        parent_of, order, is_join_tree = graph.reduction_tree()
+        join_condition = graph.tree_join_condition if is_join_tree else graph.get_join_condition
+        tree_edges = [node for node in order if parent_of[node] is not None]
+
+        def _semi_join(left: str, rights: List[Tuple[str, str]]) -> None:
+            exists = " AND ".join(f"EXISTS (SELECT 1 FROM {_source(right)} WHERE {cond})"
+                                  for right, cond in rights)
+            _add(left, f"SELECT * FROM {_source(left)} WHERE {exists}")
+
+        if self.multiway:
+            # One CTE per parent for all of its children, as in yannakakis_reduction()
+            children: Dict[str, List[Tuple[str, str]]] = defaultdict(list)
+            for node in reversed(tree_edges):
+                cond = join_condition(node, parent_of[node])
+                if cond:
+                    children[parent_of[node]].append((node, cond))
+            for node in reversed(order):
+                if children[node]:
+                    _semi_join(node, children[node])
+        else:
+            for node in reversed(tree_edges):
+                cond = join_condition(node, parent_of[node])
+                if cond:
+                    _semi_join(parent_of[node], [(node, cond)])
+        for node in tree_edges:
+            cond = join_condition(node, parent_of[node])
+            if cond:
+                _semi_join(node, [(parent_of[node], cond)])
+
+        # The last version of each node is the reduced table
+        final = {node: f"{node}__reduced" for node in versions}
+        renames = {f"{node}__{versions[node] - 1}": name for node, name in final.items()}
+        pattern = re.compile(r'\b(' + '|'.join(map(re.escape, renames)) + r')\b') if renames else None
+        if pattern is not None:
+            steps = [(renames.get(name, name), pattern.sub(lambda m: renames[m.group(1)], select))
+                     for name, select in steps]
+        return steps, final
 
-    def _restore_tables(self) -> None:
+    def rewrite_reduced_query(self, query: str, graph: JoinGraph) -> Tuple[Optional[str], List[str]]:
         """
-        Restore every base table from its snapshot and drop any extra tables
-        created during analysis (folded join tables, temp reduced tables, …).
+        Rewrite ``query`` (LLM calls intact) to read every base table it
+        joins from that table's reduced CTE (see reduction_ctes()).
+
+        ``FROM``/``JOIN`` references are replaced in the query's own text,
+        so formatting, comments and the Flock calls are kept; an alias is
+        added where there was none so ``table.col`` references still
+        resolve.  A table is only replaced when its references map one to
+        one onto the graph's nodes (a table also read by a subquery, for
+        instance, keeps its base table).
+
+        The reduced tables only drop rows that cannot reach the result as
+        long as every edge of ``graph`` is a filter of the result: the ON
+        clause of an outer join is not (a LEFT JOIN keeps the left rows it
+        does not match), so such joins must not be edges (see
+        _graph_from_parsed).  A query with more outer joins than the graph
+        knows of, e.g. one the regex parser did not recognise, is not
+        rewritten.
+
+        Returns (rewritten query or None if nothing is reduced, replaced
+        nodes).
         """
-        base_tables = set(self.table_sizes.keys())
-        # Find all tables currently in the connection
-        all_tables = {
-            row[0]
-            for row in self.conn.execute(
-                "SELECT table_name FROM information_schema.tables "
-                "WHERE table_schema = 'main'"
-            ).fetchall()
-        }
-        # Drop anything that isn't a base table or its snapshot
-        for tbl in all_tables:
-            if tbl not in base_tables and not tbl.endswith("__snapshot"):
-                try:
-                    self.conn.execute(f"DROP TABLE IF EXISTS {tbl}")
-                except Exception:
-                    pass
-        # Restore base tables from snapshots
-        for table in base_tables:
-            snap = f"{table}__snapshot"
-            self.conn.execute(f"DROP TABLE IF EXISTS {table}")
-            self.conn.execute(f"CREATE TABLE {table} AS SELECT * FROM {snap}")
+        # A CTE of the query taken for a table cannot be read from ahead
+        # of its definition
+        ctes = {name.lower() for name in _CTE_NAME_PATTERN.findall(query)}
+        if any(graph.node_base_table.get(node, node).lower() in ctes for node in graph.nodes):
+            return None, []
+        outer_joins = sum(1 for m in _OUTER_JOIN_PATTERN.finditer(query) if m.group(2))
+        if outer_joins > graph.outer_joins:
+            return None, []
+        steps, final = self.reduction_ctes(query, graph)
+        if not final:
+            return None, []
+
+        nodes_of: Dict[str, List[str]] = defaultdict(list)
+        for node in graph.nodes:
+            nodes_of[graph.node_base_table.get(node, node).lower()].append(node)
+
+        refs = [m for m in _TABLE_REF_PATTERN.finditer(query)
+                if m.group(3) and m.group(3).lower() in nodes_of]
+        occurrences: Dict[str, int] = defaultdict(int)
+        for m in refs:
+            occurrences[m.group(3).lower()] += 1
+
+        edits: List[Tuple[int, int, str]] = []
+        replaced: List[str] = []
+        for m in refs:
+            table = m.group(3).lower()
+            alias = m.group(4)
+            candidates = nodes_of[table]
+            if occurrences[table] != len(candidates):
+                continue
+            if len(candidates) == 1:
+                node = candidates[0]
+            elif alias in candidates:
+                node = alias
+            else:
+                continue
+            if node not in final:
+                continue
+            text = final[node] if alias else f"{final[node]} AS {m.group(3)}"
+            edits.append((m.start(3), m.end(3), text))
+            replaced.append(node)
+        if not edits:
+            return None, []
+
+        rewritten = query
+        for start, end, text in reversed(edits):
+            rewritten = rewritten[:start] + text + rewritten[end:]
+
+        # Only the CTEs the replaced tables depend on are emitted
+        needed: Set[str] = {final[node] for node in replaced}
+        for name, select in reversed(steps):
+            if name in needed:
+                needed.update(re.findall(r'\b(\w+__(?:\d+|reduced))\b', select))
+        program = ",\n".join(f"{name} AS MATERIALIZED (\n  {select}\n)"
+                          for name, select in steps if name in needed)
+
+        rewritten = prepend_ctes(rewritten, program)
+        if rewritten is None:
+            return None, []
+        return rewritten, sorted(replaced)
+
+    def write_reduced_query(self, query_file: str, rewritten: str,
+                            subdir: str = "reduced", header: Optional[str] = None) -> Path:
+        """Write a rewritten query to ``<subdir>/<name>`` next to ``query_file``."""
+        query_path = Path(query_file)
+        target = query_path.parent / subdir / query_path.name
+        target.parent.mkdir(parents=True, exist_ok=True)
+        if header is None:
+            header = f"-- Semi-join reduced form of ../{query_path.name}, written by reduction_analyzer.py\n"
+        target.write_text(header + rewritten.strip() + "\n")
+        return target
+
+    def verify_reduced_query(self, baseline_query: str, reduced_query: str) -> Tuple[int, int, int]:
+        """
+        Run the (LLM-free) baseline query and its reduced rewrite and
+        compare their results as multisets of rows.
+
+        Resets the scratch schema first, so both run on the base tables.
+        Returns (baseline rows, reduced rows, rows found in only one).
+        """
+        self._reset_scratch()
+        baseline, reduced = self._scratch("__baseline"), self._scratch("__reduced")
+        for table, query in ((baseline, baseline_query), (reduced, reduced_query)):
+            self.conn.execute(f"CREATE TABLE {table} AS\n{query.strip().rstrip(';')}\n")
+        try:
+            return self.conn.execute(f"""
+                SELECT (SELECT COUNT(*) FROM {baseline}),
+                       (SELECT COUNT(*) FROM {reduced}),
+                       (SELECT COUNT(*) FROM (SELECT * FROM {baseline} EXCEPT ALL SELECT * FROM {reduced}))
+                     + (SELECT COUNT(*) FROM (SELECT * FROM {reduced} EXCEPT ALL SELECT * FROM {baseline}))
+            """).fetchone()
+        finally:
+            self._reset_scratch()
 
-    def analyze_query(self, query_file: str, show_queries: bool = True):
+    def analyze_query(self, query_file: str, show_queries: bool = True) -> ReductionReport:
         """
         Pipeline:
         1. Remove LLM function calls from query
         2. Parse join graph from query
-        3. If cyclic, fold until acyclic (Algorithm 3)
+        3. If cyclic, decompose into a tree of bags (folding as fallback)
         4. Apply Yannakakis reduction (Algorithm 2)
         5. Report reduction statistics
+        6. Optionally write (and verify) the query rewritten over its
+           reduced tables, and its memoized and deduplicated forms
 
-        Tables are snapshotted before analysis and fully restored afterwards
-        so that running multiple queries in sequence produces the same results
+        Base tables are never modified: every reduced or filtered table is
+        written to the scratch schema, which is reset before each query so
+        that running multiple queries in sequence produces the same results
         as running each query individually.
+
+        The seconds spent in each phase are left in ``self.timings``
+        (strip_llm, parse, local_predicates, fold, semi_join_bottom_up,
+        semi_join_top_down, counting, report, ...; see benchmark.py).
+
+        Returns the results as a ReductionReport; the text report is only
+        formatted and printed when ``self.text`` is set.
         """
-        # Restore tables to their original state before every query
-        self._restore_tables()
+        # Discard the previous query's work tables
+        if self.profiler is not None:
+            self.profiler.reset()
+        self._reset_scratch()
+        self.timings = {}
 
         query_path = Path(query_file)
+        report = ReductionReport(query_path.name)
+        report.timings = self.timings
+        self._warnings = report.warnings
         
-        print("=" * 70)
-        print(f"Query: {query_path.name}")
-        print("=" * 70)
-        print()
+        self._print("=" * 70)
+        self._print(f"Query: {query_path.name}")
+        self._print("=" * 70)
+        self._print()
         
         with open(query_file, 'r') as f:
             original_query = f.read()
         
-        if show_queries:
-            print("ORIGINAL QUERY (with LLM functions):")
-            print("-" * 70)
-            print(original_query.strip())
-            print()
+        if show_queries and self.text:
+            self._print("ORIGINAL QUERY (with LLM functions):")
+            self._print("-" * 70)
+            self._print(original_query.strip())
+            self._print()
         
         # Step 1: Remove LLM calls to get baseline SQL
-        baseline_query = self.remove_llm_calls(original_query)
-        
-        if show_queries:
-            print("BASELINE QUERY (LLM functions removed):")
-            print("-" * 70)
-            print(baseline_query.strip())
-            print()
-        
+        with self._timed('strip_llm'):
+            baseline_query = self.remove_llm_calls(original_query)
+        
+        if show_queries and self.text:
+            self._print("BASELINE QUERY (LLM functions removed):")
+            self._print("-" * 70)
+            self._print(baseline_query.strip())
+            self._print()
+        
+        # LLM calls the removal above did not recognise (e.g. nested in an
+        # expression) would still be sent to the model by the baseline
+        leftover = sorted({call.function for call in self.llm_call_sites(baseline_query)})
+        if leftover:
+            self._print(f"⚠ Note: could not remove {', '.join(leftover)} from the baseline query.")
+            self._print()
+
         # LIMIT: the LLM only processes at most N rows regardless of table sizes
         limit_match = re.search(r'\bLIMIT\s+(\d+)\b', baseline_query, re.IGNORECASE)
         if limit_match:
             limit_n = int(limit_match.group(1))
-            print(f"⚠ Note: Query contains LIMIT {limit_n:,}.")
-            print(f"   The LLM function will process at most {limit_n:,} result rows,")
-            print(f"   regardless of the table-level reduction percentages shown below.")
-            print()
+            self._print(f"⚠ Note: Query contains LIMIT {limit_n:,}.")
+            self._print(f"   The LLM function will process at most {limit_n:,} result rows,")
+            self._print(f"   regardless of the table-level reduction percentages shown below.")
+            self._print()
 
         # CROSS JOIN: Cartesian products can't be reduced by semi-joins
         if re.search(r'\bCROSS\s+JOIN\b', baseline_query, re.IGNORECASE):
-            print("⚠ Note: Query contains a CROSS JOIN.")
-            print("   Yannakakis semi-join reduction does not apply to Cartesian products.")
-            print("   Tuple counts shown below are the *full* table sizes (0 % reduction).")
-            print()
+            self._print("⚠ Note: Query contains a CROSS JOIN.")
+            self._print("   Yannakakis semi-join reduction does not apply to Cartesian products.")
+            self._print("   Tuple counts shown below are the *full* table sizes (0 % reduction).")
+            self._print()
 
         # Step 2: Parse join graph from baseline query
-        graph = self.parse_join_graph(baseline_query)
+        with self._timed('parse'):
+            graph = self.parse_join_graph(baseline_query)
         
         if not graph.nodes:
-            print("No tables found in query")
-            return
-        
+            self._print("No tables found in query")
+            report.warnings.append("No tables found in query")
+            return report
+        
+        unapplied = list(graph.unapplied)
+        report.graph_nodes = len(graph.nodes)
+        report.graph_edges = len(graph.edges)
+        report.cyclic = graph.is_cyclic()
+        report.unapplied_conditions = len(unapplied)
+        report.outer_joins = graph.outer_joins
+
         # Prepare self-join table copies (if any)
-        self._prepare_self_join_tables(graph)
-        
-        # Step 3: Handle cyclic graphs by folding
+        with self._timed('parse'):
+            self._prepare_self_join_tables(graph)
+        
+        # Step 3: Handle cyclic graphs by decomposition (folding as fallback)
+        # Local predicates go first: bags and folded tables only keep row
+        # ids and join columns, so predicates cannot be applied afterwards.
+        predicates_applied = False
+        estimating = self.sample_rate is not None
         if graph.is_cyclic():
-            print(f"Join graph is CYCLIC ({len(graph.edges)} edges, {len(graph.nodes)} nodes)")
-            print("   Applying folding algorithm...")
-            graph = self.fold_cyclic_graph(graph)
-            print(f"   ✅ Transformed to acyclic graph")
-            print()
+            self._print(f"Join graph is CYCLIC ({len(graph.edges)} edges, {len(graph.nodes)} nodes)")
+            with self._timed('local_predicates'):
+                self._apply_local_predicates(self._extract_base_query(baseline_query), graph)
+            predicates_applied = True
+        if graph.is_cyclic() and not estimating:
+            with self._timed('fold'):
+                bags = graph.tree_decomposition(graph.cyclic_core())
+                self._print(f"   Applying tree decomposition "
+                            f"({len(bags)} bags, width {max(len(b) for b in bags) - 1})...")
+                graph = self.decompose_cyclic_graph(graph)
+                if graph.is_cyclic():
+                    self._print("   Applying folding algorithm...")
+                    graph = self.fold_cyclic_graph(graph)
+            self._print(f"   ✅ Transformed to acyclic graph")
+            self._print()
+        elif graph.is_cyclic():
+            self._print("   Tree decomposition runs on each sample")
+            self._print()
         
         # Step 4: Try HAVING-aware reduction first, then fall back to Yannakakis
-        reductions = self.compute_having_aware_reduction(baseline_query)
+        with self._timed('having'):
+            reductions = self.compute_having_aware_reduction(baseline_query)
+        intervals = None
+        join_count: Tuple[Optional[int], bool] = (None, False)
+        groups: Tuple[Optional[int], bool] = (None, False)
+        # (per-row LLM call, distinct contexts reaching it)
+        contexts: List[Tuple[LlmCall, int]] = []
+        payloads: List[CallPayload] = []
+        batch_plans: List[BatchPlan] = []
         
         if reductions:
-            print("Detected GROUP BY/HAVING pattern - using execution-based analysis")
-            print()
+            report.mode = 'having'
+            self._print("Detected GROUP BY/HAVING pattern - using execution-based analysis")
+            self._print()
+        elif estimating:
+            report.mode = 'estimate'
+            # Sampled Yannakakis, one pass per join attribute it samples on
+            with self._timed('estimate'):
+                reductions, intervals = self.estimate_reduction(baseline_query, self.sample_rate)
+            self._print(f"Estimated from a {self.sample_rate:.2%} hash sample of the join keys "
+                        f"(95% confidence intervals)")
+            self._print()
         else:
+            report.mode = 'semi-join'
             # Apply local WHERE predicates first (selection pushdown)
-            base_query_for_preds = self._extract_base_query(baseline_query)
-            self._apply_local_predicates(base_query_for_preds, graph)
+            if not predicates_applied:
+                with self._timed('local_predicates'):
+                    base_query_for_preds = self._extract_base_query(baseline_query)
+                    self._apply_local_predicates(base_query_for_preds, graph)
+            # The classic semi-joins keep DISTINCT rows, so the join result
+            # is counted before them; key-only mode counts its key tables.
+            if not self.key_only:
+                with self._timed('counting'):
+                    join_count = self.count_join_result(graph)
             # Standard Yannakakis semi-join reduction
-            reductions = self.yannakakis_reduction(graph)
+            # Only the counts are reported, so key-only mode can skip
+            # rebuilding the reduced tables.
+            reductions = self.yannakakis_reduction(graph, materialize=False)
+            with self._timed('counting'):
+                if self.key_only:
+                    join_count = self.count_join_result(graph, key_tables=True)
+                parsed = self.parse_query(baseline_query)
+                group_by = parsed.group_by if parsed is not None else []
+                if group_by:
+                    groups = self.count_groups(graph, group_by)
+                parsed = self.parse_query(original_query)
+                llm_calls = [call for call in parsed.llm_calls if call.context_expressions] if parsed else []
+                for call in llm_calls:
+                    if call.function in PER_ROW_FUNCTIONS:
+                        distinct = self.count_distinct_contexts(graph, list(call.context_expressions))
+                        if distinct is not None:
+                            contexts.append((call, distinct))
+            if self.payload and llm_calls:
+                try:
+                    with self._timed('payload'):
+                        payloads = self.estimate_payload(graph, llm_calls, group_by, self.token_model)
+                except Exception as e:
+                    self._print(f"⚠ Error estimating the LLM payload: {e}")
+            if self.context_window is not None and llm_calls:
+                try:
+                    with self._timed('batch_plan'):
+                        batch_plans = self.plan_batches(graph, llm_calls, group_by,
+                                                        self.token_model, self.context_window)
+                except Exception as e:
+                    self._print(f"⚠ Error planning the LLM batches: {e}")
         
         # Step 5: Report results
-        print("TUPLE REDUCTION ANALYSIS:")
-        print("-" * 70)
-        print(f"{'Table':<20} {'Original':<12} {'Reduced':<12} {'Reduction %':<12}")
-        print("-" * 70)
-        
-        total_original = 0
-        total_reduced = 0
-        
+        report_start = time.perf_counter()
         for table in sorted(reductions.keys()):
-            original, reduced, pct = reductions[table]
+            original, reduced, _ = reductions[table]
+            low, high = intervals.get(table, (reduced, reduced)) if intervals is not None else (None, None)
+            report.nodes.append(NodeReduction(table, graph.node_base_table.get(table, table),
+                                              original, reduced, low, high))
+        report.join_rows, report.join_exact = join_count
+        report.groups, report.groups_exact = groups
+        report.having = bool(re.search(r'\bHAVING\b', baseline_query, re.IGNORECASE))
+        report.contexts = [ContextCount(call.alias or call.function, call.function, distinct)
+                           for call, distinct in contexts]
+        report.payloads = payloads
+        report.batch_plans = batch_plans
+        if self.text:
+            self._report_reductions(report)
+            if payloads:
+                self._report_payload(payloads)
+            if batch_plans:
+                self._report_batches(batch_plans)
+        self.timings['report'] = time.perf_counter() - report_start
+
+        # Step 6: Reduce-and-execute, memoization (of the reduced query
+        # when there is one)
+        reduced_query = None
+        with self._timed('rewrite'):
+            if self.rewrite:
+                reduced_query = self._write_reduced(query_file, original_query, baseline_query,
+                                                    bool(leftover))
+            if self.memo is not None:
+                self._write_memoized(query_file, reduced_query or original_query)
+            if self.dedup:
+                self._write_deduplicated(query_file, reduced_query or original_query)
+        if self.profiler is not None:
+            self._report_profile(query_path)
+        return report
+
+    def _report_profile(self, query_path: Path) -> None:
+        """Profile mode: summary of the query's SQL statements, and their JSON profiles."""
+        if self.text:
+            self._print(format_profile(self.profiler), end='')
+        if self.profile_dir:
+            target = Path(self.profile_dir) / f"{query_path.stem}.profile.json"
+            target.parent.mkdir(parents=True, exist_ok=True)
+            target.write_text(json.dumps(self.profiler.to_json(), indent=1))
+            self._print(f"SQL PROFILES: {target}")
+            self._print()
+
+    def _report_reductions(self, report: ReductionReport) -> None:
+        """Step 5 of analyze_query(): per-table reductions and the counts reaching the LLM."""
+        estimated = report.mode == 'estimate'
+        self._print("TUPLE REDUCTION ANALYSIS:")
+        self._print("-" * 70)
+        header = f"{'Table':<20} {'Original':<12} {'Reduced':<12} {'Reduction %':<12}"
+        if estimated:
+            header += f" {'95% CI':<16}"
+        self._print(header)
+        self._print("-" * 70)
+
+        def _ci(original: int, low: int, high: int) -> str:
+            # Interval of the reduction %: the high count gives the low %
+            if original <= 0:
+                return ""
+            return (f"  [{(original - high) / original * 100:.1f}%, "
+                    f"{(original - low) / original * 100:.1f}%]")
+
+        for node in report.nodes:
             # For self-join nodes, show base table name alongside the alias
-            base = graph.node_base_table.get(table, table)
-            display = f"{base} ({table})" if base != table else table
-            print(f"{display:<20} {original:<12,} {reduced:<12,} {pct:>10.2f}%")
-            total_original += original
-            total_reduced += reduced
-        
-        print("-" * 70)
-        
+            display = f"{node.base_table} ({node.table})" if node.base_table != node.table else node.table
+            line = f"{display:<20} {node.original:<12,} {node.reduced:<12,} {node.pct:>10.2f}%"
+            if estimated:
+                line += _ci(node.original, node.reduced_low, node.reduced_high)
+            self._print(line)
+
+        self._print("-" * 70)
+
+        total_original = report.total_original
         if total_original > 0:
-            overall_pct = ((total_original - total_reduced) / total_original) * 100
-            print(f"{'OVERALL':<20} {total_original:<12,} {total_reduced:<12,} {overall_pct:>10.2f}%")
-        
-        print()
+            line = (f"{'OVERALL':<20} {total_original:<12,} {report.total_reduced:<12,} "
+                    f"{report.overall_pct:>10.2f}%")
+            if estimated:
+                # Summed bounds: conservative, the tables are not independent
+                line += _ci(total_original, sum(n.reduced_low for n in report.nodes),
+                            sum(n.reduced_high for n in report.nodes))
+            self._print(line)
+
+        # Rows (or groups) reaching the LLM calls of the original query
+        def _note(exact: bool) -> str:
+            if exact:
+                return "exact"
+            if report.outer_joins:
+                return f"estimate, {report.outer_joins} outer join(s) not applied"
+            if report.unapplied_conditions:
+                return f"upper bound, {report.unapplied_conditions} condition(s) not applied"
+            return "upper bound, graph still cyclic"
+
+        rows = report.join_rows
+        if rows is not None:
+            self._print(f"{'JOIN RESULT':<20} {rows:<12,} rows ({_note(report.join_exact)})")
+        if report.groups is not None:
+            having = " before HAVING" if report.having else ""
+            self._print(f"{'GROUPS':<20} {report.groups:<12,} GROUP BY groups{having} "
+                        f"({_note(report.groups_exact)})")
+        # Model calls needed when every distinct context is sent only once
+        for context in report.contexts:
+            line = f"{'CONTEXTS':<20} {context.distinct:<12,} distinct for {context.label} ({context.function})"
+            if rows and context.distinct:
+                line += f", {rows / context.distinct:.2f} rows each"
+            self._print(line)
+
+        self._print()
+
+    def _report_payload(self, payloads: List[CallPayload]) -> None:
+        """Step 5 of analyze_query(): bytes and tokens of the LLM calls."""
+        self._print(f"LLM PAYLOAD (bytes; {self.token_model.description}):")
+        self._print("-" * 70)
+        self._print(f"{'Call':<20} {'Before':<12} {'After':<12} {'Reduction %':<12} {'Tokens after'}")
+        self._print("-" * 70)
+
+        def _pct(before: int, after: int) -> float:
+            return (before - after) / before * 100 if before else 0.0
+
+        for p in payloads:
+            self._print(f"{p.label:<20} {p.before_bytes:<12,} {p.after_bytes:<12,} "
+                        f"{_pct(p.before_bytes, p.after_bytes):>10.2f}%  {p.tokens(p.after_bytes):,}")
+            if p.distinct_bytes is not None:
+                self._print(f"{'  once per context':<20} {'':<12} {p.distinct_bytes:<12,} "
+                            f"{'':<12} {p.tokens(p.distinct_bytes):,}")
+        self._print("-" * 70)
+        before = sum(p.before_bytes for p in payloads)
+        after = sum(p.after_bytes for p in payloads)
+        tokens = sum(p.tokens(p.after_bytes) for p in payloads)
+        self._print(f"{'OVERALL':<20} {before:<12,} {after:<12,} {_pct(before, after):>10.2f}%  {tokens:,}")
+        if not all(p.exact for p in payloads):
+            self._print("⚠ Upper bound: some WHERE conditions could not be applied to the join.")
+        self._print()
+
+    def _report_batches(self, plans: List[BatchPlan]) -> None:
+        """Step 5 of analyze_query(): API calls of the aggregate LLM calls."""
+        self._print(f"LLM BATCHES (context window {self.context_window:,} tokens; "
+                    f"{self.token_model.description}):")
+        self._print("-" * 70)
+        self._print(f"{'Call':<20} {'Groups':<8} {'Tuples':<12} {'Tokens':<12} {'API calls':<10} {'Round trips'}")
+        self._print("-" * 70)
+        for p in plans:
+            self._print(f"{p.label:<20} {p.groups:<8,} {p.tuples:<12,} {p.tokens:<12,} "
+                        f"{p.api_calls:<10,} {p.round_trips:,}")
+        self._print("-" * 70)
+        self._print("Round trips: API calls of the largest group, with groups running concurrently.")
+        if not all(p.exact for p in plans):
+            self._print("⚠ Upper bound: some WHERE conditions could not be applied to the join.")
+        self._print()
+
+    def _write_reduced(self, query_file: str, original_query: str,
+                       baseline_query: str, has_leftover_llm: bool) -> Optional[str]:
+        """
+        Step 6 of analyze_query(): rewrite, verify and write a query.
+
+        With ``verify`` set, a rewrite whose result differs from the
+        baseline's (or that cannot be run) is reported and not written.
+        """
+        # The rewrite needs the query's own join columns, not encoded keys
+        graph = self.parse_join_graph(baseline_query, encode_keys=False)
+        rewritten, replaced = self.rewrite_reduced_query(original_query, graph)
+        if rewritten is None:
+            self._print("REDUCED QUERY: no table could be replaced by a reduced form")
+            self._print()
+            return None
+        reduced = f"{len(replaced)} of {len(graph.nodes)} tables reduced"
+        verified = None
+        if self.verify:
+            if has_leftover_llm:
+                verified = "   ⚠ Not verified: the baseline query still calls LLM functions"
+            else:
+                # Which rows a trailing LIMIT keeps is arbitrary (ties, no
+                # ORDER BY), so the check compares the results without it
+                unlimited = re.sub(r'\s+LIMIT\s+\d+(?:\s+OFFSET\s+\d+)?\s*;?\s*$', '',
+                                   baseline_query, flags=re.IGNORECASE)
+                without = " without LIMIT" if unlimited != baseline_query else ""
+                reduced_baseline, _ = self.rewrite_reduced_query(unlimited, graph)
+                try:
+                    baseline_rows, reduced_rows, differing = self.verify_reduced_query(
+                        unlimited, reduced_baseline)
+                except Exception as e:
+                    self._print(f"REDUCED QUERY: not written ({reduced})")
+                    self._print(f"   ⚠ Error verifying the reduced query: {e}")
+                    self._print()
+                    return None
+                if differing:
+                    self._print(f"REDUCED QUERY: not written ({reduced})")
+                    self._print(f"   ❌ Result differs from the baseline: {reduced_rows:,} rows "
+                                f"vs {baseline_rows:,}, {differing:,} not in both")
+                    self._print()
+                    return None
+                verified = f"   ✅ Same result as the baseline{without} ({baseline_rows:,} rows)"
+        target = self.write_reduced_query(query_file, rewritten)
+        self._print(f"REDUCED QUERY: {target} ({reduced})")
+        if verified:
+            self._print(verified)
+        self._print()
+        return rewritten
+
+    def _write_memoized(self, query_file: str, query: str) -> None:
+        """Step 6 of analyze_query(): write the memoized script of a query."""
+        parsed = self.parse_query(query)
+        if parsed is None:
+            self._print("MEMOIZED QUERY: not written (the query could not be parsed)")
+            self._print()
+            return
+        columns = {(call.function, call.alias): call.context_columns for call in parsed.llm_calls}
+        result = self.memo.rewrite(query, Path(query_file).stem, columns)
+        if result.script is None:
+            self._print(f"MEMOIZED QUERY: not written ({result.reason})")
+        else:
+            target = self.write_reduced_query(query_file, result.script, "memoized", header="")
+            self._print(f"MEMOIZED QUERY: {target} "
+                        f"({', '.join(result.memoized)} looked up in {self.memo.table})")
+        self._print()
+
+    def _write_deduplicated(self, query_file: str, query: str) -> None:
+        """Step 6 of analyze_query(): write a query calling the model once per distinct context."""
+        parsed = self.parse_query(query)
+        if parsed is None:
+            self._print("DEDUPLICATED QUERY: not written (the query could not be parsed)")
+            self._print()
+            return
+        columns = {(call.function, call.alias): call.context_columns for call in parsed.llm_calls}
+        result = distinct_context_query(query, columns)
+        if result.script is None:
+            self._print(f"DEDUPLICATED QUERY: not written ({result.reason})")
+        else:
+            name = Path(query_file).name
+            header = f"-- ../{name} with each LLM call run once per distinct context, written by reduction_analyzer.py\n"
+            target = self.write_reduced_query(query_file, result.script, "deduplicated", header=header)
+            self._print(f"DEDUPLICATED QUERY: {target} "
+                        f"({', '.join(result.memoized)} once per distinct context)")
+        self._print()
+
+
+    def _analyze_to_buffer(self, query_file: str,
+                           show_queries: bool) -> Tuple[str, ReductionReport]:
+        """Analyze one query file and return its text and structured reports."""
+        buffer = io.StringIO()
+        self.out = buffer
+        report = None
+        error = None
+        try:
+            report = self.analyze_query(query_file, show_queries=show_queries)
+        except FileNotFoundError:
+            error = f"File not found: {query_file}"
+        except Exception as e:
+            error = f"Error analyzing {query_file}: {e}"
+        finally:
+            if error is not None:
+                self._print(f"❌ {error}\n")
+            self.out = None
+        if report is None:
+            report = ReductionReport(Path(query_file).name)
+            report.error = error
+        return buffer.getvalue(), report
+
+    def _analyze_all(self, query_files: Iterable[str], jobs: int,
+                     show_queries: bool) -> Iterator[Tuple[str, ReductionReport]]:
+        """
+        Analyze several query files, yielding (text, report) in input order.
+
+        With ``jobs > 1`` the files are spread over a thread pool of
+        workers created by spawn_worker().  Each report is buffered while
+        its query runs, so output stays grouped per query and is yielded
+        in the same order as ``query_files`` regardless of which worker
+        finishes first.
+        """
+        query_files = list(query_files)
+        if jobs <= 1:
+            for query_file in query_files:
+                yield self._analyze_to_buffer(query_file, show_queries)
+            return
+
+        workers: "queue.Queue[QueryReducer]" = queue.Queue()
+        for worker_id in range(min(jobs, len(query_files))):
+            workers.put(self.spawn_worker(worker_id))
+
+        def _run(query_file: str) -> Tuple[str, ReductionReport]:
+            worker = workers.get()
+            try:
+                return worker._analyze_to_buffer(query_file, show_queries)
+            finally:
+                workers.put(worker)
+
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(_run, query_file) for query_file in query_files]
+            for future in futures:
+                yield future.result()
+
+        while not workers.empty():
+            worker = workers.get()
+            worker.conn.execute(f"DROP SCHEMA IF EXISTS {worker.scratch_schema} CASCADE")
+            worker.conn.close()
+
+    def analyze_queries(self, query_files: Iterable[str], jobs: int = 1,
+                        show_queries: bool = True) -> Iterator[str]:
+        """
+        Analyze several query files (``jobs`` at a time), yielding each
+        text report in input order.
+        """
+        for text, _ in self._analyze_all(query_files, jobs, show_queries):
+            yield text
+
+    def analyze_reports(self, query_files: Iterable[str], jobs: int = 1) -> Iterator[ReductionReport]:
+        """
+        Analyze several query files (``jobs`` at a time), yielding each
+        ReductionReport in input order.  Set ``text`` to False first to
+        skip formatting the text reports.
+        """
+        for _, report in self._analyze_all(query_files, jobs, show_queries=False):
+            yield report
 
 
 def main():
@@ -1060,24 +3596,163 @@ Examples:
   
   # Analyze multiple queries
   python reduction_analyzer.py queries/*.sql --data-dir ./data/
+
+  # Analyze against an existing DuckDB database, attached read-only
+  python reduction_analyzer.py queries/*.sql --database flock.duckdb
+
+  # Load the tables with the dataset's own setup script
+  python reduction_analyzer.py sql/llm_queries/*.sql --load-script sql/setup/load.sql
         """
     )
     
     parser.add_argument('query_files', nargs='+', help='SQL query file(s) to analyze')
-    parser.add_argument('--data-dir', required=True, help='Directory containing CSV data files')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--data-dir', help='Directory containing CSV data files')
+    source.add_argument('--database', metavar='FILE',
+                        help='Analyze the tables of an existing DuckDB database, attached '
+                             'read-only (sizes from catalog statistics, nothing copied)')
+    source.add_argument('--load-script', metavar='FILE',
+                        help="Load the tables by running a dataset's sql/setup/load.sql, "
+                             'without its Flock and secrets lines')
+    parser.add_argument('--script-dir', metavar='DIR',
+                        help='With --load-script: directory the relative paths of the script '
+                             'resolve against (default: the dataset directory)')
+    parser.add_argument('--key-only', action='store_true',
+                        help='Semi-join on projected join keys and row ids instead of full rows')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Number of queries to analyze concurrently (default: 1)')
+    parser.add_argument('--cache-dir', default=None,
+                        help='Parquet load cache directory (default: <data-dir>/.reduction_cache)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Always parse the CSV files, bypassing the load cache')
+    parser.add_argument('--estimate', nargs='?', type=float, const=0.01, default=None,
+                        metavar='RATE',
+                        help='Estimate reductions from a hash sample of RATE of the join '
+                             'key values (default 0.01) with 95%% confidence intervals')
+    parser.add_argument('--rewrite', action='store_true',
+                        help='Write each query rewritten to read its reduced tables '
+                             '(as CTEs) to reduced/<name> next to the query file')
+    parser.add_argument('--verify', action='store_true',
+                        help='With --rewrite: run the rewritten query without its LLM '
+                             'calls and check it returns the baseline rows')
+    parser.add_argument('--memoize', action='store_true',
+                        help='Write each query to memoized/<name> as a script that looks its '
+                             'per-row LLM calls up in a persistent memo table first '
+                             '(the reduced query with --rewrite)')
+    parser.add_argument('--dedup', action='store_true',
+                        help='Write each query to deduplicated/<name> rewritten to run its '
+                             'per-row LLM calls once per distinct context '
+                             '(the reduced query with --rewrite)')
+    parser.add_argument('--memo-ttl', type=float, default=30, metavar='DAYS',
+                        help='Memo entries older than this are dropped (default: 30, 0: no TTL)')
+    parser.add_argument('--memo-capacity', type=int, default=100_000, metavar='N',
+                        help='Keep at most N memo entries, evicting the least recently used '
+                             '(default: 100000, 0: unbounded)')
+    parser.add_argument('--payload', action='store_true',
+                        help='Estimate the bytes and tokens each LLM call sends, '
+                             'before and after reduction')
+    parser.add_argument('--tokens-per-byte', type=float, default=0.25, metavar='R',
+                        help='With --payload/--plan-batches: tokens per byte of text (default: 0.25)')
+    parser.add_argument('--tokenizer', metavar='ENCODING',
+                        help='With --payload/--plan-batches: measure tokens per byte with this tiktoken '
+                             'encoding (e.g. cl100k_base) instead')
+    parser.add_argument('--plan-batches', action='store_true',
+                        help='Simulate how llm_reduce/llm_rerank batch their groups and report '
+                             'the expected API calls, tokens and round trips')
+    parser.add_argument('--context-window', type=int, default=128_000, metavar='TOKENS',
+                        help='With --plan-batches: model context window (default: 128000)')
+    parser.add_argument('--typed-keys', action='store_true',
+                        help='Store the join keys of the given queries as integers '
+                             '(native or dictionary ids) and join on those')
+    parser.add_argument('--profile', action='store_true',
+                        help='Trace every SQL statement of each analysis and print a summary of '
+                             'the slowest steps (wall time, rows in/out, memory)')
+    parser.add_argument('--profile-dir', metavar='DIR',
+                        help="With --profile: also write each query's statements and DuckDB "
+                             'JSON profiles to DIR/<name>.profile.json')
+    parser.add_argument('--db-file', metavar='PATH',
+                        help='Keep the loaded and reduced tables in this DuckDB database file '
+                             'instead of in memory')
+    parser.add_argument('--memory-limit', metavar='SIZE',
+                        help="DuckDB memory limit, e.g. 4GB (default: DuckDB's, 80%% of RAM)")
+    parser.add_argument('--threads', type=int, metavar='N',
+                        help="DuckDB worker threads (default: DuckDB's, one per core)")
+    parser.add_argument('--temp-directory', metavar='DIR',
+                        help='Directory DuckDB spills to when over the memory limit')
+    parser.add_argument('--no-insertion-order', action='store_true',
+                        help='Let DuckDB produce rows in any order (less buffering)')
+    parser.add_argument('--out-of-core', action='store_true',
+                        help='Spill-aware mode for data larger than memory: a file-backed '
+                             'database (temporary unless --db-file), checkpointed after '
+                             'loading, without insertion order')
+    parser.add_argument('--format', choices=['table', 'json', 'parquet'], default='table',
+                        help='Report format: formatted text (default), one JSON object per '
+                             'query and line, or a Parquet file with one row per query')
+    parser.add_argument('--output', metavar='PATH',
+                        help='Write the reports to PATH instead of standard output '
+                             '(required for --format parquet)')
     
     args = parser.parse_args()
     
-    reducer = QueryReducer()
-    reducer.load_data_dynamic(args.data_dir)
+    if args.estimate is not None and not 0 < args.estimate <= 1:
+        parser.error('--estimate RATE must be in (0, 1]')
+    if args.format == 'parquet' and not args.output:
+        parser.error('--format parquet needs --output PATH')
+    if args.threads is not None and args.threads < 1:
+        parser.error('--threads N must be at least 1')
+    try:
+        token_model = (tiktoken_model(args.tokenizer) if args.tokenizer
+                       else TokenModel(args.tokens_per_byte))
+    except ImportError as e:
+        parser.error(str(e))
+    memo = None
+    if args.memoize:
+        memo = LlmMemo(ttl_days=args.memo_ttl or None, capacity=args.memo_capacity or None)
+    reducer = QueryReducer(key_only=args.key_only, sample_rate=args.estimate,
+                           rewrite=args.rewrite, verify=args.verify, memo=memo,
+                           dedup=args.dedup, payload=args.payload, token_model=token_model,
+                           context_window=args.context_window if args.plan_batches else None,
+                           text=args.format == 'table',
+                           profile=args.profile or bool(args.profile_dir),
+                           profile_dir=args.profile_dir,
+                           db_path=args.db_file or ":memory:",
+                           memory_limit=args.memory_limit, threads=args.threads,
+                           temp_directory=args.temp_directory,
+                           preserve_insertion_order=not args.no_insertion_order,
+                           out_of_core=args.out_of_core)
+    try:
+        _load_and_report(reducer, args)
+    finally:
+        reducer.close()
+
+
+def _load_and_report(reducer: QueryReducer, args: argparse.Namespace) -> None:
+    """Load the data and write the reports of main()."""
+    if args.database:
+        reducer.attach_database(args.database)
+    elif args.load_script:
+        reducer.run_load_script(args.load_script, base_dir=args.script_dir)
+    else:
+        cache_dir = None if args.no_cache else (
+            args.cache_dir or str(Path(args.data_dir) / '.reduction_cache')
+        )
+        reducer.load_data_dynamic(args.data_dir, cache_dir=cache_dir)
+    if args.typed_keys:
+        reducer.encode_join_keys(args.query_files)
     
-    for query_file in args.query_files:
-        try:
-            reducer.analyze_query(query_file)
-        except FileNotFoundError:
-            print(f"❌ File not found: {query_file}\n")
-        except Exception as e:
-            print(f"❌ Error analyzing {query_file}: {e}\n")
+    if args.format != 'table':
+        count = write_reports(reducer.analyze_reports(args.query_files, jobs=args.jobs),
+                              args.format, args.output)
+        if args.output:
+            print(f"✓ {count} report(s) written to {args.output}")
+        return
+    out = open(args.output, 'w', encoding='utf-8') if args.output else None
+    try:
+        for report in reducer.analyze_queries(args.query_files, jobs=args.jobs):
+            print(report, end='', file=out)
+    finally:
+        if out is not None:
+            out.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,227 @@
+"""
+Structured Reduction Reports
+
+QueryReducer.analyze_query() returns a ReductionReport: the per-table
+sizes, overall reduction, join graph shape, join and group counts,
+distinct LLM contexts, payload and batch estimates, phase timings and
+warnings of one query.  Reports and their nodes use ``__slots__``, so
+thousands of them stay small in memory.
+
+``write_reports`` writes reports in bulk for dashboards and later
+analysis, in either format DuckDB reads back directly:
+
+    - json: one JSON object per line,
+      ``SELECT * FROM read_json('reports.json')``
+    - parquet: one row per report with nested node and context lists,
+      ``SELECT * FROM read_parquet('reports.parquet')``
+"""
+
+import os
+import sys
+import json
+import tempfile
+from typing import Dict, Iterable, List, NamedTuple, Optional, TextIO
+
+import duckdb
+
+from llm_payload import BatchPlan, CallPayload
+
+# ============================================================================
+# Report
+# ============================================================================
+
+class ContextCount(NamedTuple):
+    """Distinct contexts reaching one per-row LLM call."""
+    label: str       # alias of the call, else its function
+    function: str
+    distinct: int
+
+
+class NodeReduction:
+    """Original and reduced size of one table (or self-join alias)."""
+
+    __slots__ = ('table', 'base_table', 'original', 'reduced', 'reduced_low', 'reduced_high')
+
+    def __init__(self, table: str, base_table: str, original: int, reduced: int,
+                 reduced_low: Optional[int] = None, reduced_high: Optional[int] = None):
+        self.table = table
+        self.base_table = base_table
+        self.original = original
+        self.reduced = reduced
+        # 95% interval of the reduced size (estimate mode only)
+        self.reduced_low = reduced_low
+        self.reduced_high = reduced_high
+
+    @property
+    def pct(self) -> float:
+        return _pct(self.original, self.reduced)
+
+    def to_dict(self) -> Dict[str, object]:
+        return {'node': self.table, 'base_table': self.base_table, 'original': self.original,
+                'reduced': self.reduced, 'pct': self.pct,
+                'reduced_low': self.reduced_low, 'reduced_high': self.reduced_high}
+
+
+def _pct(original: int, reduced: int) -> float:
+    return (original - reduced) / original * 100 if original > 0 else 0.0
+
+
+class ReductionReport:
+    """
+    Result of analyzing one query.  ``mode`` is how the reductions were
+    computed ('semi-join', 'having' or 'estimate'); None with ``error``
+    or a warning when the query could not be analyzed.
+    """
+
+    __slots__ = ('query', 'mode', 'nodes', 'graph_nodes', 'graph_edges', 'cyclic',
+                 'unapplied_conditions', 'outer_joins', 'join_rows', 'join_exact', 'groups', 'groups_exact', 'having',
+                 'contexts', 'payloads', 'batch_plans', 'timings', 'warnings', 'error')
+
+    def __init__(self, query: str):
+        self.query = query
+        self.mode: Optional[str] = None
+        self.nodes: List[NodeReduction] = []
+        self.graph_nodes = 0
+        self.graph_edges = 0
+        self.cyclic = False
+        self.unapplied_conditions = 0
+        self.outer_joins = 0
+        # Rows reaching the LLM calls; exact only for a join tree of INNER
+        # joins with every condition applied
+        self.join_rows: Optional[int] = None
+        self.join_exact = False
+        # GROUP BY groups, counted before HAVING when ``having``; exact
+        # under the same conditions as ``join_rows``
+        self.groups: Optional[int] = None
+        self.groups_exact = False
+        self.having = False
+        self.contexts: List[ContextCount] = []
+        self.payloads: List[CallPayload] = []
+        self.batch_plans: List[BatchPlan] = []
+        # phase -> seconds, see QueryReducer.timings
+        self.timings: Dict[str, float] = {}
+        self.warnings: List[str] = []
+        self.error: Optional[str] = None
+
+    @property
+    def total_original(self) -> int:
+        return sum(node.original for node in self.nodes)
+
+    @property
+    def total_reduced(self) -> int:
+        return sum(node.reduced for node in self.nodes)
+
+    @property
+    def overall_pct(self) -> float:
+        return _pct(self.total_original, self.total_reduced)
+
+    def to_dict(self) -> Dict[str, object]:
+        """The report as JSON-compatible values, one key per REPORT_COLUMNS column."""
+        return {
+            'query': self.query,
+            'mode': self.mode,
+            'error': self.error,
+            'graph_nodes': self.graph_nodes,
+            'graph_edges': self.graph_edges,
+            'cyclic': self.cyclic,
+            'unapplied_conditions': self.unapplied_conditions,
+            'outer_joins': self.outer_joins,
+            'total_original': self.total_original,
+            'total_reduced': self.total_reduced,
+            'overall_pct': self.overall_pct,
+            'join_rows': self.join_rows,
+            'join_exact': self.join_exact,
+            'groups': self.groups,
+            'groups_exact': self.groups_exact,
+            'nodes': [node.to_dict() for node in self.nodes],
+            'contexts': [c._asdict() for c in self.contexts],
+            'payloads': [p._asdict() for p in self.payloads],
+            'batch_plans': [b._asdict() for b in self.batch_plans],
+            'warnings': list(self.warnings),
+            'timings': dict(self.timings),
+        }
+
+
+# ============================================================================
+# Output
+# ============================================================================
+
+# Column types of the Parquet output (and of read_json over the JSON output)
+REPORT_COLUMNS = {
+    'query': 'VARCHAR',
+    'mode': 'VARCHAR',
+    'error': 'VARCHAR',
+    'graph_nodes': 'INTEGER',
+    'graph_edges': 'INTEGER',
+    'cyclic': 'BOOLEAN',
+    'unapplied_conditions': 'INTEGER',
+    'outer_joins': 'INTEGER',
+    'total_original': 'BIGINT',
+    'total_reduced': 'BIGINT',
+    'overall_pct': 'DOUBLE',
+    'join_rows': 'BIGINT',
+    'join_exact': 'BOOLEAN',
+    'groups': 'BIGINT',
+    'groups_exact': 'BOOLEAN',
+    'nodes': 'STRUCT(node VARCHAR, base_table VARCHAR, original BIGINT, reduced BIGINT, '
+             'pct DOUBLE, reduced_low BIGINT, reduced_high BIGINT)[]',
+    'contexts': 'STRUCT(label VARCHAR, function VARCHAR, "distinct" BIGINT)[]',
+    'payloads': 'STRUCT(label VARCHAR, before_bytes BIGINT, after_bytes BIGINT, '
+                'distinct_bytes BIGINT, tokens_per_byte DOUBLE, exact BOOLEAN)[]',
+    'batch_plans': 'STRUCT(label VARCHAR, groups BIGINT, tuples BIGINT, tokens BIGINT, '
+                   'api_calls BIGINT, round_trips BIGINT, exact BOOLEAN)[]',
+    'warnings': 'VARCHAR[]',
+    'timings': 'MAP(VARCHAR, DOUBLE)',
+}
+
+
+def write_json(reports: Iterable[ReductionReport], out: TextIO) -> int:
+    """Write one JSON object per report and line; returns the count."""
+    count = 0
+    for report in reports:
+        out.write(json.dumps(report.to_dict()) + "\n")
+        count += 1
+    return count
+
+
+def write_parquet(reports: Iterable[ReductionReport], path: str) -> int:
+    """
+    Write the reports to a Parquet file; returns the count.
+
+    The reports are streamed to a temporary JSON-lines file as they come
+    and converted in one COPY, typed by REPORT_COLUMNS, so they are never
+    all held in memory.
+    """
+    columns = ", ".join(f"'{name}': '{column_type}'" for name, column_type in REPORT_COLUMNS.items())
+    fd, lines = tempfile.mkstemp(suffix='.json')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as out:
+            count = write_json(reports, out)
+        conn = duckdb.connect()
+        try:
+            # $n rather than ?: COPY binds its target before the subquery
+            conn.execute(f"COPY (SELECT * FROM read_json($1, format = 'newline_delimited', "
+                         f"columns = {{{columns}}})) TO $2 (FORMAT PARQUET)", [lines, path])
+        finally:
+            conn.close()
+    finally:
+        os.unlink(lines)
+    return count
+
+
+def write_reports(reports: Iterable[ReductionReport], format: str,
+                  path: Optional[str] = None) -> int:
+    """
+    Write ``reports`` as 'json' (to ``path``, or standard output) or
+    'parquet' (to ``path``); returns the number written.
+    """
+    if format == 'parquet':
+        if path is None:
+            raise ValueError("Parquet reports need an output path")
+        return write_parquet(reports, path)
+    if format != 'json':
+        raise ValueError(f"unknown report format: {format}")
+    if path is None:
+        return write_json(reports, sys.stdout)
+    with open(path, 'w', encoding='utf-8') as f:
+        return write_json(reports, f)
@@ -0,0 +1,533 @@
+"""
+SQL Front-End for the Reduction Analyzer
+
+Parses queries with DuckDB's own parser (``json_serialize_sql``) instead of
+regexes, and extracts what the analyzer needs from the serialized AST:
+
+    - the base tables, with self-join occurrences as separate nodes
+    - the ON conjuncts and the type (INNER, LEFT, ...) of every JOIN, and
+      the WHERE conjuncts, with column references rewritten to node names
+    - GROUP BY / HAVING
+    - the Flock LLM call sites (llm_* functions) and their context columns
+
+Expressions are turned back into SQL with ``json_deserialize_sql``, so
+CTEs, nested subqueries, BETWEEN ... AND, OR predicates and comments are
+handled exactly as DuckDB handles them.
+
+Parsed plans are cached by a hash of the normalized query *template*:
+comments and whitespace are normalized and literals are replaced by
+``$n`` parameters before parsing, so a workload of many instances of the
+same template parses it once.  Literals are substituted back into the
+rendered SQL when a plan is bound to a concrete query.
+"""
+
+import re
+import json
+import copy
+import hashlib
+import threading
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+# ============================================================================
+# Query Normalization
+# ============================================================================
+
+_TOKEN_PATTERN = re.compile(r"""
+    (?P<comment>--[^\n]*|/\*.*?\*/)
+  | (?P<typeparams>\b(?:DECIMAL|NUMERIC|VARCHAR|CHAR|BIT)\s*\([\d\s,]*\))
+  | (?P<string>'(?:[^']|'')*')
+  | (?P<ident>"(?:[^"]|"")*")
+  | (?P<number>(?<![\w.$])\d+(?:\.\d+)?(?:[eE][+-]?\d+)?(?![\w.]))
+  | (?P<space>\s+)
+""", re.VERBOSE | re.DOTALL | re.IGNORECASE)
+
+_PARAMETER_PATTERN = re.compile(r'\$(\d+)\b')
+
+# Prepared-statement parameters of the query itself ($1, $name, ?),
+# outside strings, quoted identifiers and comments
+_QUERY_PARAMETER_PATTERN = re.compile(r"""
+    ('(?:[^']|'')*'|"(?:[^"]|"")*"|--[^\n]*|/\*.*?\*/)
+  | (\$\w+|\?)
+""", re.VERBOSE | re.DOTALL)
+
+# Runs of spaces outside quoted strings and identifiers
+_SPACES_PATTERN = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")| {2,}""")
+
+
+def normalize_query(query: str) -> Tuple[str, List[str]]:
+    """
+    Split a query into its template and literals.
+
+    Comments are dropped, whitespace is collapsed, and every string or
+    numeric literal becomes a ``$n`` parameter.  Struct keys
+    (``{'prompt': ...}``) and type parameters (``DECIMAL(3,2)``) are part
+    of the query's shape and stay in the template.
+
+    Returns (template, literals), where literals[n - 1] is the text of $n.
+    """
+    literals: List[str] = []
+
+    def _replace(m: re.Match) -> str:
+        kind = m.lastgroup
+        if kind in ('comment', 'space'):
+            return ' '
+        if kind in ('typeparams', 'ident'):
+            return m.group(0)
+        if kind == 'string':
+            rest = query[m.end():].lstrip()
+            if rest.startswith(':') and not rest.startswith('::'):
+                return m.group(0)  # struct key
+        literals.append(m.group(0))
+        return f"${len(literals)}"
+
+    template = _TOKEN_PATTERN.sub(_replace, query)
+    template = _SPACES_PATTERN.sub(lambda m: m.group(1) or ' ', template)
+    return template.strip(), literals
+
+
+def bind_literals(text: str, literals: List[str]) -> str:
+    """Replace the ``$n`` parameters of a template by their literals."""
+    if not literals:
+        return text
+    return _PARAMETER_PATTERN.sub(
+        lambda m: literals[int(m.group(1)) - 1] if int(m.group(1)) <= len(literals) else m.group(0),
+        text,
+    )
+
+
+# ============================================================================
+# Parsed Query
+# ============================================================================
+
+class TableRef(NamedTuple):
+    """One base-table occurrence in the FROM clause."""
+    node: str            # join-graph node (table name, or alias for self-joins)
+    table: str           # table name
+    alias: Optional[str]
+
+
+class Conjunct(NamedTuple):
+    """One AND-conjunct, rendered with node-qualified column references."""
+    refs: Tuple[str, ...]  # nodes referenced, in order of appearance
+    sql: str
+
+
+class LlmCall(NamedTuple):
+    """A Flock LLM function call site."""
+    function: str                    # e.g. llm_complete
+    clause: str                      # SELECT, WHERE, HAVING, ORDER BY, ...
+    alias: str                       # output name for SELECT items, else ''
+    prompt: Optional[str]
+    context_columns: Tuple[str, ...]  # column references passed to the LLM
+    sql: str
+    # 'data' expressions of context_columns with node-qualified column
+    # references; empty unless the call is in the base SELECT
+    context_expressions: Tuple[str, ...] = ()
+
+
+class ParsedQuery(NamedTuple):
+    """
+    The parts of a query the analyzer needs, taken from its base SELECT
+    (the innermost level reached by unwrapping ``FROM (subquery)`` and
+    ``FROM cte`` wrappers, as _extract_base_query does).
+    """
+    tables: List[TableRef]
+    joins: List[List[Conjunct]]   # ON conjuncts of each JOIN, in FROM order
+    join_types: List[str]         # type of each JOIN: INNER, LEFT, RIGHT, FULL, SEMI, ...
+    nullable: List[str]           # nodes on the NULL-supplying side of an outer JOIN
+                                  # (or the right side of SEMI/ANTI), see _NULLABLE_SIDES
+    where: List[Conjunct]         # WHERE conjuncts without subqueries or LLM calls
+    skipped: List[str]            # the WHERE and ON conjuncts left out of ``where``/``joins``
+    group_by: List[str]
+    having: Optional[str]
+    having_min_count: Optional[int]  # N of ``HAVING count(...) >= N``
+    llm_calls: List[LlmCall]          # from every level of the query
+    ast: dict  # serialized statement; template literals appear as $n parameters
+
+    def bind(self, literals: List[str]) -> 'ParsedQuery':
+        """Substitute a concrete query's literals into this template."""
+        if not literals:
+            return self
+
+        def _b(text):
+            return None if text is None else bind_literals(text, literals)
+
+        return ParsedQuery(
+            tables=self.tables,
+            joins=[[Conjunct(c.refs, _b(c.sql)) for c in join] for join in self.joins],
+            join_types=self.join_types,
+            nullable=self.nullable,
+            where=[Conjunct(c.refs, _b(c.sql)) for c in self.where],
+            skipped=[_b(c) for c in self.skipped],
+            group_by=[_b(g) for g in self.group_by],
+            having=_b(self.having),
+            having_min_count=self.having_min_count,
+            llm_calls=[call._replace(prompt=_b(call.prompt), sql=_b(call.sql),
+                                     context_expressions=tuple(_b(e) for e in call.context_expressions))
+                       for call in self.llm_calls],
+            ast=self.ast,
+        )
+
+
+# ============================================================================
+# AST Helpers
+# ============================================================================
+
+_CLAUSES = (
+    ('select_list', 'SELECT'), ('where_clause', 'WHERE'), ('group_expressions', 'GROUP BY'),
+    ('having', 'HAVING'), ('qualify', 'QUALIFY'), ('modifiers', 'ORDER BY'),
+)
+
+
+def _walk(value, into_subqueries: bool = False) -> Iterator[dict]:
+    """Yield every dict in an AST fragment, optionally skipping subqueries."""
+    if isinstance(value, dict):
+        yield value
+        if value.get('class') == 'SUBQUERY' and not into_subqueries:
+            return
+        for child in value.values():
+            yield from _walk(child, into_subqueries)
+    elif isinstance(value, list):
+        for child in value:
+            yield from _walk(child, into_subqueries)
+
+
+def _conjuncts(expr: Optional[dict]) -> List[dict]:
+    """Top-level AND-conjuncts of an expression."""
+    if expr is None:
+        return []
+    if expr.get('type') == 'CONJUNCTION_AND':
+        return [c for child in expr['children'] for c in _conjuncts(child)]
+    return [expr]
+
+
+def _is_llm_call(expr: dict) -> bool:
+    return expr.get('class') == 'FUNCTION' and expr.get('function_name', '').lower().startswith('llm_')
+
+
+def _select_nodes(value) -> Iterator[dict]:
+    """Every SELECT_NODE in a statement, including subqueries and CTEs."""
+    for item in _walk(value, into_subqueries=True):
+        if item.get('type') == 'SELECT_NODE':
+            yield item
+
+
+def _base_select(node: dict) -> Optional[dict]:
+    """Unwrap ``FROM (subquery)`` and ``FROM cte`` until a real FROM clause."""
+    ctes: Dict[str, dict] = {}
+    while node is not None and node.get('type') == 'SELECT_NODE':
+        for entry in node.get('cte_map', {}).get('map', []):
+            ctes[entry['key']] = entry['value']['query']['node']
+        source = node.get('from_table') or {}
+        if source.get('type') == 'SUBQUERY':
+            node = source['subquery']['node']
+        elif (source.get('type') == 'BASE_TABLE' and not source.get('schema_name')
+              and source.get('table_name') in ctes):
+            node = ctes.pop(source['table_name'])
+        else:
+            return node
+    return None
+
+
+# NULL-supplying sides of each JOIN type; the right side of SEMI and ANTI
+# joins is listed too, as its rows only decide which left rows are kept.
+_NULLABLE_SIDES = {
+    'LEFT': ('right',), 'RIGHT': ('left',), 'FULL': ('left', 'right'),
+    'SEMI': ('right',), 'ANTI': ('right',),
+}
+
+
+def _flatten_from(ref: dict, tables: List[dict], joins: List[dict]) -> None:
+    """Collect base tables and JOIN nodes of a FROM tree in textual order."""
+    if ref.get('type') == 'JOIN':
+        _flatten_from(ref['left'], tables, joins)
+        _flatten_from(ref['right'], tables, joins)
+        joins.append(ref)
+    elif ref.get('type') == 'BASE_TABLE':
+        tables.append(ref)
+
+
+# ============================================================================
+# Front-End
+# ============================================================================
+
+_UNPARSEABLE = object()
+
+
+class SqlFrontend:
+    """
+    Parse queries into ParsedQuery objects through DuckDB's parser, with a
+    plan cache keyed by the SHA-256 of the normalized template.
+
+    The cache is shared by all workers of a QueryReducer; each parse uses
+    the caller's connection (parsing needs no tables).
+    """
+
+    def __init__(self):
+        self._plans: Dict[str, object] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def parse(self, query: str, conn) -> Optional[ParsedQuery]:
+        """
+        Parse ``query``, or return None if DuckDB cannot parse it or it is
+        not a single SELECT statement.
+        """
+        if any(m.group(2) for m in _QUERY_PARAMETER_PATTERN.finditer(query)):
+            # The query's own parameters would collide with the template's
+            # $n placeholders: parse it as it is
+            plan = self._plan(query, conn, own_parameters=True)
+            return None if plan is _UNPARSEABLE else plan.bind([])
+        template, literals = normalize_query(query)
+        plan = self._plan(template, conn)
+        if plan is _UNPARSEABLE and literals:
+            # Some literals cannot be parameters (e.g. DATE '2024-01-01');
+            # cache the concrete query instead.
+            plan = self._plan(bind_literals(template, literals), conn)
+            literals = []
+        if plan is _UNPARSEABLE:
+            return None
+        return plan.bind(literals)
+
+    def _plan(self, text: str, conn, own_parameters: bool = False):
+        key = hashlib.sha256((('raw:' if own_parameters else '') + text).encode('utf-8')).hexdigest()
+        with self._lock:
+            plan = self._plans.get(key)
+            if plan is not None:
+                self.hits += 1
+                return plan
+            self.misses += 1
+        try:
+            plan = self._build(text, conn, own_parameters)
+        except Exception:
+            plan = _UNPARSEABLE
+        with self._lock:
+            self._plans[key] = plan
+        return plan
+
+    def _build(self, text: str, conn, own_parameters: bool = False):
+        """
+        Parse ``text`` into a _Plan.  With ``own_parameters`` its
+        parameters are the query's own, not template literals: conjuncts
+        that use them have no value to reduce with and are skipped.
+        """
+        serialized = json.loads(
+            conn.execute("SELECT json_serialize_sql(?)", [text]).fetchone()[0]
+        )
+        if serialized.get('error') or len(serialized.get('statements', [])) != 1:
+            return _UNPARSEABLE
+        statement = serialized['statements'][0]
+        base = _base_select(statement['node'])
+        if base is None:
+            return _UNPARSEABLE
+
+        def _render(expr: dict) -> str:
+            """SQL text of an expression, via json_deserialize_sql."""
+            wrapper = {'error': False, 'statements': [{'node': {
+                'type': 'SELECT_NODE', 'modifiers': [], 'cte_map': {'map': []},
+                'select_list': [dict(expr, alias='')],
+                'from_table': {'type': 'EMPTY', 'alias': '', 'sample': None, 'query_location': 0},
+                'where_clause': None, 'group_expressions': [], 'group_sets': [],
+                'aggregate_handling': 'STANDARD_HANDLING', 'having': None,
+                'sample': None, 'qualify': None,
+            }}]}
+            sql = conn.execute("SELECT json_deserialize_sql(?)", [json.dumps(wrapper)]).fetchone()[0]
+            sql = sql[len('SELECT '):]
+            if sql.startswith('(') and sql.endswith(')'):
+                depth = 0
+                for i, ch in enumerate(sql):
+                    depth += ch == '('
+                    depth -= ch == ')'
+                    if depth == 0 and i < len(sql) - 1:
+                        break
+                else:
+                    sql = sql[1:-1]
+            return sql
+
+        # ----------------------------------------------------------------
+        # Tables and node names (same rules as the regex parser: a table
+        # that occurs more than once gets one node per alias)
+        # ----------------------------------------------------------------
+        table_nodes: List[dict] = []
+        join_nodes: List[dict] = []
+        _flatten_from(base.get('from_table') or {}, table_nodes, join_nodes)
+
+        counts: Dict[str, int] = {}
+        for ref in table_nodes:
+            counts[ref['table_name']] = counts.get(ref['table_name'], 0) + 1
+
+        tables: List[TableRef] = []
+        alias_map: Dict[str, str] = {}
+        used = set()
+        for ref in table_nodes:
+            table, alias = ref['table_name'], ref.get('alias') or None
+            if counts[table] > 1:
+                node = alias or table
+                if node in used:
+                    sfx = 2
+                    while f"{node}_{sfx}" in used:
+                        sfx += 1
+                    node = f"{node}_{sfx}"
+            else:
+                node = table
+                alias_map.setdefault(table, node)
+            used.add(node)
+            alias_map.setdefault(alias or table, node)
+            tables.append(TableRef(node, table, alias))
+
+        def _resolve(expr: dict) -> Tuple[Optional[Tuple[str, ...]], dict]:
+            """
+            Node references of an expression and a copy of it with column
+            references rewritten to ``node.column``; refs is None when a
+            reference cannot be resolved to a base-table node.
+            """
+            expr = copy.deepcopy(expr)
+            refs: List[str] = []
+            for item in _walk(expr):
+                if item.get('class') != 'COLUMN_REF':
+                    continue
+                names = item['column_names']
+                if len(names) >= 2:
+                    node = alias_map.get(names[-2])
+                elif len(tables) == 1:
+                    node = tables[0].node
+                else:
+                    node = None
+                if node is None:
+                    return None, expr
+                item['column_names'] = [node, names[-1]]
+                if node not in refs:
+                    refs.append(node)
+            return tuple(refs), expr
+
+        def _conjunct(expr: dict) -> Optional[Conjunct]:
+            if any(i.get('class') == 'SUBQUERY' or _is_llm_call(i) for i in _walk(expr)):
+                return None
+            if own_parameters and any(i.get('class') == 'PARAMETER' for i in _walk(expr)):
+                return None
+            refs, rewritten = _resolve(expr)
+            return None if refs is None else Conjunct(refs, _render(rewritten))
+
+        # ----------------------------------------------------------------
+        # JOIN ... ON and WHERE conjuncts
+        # ----------------------------------------------------------------
+        joins: List[List[Conjunct]] = []
+        join_types: List[str] = []
+        nullable: List[str] = []
+        skipped: List[str] = []
+        for join in join_nodes:
+            join_type = join.get('join_type', 'INNER')
+            if join.get('ref_type') not in ('REGULAR', 'CROSS', None):
+                join_type = f"{join['ref_type']} {join_type}"  # e.g. NATURAL INNER, ASOF LEFT
+            join_types.append(join_type)
+            left_tables: List[dict] = []
+            _flatten_from(join['left'], left_tables, [])
+            right_tables: List[dict] = []
+            _flatten_from(join['right'], right_tables, [])
+            # Rows of the NULL-supplying side(s) may appear NULL-extended
+            for side in _NULLABLE_SIDES.get(join_type.split()[-1], ()):
+                for ref in (left_tables if side == 'left' else right_tables):
+                    node = tables[table_nodes.index(ref)].node
+                    if node not in nullable:
+                        nullable.append(node)
+            condition = join.get('condition')
+            if condition is None and join.get('using_columns'):
+                # USING (col): equality with the nearest table on the left
+                if left_tables and right_tables:
+                    l_node = tables[table_nodes.index(left_tables[-1])].node
+                    r_node = tables[table_nodes.index(right_tables[0])].node
+                    joins.append([Conjunct((l_node, r_node), f"{l_node}.{col} = {r_node}.{col}")
+                                  for col in join['using_columns']])
+                    continue
+            conjuncts = []
+            for expr in _conjuncts(condition):
+                conjunct = _conjunct(expr)
+                if conjunct is not None:
+                    conjuncts.append(conjunct)
+                else:
+                    skipped.append(_render(expr))
+            joins.append(conjuncts)
+
+        where: List[Conjunct] = []
+        for expr in _conjuncts(base.get('where_clause')):
+            conjunct = _conjunct(expr)
+            if conjunct is not None:
+                where.append(conjunct)
+            else:
+                skipped.append(_render(expr))
+
+        # ----------------------------------------------------------------
+        # GROUP BY / HAVING
+        # ----------------------------------------------------------------
+        group_by = [_render(_resolve(e)[1]) for e in base.get('group_expressions', [])]
+        having_expr = base.get('having')
+        having = _render(_resolve(having_expr)[1]) if having_expr else None
+        having_threshold = None
+        if (having_expr and having_expr.get('type') == 'COMPARE_GREATERTHANOREQUALTO'
+                and having_expr['left'].get('function_name', '').lower() in ('count', 'count_star')):
+            having_threshold = _render(having_expr['right'])  # may be a $n parameter
+
+        # ----------------------------------------------------------------
+        # LLM call sites (every level of the query)
+        # ----------------------------------------------------------------
+        llm_calls: List[LlmCall] = []
+        for select in _select_nodes(statement['node']):
+            for key, clause in _CLAUSES:
+                for expr in _walk(select.get(key)):
+                    if not _is_llm_call(expr):
+                        continue
+                    prompt = None
+                    columns: List[str] = []
+                    data: List[dict] = []
+                    for item in _walk(expr):
+                        if item.get('alias') == 'prompt' and item.get('class') in ('CONSTANT', 'PARAMETER'):
+                            prompt = _render(item)  # SQL literal or $n, see _Plan.bind
+                        elif item.get('class') == 'COLUMN_REF':
+                            name = '.'.join(item['column_names'])
+                            if name not in columns:
+                                columns.append(name)
+                        if item.get('alias') == 'data':
+                            data.append(item)
+                    expressions: List[str] = []
+                    if select is base:
+                        for item in data:
+                            refs, resolved = _resolve(item)
+                            if refs is None:
+                                expressions = []
+                                break
+                            expressions.append(_render(resolved))
+                    top_level = key == 'select_list' and expr in select['select_list']
+                    llm_calls.append(LlmCall(
+                        function=expr['function_name'].lower(), clause=clause,
+                        alias=expr.get('alias', '') if top_level else '',
+                        prompt=prompt, context_columns=tuple(columns), sql=_render(expr),
+                        context_expressions=tuple(expressions),
+                    ))
+
+        return _Plan(ParsedQuery(tables, joins, join_types, nullable, where, skipped, group_by,
+                                 having, None, llm_calls, statement), having_threshold)
+
+
+class _Plan:
+    """A cached template: the ParsedQuery plus the unbound HAVING threshold."""
+
+    def __init__(self, parsed: ParsedQuery, having_threshold: Optional[str]):
+        self.parsed = parsed
+        self.having_threshold = having_threshold
+
+    def bind(self, literals: List[str]) -> ParsedQuery:
+        parsed = self.parsed.bind(literals)
+        if self.having_threshold is not None:
+            try:
+                threshold = int(bind_literals(self.having_threshold, literals))
+            except ValueError:
+                threshold = None
+            parsed = parsed._replace(having_min_count=threshold)
+        # Prompts are kept as SQL string literals until bound
+        return parsed._replace(llm_calls=[
+            call._replace(prompt=call.prompt[1:-1].replace("''", "'"))
+            if call.prompt and call.prompt.startswith("'") and call.prompt.endswith("'")
+            else call
+            for call in parsed.llm_calls
+        ])
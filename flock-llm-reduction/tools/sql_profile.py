@@ -0,0 +1,187 @@
+"""
+SQL Statement Profiling
+
+Traces every SQL statement a QueryReducer issues, for ``--profile``:
+
+    - ProfiledConnection wraps the reducer's DuckDB connection and
+      enables DuckDB's profiler on it; every ``execute`` is recorded
+      with its wall time, rows scanned and produced, peak buffer memory
+      and DuckDB's JSON profile tree
+    - after each statement the database's memory use is read from
+      ``duckdb_memory()`` (on a separate cursor, so the statement's
+      result stays fetchable)
+    - each statement is attributed to the chain of reducer methods that
+      issued it, e.g. ``analyze_query;yannakakis_reduction;semi_join``
+
+``format_profile`` renders a flame-style summary of those chains, their
+self time as bars, followed by the hottest individual statements.
+"""
+
+import sys
+import json
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+import duckdb
+
+# ============================================================================
+# Statement Records
+# ============================================================================
+
+class StatementProfile(NamedTuple):
+    """One SQL statement issued during an analysis."""
+    stack: str              # reducer methods, outermost first, ';'-separated
+    sql: str
+    seconds: float          # wall time of execute()
+    rows_in: int            # rows scanned by the plan
+    rows_out: int           # rows produced (stored by CREATE TABLE AS / INSERT)
+    peak_buffer_bytes: int  # DuckDB's peak buffer memory during the statement
+    memory_bytes: int       # duckdb_memory() total after the statement
+    profile: Optional[dict]  # DuckDB's JSON profile tree, None for DDL
+
+
+def _rows_out(profile: dict) -> int:
+    """Rows produced by the plan's top operator (below a CREATE/INSERT sink)."""
+    node = (profile.get('children') or [None])[0]
+    while node and node.get('operator_type') in ('CREATE_TABLE_AS', 'INSERT', 'BATCH_CREATE_TABLE_AS',
+                                                  'BATCH_INSERT', 'RESULT_COLLECTOR'):
+        children = node.get('children') or []
+        if not children:
+            break
+        node = children[0]
+    return int(node.get('operator_cardinality', 0)) if node else 0
+
+
+class SqlProfiler:
+    """Statement records of the current query, see ProfiledConnection."""
+
+    def __init__(self):
+        self.statements: List[StatementProfile] = []
+
+    def reset(self) -> None:
+        self.statements = []
+
+    @property
+    def peak_memory_bytes(self) -> int:
+        """Highest memory reading (after a statement or during one)."""
+        return max((max(s.memory_bytes, s.peak_buffer_bytes) for s in self.statements), default=0)
+
+    def to_json(self) -> List[Dict[str, object]]:
+        return [s._asdict() for s in self.statements]
+
+
+class ProfiledConnection:
+    """
+    A DuckDB connection that records its statements in ``profiler``.
+
+    Statements are attributed to the methods of ``owner`` (the reducer)
+    on the call stack.  Everything but ``execute`` is passed through to
+    the wrapped connection; its cursors are not profiled.
+    """
+
+    def __init__(self, conn: duckdb.DuckDBPyConnection, profiler: SqlProfiler, owner: object):
+        self._conn = conn
+        self._profiler = profiler
+        self._owner = owner
+        self._conn.execute("PRAGMA enable_profiling = 'no_output'")
+        # duckdb_memory() is read on its own cursor: a query on this
+        # connection would replace the result the caller is about to fetch
+        self._memory = conn.cursor()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self) -> None:
+        self._memory.close()
+        self._conn.close()
+
+    def execute(self, query: str, parameters=None):
+        start = time.perf_counter()
+        result = (self._conn.execute(query) if parameters is None
+                  else self._conn.execute(query, parameters))
+        seconds = time.perf_counter() - start
+        self._record(query, seconds)
+        return result
+
+    # ------------------------------------------------------------------------
+
+    def _stack(self) -> str:
+        """Methods of the owner on the call stack, outermost first."""
+        names = []
+        frame = sys._getframe(2)
+        while frame is not None:
+            if frame.f_locals.get('self') is self._owner:
+                names.append(frame.f_code.co_name)
+            frame = frame.f_back
+        return ";".join(reversed(names)) or "(direct)"
+
+    def _record(self, query: str, seconds: float) -> None:
+        try:
+            profile = json.loads(self._conn.get_profiling_information(format='json'))
+        except (duckdb.Error, ValueError):
+            profile = None
+        if not profile or 'query_name' not in profile:
+            profile = None
+        memory = self._memory.execute(
+            "SELECT COALESCE(SUM(memory_usage_bytes), 0) FROM duckdb_memory()").fetchone()[0]
+        self._profiler.statements.append(StatementProfile(
+            stack=self._stack(),
+            sql=" ".join(query.split()),
+            seconds=seconds,
+            rows_in=int(profile.get('cumulative_rows_scanned', 0)) if profile else 0,
+            rows_out=_rows_out(profile) if profile else 0,
+            peak_buffer_bytes=int(profile.get('system_peak_buffer_memory', 0)) if profile else 0,
+            memory_bytes=int(memory),
+            profile=profile,
+        ))
+
+
+# ============================================================================
+# Summary
+# ============================================================================
+
+def _mb(size: int) -> str:
+    return f"{size / 2 ** 20:,.1f} MB"
+
+
+def format_profile(profiler: SqlProfiler, top: int = 10, width: int = 30) -> str:
+    """
+    Flame-style summary: time per call stack of the statements (below
+    the frames they all share), then the ``top`` slowest statements.
+    """
+    statements = profiler.statements
+    if not statements:
+        return "SQL PROFILE: no statements\n\n"
+    total = sum(s.seconds for s in statements)
+    # Stacks are shown below the frames all statements share (e.g. analyze_query)
+    frames = [s.stack.split(';') for s in statements]
+    shared = 0
+    while (all(len(f) > shared + 1 for f in frames)
+           and len({f[shared] for f in frames}) == 1):
+        shared += 1
+    by_stack: Dict[str, List[StatementProfile]] = {}
+    for s, f in zip(statements, frames):
+        by_stack.setdefault(";".join(f[shared:]), []).append(s)
+    stacks = sorted(by_stack.items(), key=lambda item: -sum(s.seconds for s in item[1]))
+
+    lines = [
+        f"SQL PROFILE ({len(statements)} statements, {total * 1000:,.1f} ms, "
+        f"peak memory {_mb(profiler.peak_memory_bytes)}):",
+        "-" * 70,
+    ]
+    for stack, group in stacks:
+        seconds = sum(s.seconds for s in group)
+        share = seconds / total if total > 0 else 0.0
+        bar = "█" * max(1, round(share * width)) if seconds > 0 else ""
+        lines.append(f"{bar:<{width}} {share:>6.1%} {seconds * 1000:>9.1f} ms  "
+                     f"{len(group):>4}x  {stack}")
+    lines.append("")
+    lines.append(f"{'Step':<24} {'ms':>9} {'Rows in':>12} {'Rows out':>12} {'Memory':>11}  SQL")
+    lines.append("-" * 70)
+    for s in sorted(statements, key=lambda s: -s.seconds)[:top]:
+        step = s.stack.rsplit(';', 1)[-1]
+        sql = s.sql if len(s.sql) <= 60 else s.sql[:57] + "..."
+        lines.append(f"{step[:24]:<24} {s.seconds * 1000:>9.1f} {s.rows_in:>12,} {s.rows_out:>12,} "
+                     f"{_mb(s.memory_bytes):>11}  {sql}")
+    lines.append("")
+    return "\n".join(lines) + "\n"
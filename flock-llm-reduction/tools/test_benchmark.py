@@ -0,0 +1,79 @@
+"""
+Unit tests for benchmark.py
+"""
+
+import pytest
+from benchmark import benchmark_query, format_run, hubs, previous_run
+from reduction_analyzer import QueryReducer
+
+
+def _run(commit, total, key_only=False):
+    return {
+        'timestamp': '2026-01-01T00:00:00+00:00', 'commit': commit, 'key_only': key_only, 'repeat': 1,
+        'results': [{'dataset': 'd', 'variant': 'samples', 'load': 0.01, 'queries': [
+            {'query': 'q1.sql', 'total': total, 'phases': {'parse': 0.001, 'having': 0.0}},
+            {'query': 'q2.sql', 'error': 'Binder Error: no such column\nLINE 1'},
+        ]}],
+    }
+
+
+# ================================
+# Run Tests
+# ================================
+
+class TestBenchmarkQuery:
+
+    def test_phases_and_total(self, tmp_path):
+        (tmp_path / "customers.csv").write_text("id,name\n1,Alice\n2,Bob\n")
+        (tmp_path / "orders.csv").write_text("id,customer_id\n10,1\n11,9\n")
+        query = tmp_path / "q.sql"
+        query.write_text("SELECT * FROM orders o JOIN customers c ON o.customer_id = c.id")
+        reducer = QueryReducer()
+        reducer.load_data_dynamic(str(tmp_path))
+
+        result = benchmark_query(reducer, query, repeat=2)
+        assert result['query'] == "q.sql"
+        assert result['phases']['semi_join_bottom_up'] <= result['total']
+        assert sum(result['phases'].values()) <= result['total']
+
+    def test_hubs(self, tmp_path):
+        star = tmp_path / "star.sql"
+        star.write_text("SELECT * FROM hub JOIN a ON hub.id = a.hub_id JOIN b ON hub.code = b.code")
+        chain = tmp_path / "chain.sql"
+        chain.write_text("SELECT * FROM a JOIN b ON a.id = b.a_id JOIN c ON b.id = c.b_id")
+        assert hubs(QueryReducer(), star) == {"hub": 2}
+        assert hubs(QueryReducer(), chain) == {}
+
+    def test_error_recorded(self, tmp_path):
+        result = benchmark_query(QueryReducer(), tmp_path / "missing.sql", repeat=1)
+        assert result['query'] == "missing.sql"
+        assert 'No such file' in result['error']
+
+
+# ================================
+# History Tests
+# ================================
+
+class TestHistory:
+
+    def test_previous_run_matches_settings(self):
+        history = [_run('a', 0.1), _run('b', 0.1, key_only=True), _run('c', 0.1)]
+        assert previous_run(history, _run('d', 0.1))['commit'] == 'c'
+        assert previous_run(history, _run('d', 0.1, key_only=True))['commit'] == 'b'
+        assert previous_run([], _run('d', 0.1)) is None
+
+    def test_pairwise_runs_compared_separately(self):
+        pairwise = dict(_run('b', 0.1), multiway=False)
+        assert previous_run([_run('a', 0.1), pairwise], _run('c', 0.1))['commit'] == 'a'
+        assert previous_run([_run('a', 0.1), pairwise], dict(_run('c', 0.1), multiway=False))['commit'] == 'b'
+        assert ", pairwise;" in format_run(pairwise, None)
+
+    def test_regression_flagged(self):
+        report = format_run(_run('b', 0.2), _run('a', 0.1))
+        assert "vs a" in report
+        assert "+100.0% ⚠ regression" in report
+        assert "⚠ Binder Error: no such column" in report
+
+    @pytest.mark.parametrize("total", [0.1, 0.104])
+    def test_small_changes_not_flagged(self, total):
+        assert "regression" not in format_run(_run('b', total), _run('a', 0.1))
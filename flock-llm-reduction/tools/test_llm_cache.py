@@ -0,0 +1,223 @@
+"""
+Unit tests for llm_cache.py
+"""
+
+import pytest
+import duckdb
+from llm_cache import LlmMemo, _split_args, distinct_context_query, find_calls, prepend_ctes
+
+_MODEL = "STRUCT(model_name VARCHAR)"
+_PROMPT = "STRUCT(prompt VARCHAR, context_columns STRUCT(data VARCHAR, name VARCHAR)[])"
+
+_QUERY = """
+SELECT b.id,
+  llm_complete({'model_name': 'm'},
+               {'prompt': 'Summarize', 'context_columns': [{'data': b.title, 'name': 'title'}]}) AS summary
+FROM books b JOIN tags t ON t.book_id = b.id
+WHERE t.tag = 'x'
+"""
+
+_COLUMNS = {('llm_complete', 'summary'): ('b.title',)}
+
+# ================================
+# Fixtures
+# ================================
+
+@pytest.fixture
+def conn():
+    """books(id, title) joined with tags(book_id, tag): book 1 has two 'x' tags."""
+    conn = duckdb.connect()
+    conn.execute("CREATE TABLE books AS SELECT * FROM (VALUES (1, 'Dune'), (2, 'Emma'), (3, 'Dune')) v(id, title)")
+    conn.execute("CREATE TABLE tags AS SELECT * FROM (VALUES (1, 'x'), (1, 'x'), (2, 'x'), (3, 'x'), (3, 'y')) v(book_id, tag)")
+    return conn
+
+
+@pytest.fixture
+def model_calls(conn):
+    """Stand-in llm_complete that counts its calls."""
+    pytest.importorskip("numpy")  # DuckDB Python UDFs need numpy
+    calls = []
+
+    def llm_complete(model, prompt):
+        calls.append(prompt['context_columns'][0]['data'])
+        return f"about {prompt['context_columns'][0]['data']}"
+
+    conn.create_function('llm_complete', llm_complete, [_MODEL, _PROMPT], 'VARCHAR',
+                         side_effects=True)
+    return calls
+
+
+# ================================
+# Call Site Tests
+# ================================
+
+class TestFindCalls:
+
+    def test_select_item_with_alias(self):
+        (call,) = find_calls(_QUERY)
+        assert (call.function, call.alias, call.in_select_list) == ('llm_complete', 'summary', True)
+        assert call.args[0] == "{'model_name': 'm'}"
+        assert _QUERY[call.start:call.end].startswith('llm_complete(')
+        assert _QUERY[call.start:call.end].endswith("}]})")
+
+    def test_call_inside_expression_is_not_an_item(self):
+        (call,) = find_calls("SELECT upper(llm_complete({'model_name': 'm'}, {'prompt': 'p'})) AS s FROM t")
+        assert call.alias == ''
+        assert call.in_select_list
+
+    def test_calls_outside_select_list(self):
+        calls = find_calls("""
+            SELECT s FROM (SELECT llm_complete({'model_name': 'm'}, {'prompt': 'p'}) AS s FROM t) q
+            WHERE llm_filter({'model_name': 'm'}, {'prompt': 'keep?'})
+        """)
+        assert [(c.function, c.in_select_list) for c in calls] == [
+            ('llm_complete', False), ('llm_filter', False)]
+
+    def test_strings_and_comments_ignored(self):
+        calls = find_calls("SELECT 'llm_complete(x)' AS s -- llm_filter(y)\nFROM t")
+        assert calls == []
+
+    def test_split_args_respects_nesting_and_strings(self):
+        assert _split_args("{'a': 1, 'b': [1, 2]}, 'x, y', f(1, 2)") == (
+            "{'a': 1, 'b': [1, 2]}", "'x, y'", "f(1, 2)")
+
+
+# ================================
+# Rewrite Tests
+# ================================
+
+class TestRewrite:
+
+    def test_not_memoized_reasons(self):
+        memo = LlmMemo()
+        assert memo.rewrite("SELECT * FROM t", "q", {}).reason == "no LLM calls"
+        assert memo.rewrite(
+            "SELECT * FROM t WHERE llm_filter({'model_name': 'm'}, {'prompt': 'p'})", "q", {}
+        ).reason == "LLM calls outside the outermost SELECT list"
+        assert memo.rewrite(
+            "SELECT llm_reduce({'model_name': 'm'}, {'prompt': 'p'}) AS r FROM t GROUP BY t.g", "q", {}
+        ).reason == "no per-row LLM call among the SELECT items"
+
+    def test_other_llm_calls_are_null_in_the_probe(self):
+        query = ("SELECT llm_complete({'model_name': 'm'}, {'prompt': 'p', 'context_columns': "
+                 "[{'data': t.a}]}) AS c, llm_reduce({'model_name': 'm'}, {'prompt': 'q'}) AS r "
+                 "FROM t GROUP BY t.a")
+        script = LlmMemo().rewrite(query, "q", {('llm_complete', 'c'): ('t.a',)}).script
+        assert "'t': {'a': t.a}} AS c, NULL AS r" in script
+        # The final query still aggregates with the model
+        assert script.rstrip().endswith("llm_reduce({'model_name': 'm'}, {'prompt': 'q'}) AS r FROM t GROUP BY t.a;")
+
+    def test_first_run_calls_once_per_distinct_context(self, conn, model_calls):
+        expected = sorted(conn.execute(_QUERY).fetchall())
+        assert len(model_calls) == 4
+        model_calls.clear()
+
+        script = LlmMemo().rewrite(_QUERY, "q", _COLUMNS).script
+        assert sorted(conn.execute(script).fetchall()) == expected
+        assert sorted(model_calls) == ["Dune", "Emma"]
+
+    def test_second_run_only_hits(self, conn, model_calls):
+        memo = LlmMemo()
+        script = memo.rewrite(_QUERY, "q", _COLUMNS).script
+        first = sorted(conn.execute(script).fetchall())
+        model_calls.clear()
+        assert sorted(conn.execute(script).fetchall()) == first
+        assert model_calls == []
+        assert memo.stats(conn) == [("q", "summary", 2, 2, 0.5)]
+        assert conn.execute("SELECT SUM(hits) FROM llm_memo").fetchone()[0] == 2
+
+    def test_filter_result_read_back_as_boolean(self, conn):
+        pytest.importorskip("numpy")
+        conn.create_function('llm_filter', lambda m, p: p['context_columns'][0]['data'] == 'Dune',
+                             [_MODEL, _PROMPT], 'BOOLEAN', side_effects=True)
+        query = ("SELECT b.id, llm_filter({'model_name': 'm'}, {'prompt': 'p', 'context_columns': "
+                 "[{'data': b.title, 'name': 't'}]}) AS keep FROM books b")
+        script = LlmMemo().rewrite(query, "q", {('llm_filter', 'keep'): ('b.title',)}).script
+        conn.execute(script)
+        assert sorted(conn.execute(script).fetchall()) == [(1, True), (2, False), (3, True)]
+
+    def test_contexts_sharing_a_key_stored_once(self, conn):
+        pytest.importorskip("numpy")
+        conn.create_function('llm_complete', lambda m, p: p['context_columns'][0]['data'],
+                             [_MODEL, _PROMPT], 'VARCHAR', side_effects=True)
+        conn.execute("INSERT INTO books VALUES (4, 'DUNE')")
+        query = ("SELECT b.id, llm_complete({'model_name': 'm'}, {'prompt': 'p', 'context_columns': "
+                 "[{'data': lower(b.title), 'name': 't'}]}) AS t FROM books b")
+        script = LlmMemo().rewrite(query, "q", {('llm_complete', 't'): ('b.title',)}).script
+        assert sorted(conn.execute(script).fetchall()) == [
+            (1, 'dune'), (2, 'emma'), (3, 'dune'), (4, 'dune')]
+
+
+# ================================
+# Distinct-Context Query Tests
+# ================================
+
+class TestDistinctContextQuery:
+
+    def test_calls_once_per_distinct_context(self, conn, model_calls):
+        expected = sorted(conn.execute(_QUERY).fetchall())
+        model_calls.clear()
+
+        result = distinct_context_query(_QUERY, _COLUMNS)
+        assert result.memoized == ["summary"]
+        assert result.script.startswith("WITH summary__contexts AS MATERIALIZED (")
+        assert sorted(conn.execute(result.script).fetchall()) == expected
+        assert sorted(model_calls) == ["Dune", "Emma"]
+
+    def test_joins_the_query_with_clause(self, conn, model_calls):
+        query = "WITH x AS (SELECT * FROM books)\n" + _QUERY.replace("FROM books b", "FROM x b")
+        expected = sorted(conn.execute(query).fetchall())
+        model_calls.clear()
+
+        script = distinct_context_query(query, _COLUMNS).script
+        assert script.startswith("WITH summary__contexts AS MATERIALIZED (")
+        assert "x AS (SELECT * FROM books)" in script
+        assert sorted(conn.execute(script).fetchall()) == expected
+        assert len(model_calls) == 2
+
+    def test_not_rewritten_reason(self):
+        assert distinct_context_query("SELECT * FROM t", {}).reason == "no LLM calls"
+
+    def test_prepend_ctes(self):
+        assert prepend_ctes("-- q\nSELECT 1", "a AS (SELECT 2)") == "-- q\nWITH a AS (SELECT 2)\nSELECT 1"
+        assert prepend_ctes("WITH b AS (SELECT 1) SELECT * FROM b", "a AS (SELECT 2)") == (
+            "WITH a AS (SELECT 2),\nb AS (SELECT 1) SELECT * FROM b")
+        assert prepend_ctes("VALUES (1)", "a AS (SELECT 2)") is None
+
+
+# ================================
+# Eviction Tests
+# ================================
+
+class TestEviction:
+
+    def _fill(self, conn, memo):
+        conn.execute(memo.setup_sql())
+        conn.execute(f"""
+            INSERT INTO {memo.table} VALUES
+            ('old',    'llm_complete', 'a', now() - INTERVAL 40 DAY, now() - INTERVAL 40 DAY, 0),
+            ('stale',  'llm_complete', 'b', now() - INTERVAL 2 DAY,  now() - INTERVAL 2 DAY,  0),
+            ('recent', 'llm_complete', 'c', now() - INTERVAL 2 DAY,  now(),                   3)
+        """)
+
+    def _keys(self, conn, memo):
+        return sorted(k for (k,) in conn.execute(f"SELECT key FROM {memo.table}").fetchall())
+
+    def test_ttl_drops_expired_entries(self, conn):
+        memo = LlmMemo(ttl_days=30)
+        self._fill(conn, memo)
+        conn.execute(memo.setup_sql())
+        assert self._keys(conn, memo) == ["recent", "stale"]
+
+    def test_lru_keeps_most_recently_used(self, conn):
+        memo = LlmMemo(ttl_days=None, capacity=1)
+        self._fill(conn, memo)
+        conn.execute(memo.eviction_sql())
+        assert self._keys(conn, memo) == ["recent"]
+
+    def test_limits_can_be_disabled(self, conn):
+        memo = LlmMemo(ttl_days=None, capacity=None)
+        self._fill(conn, memo)
+        conn.execute(memo.setup_sql())
+        assert memo.eviction_sql() is None
+        assert len(self._keys(conn, memo)) == 3
@@ -0,0 +1,85 @@
+"""
+Unit tests for llm_payload.py
+"""
+
+import pytest
+import duckdb
+from llm_payload import (CallPayload, TokenModel, TokenizerModel, batch_plan_sql, byte_length_sql,
+                         payload_bytes, tiktoken_model)
+
+# ================================
+# Token Model Tests
+# ================================
+
+class TestTokenModels:
+
+    def test_fixed_ratio(self):
+        model = TokenModel(0.3)
+        assert model.sample_size == 0
+        assert model.ratio(["anything"]) == 0.3
+        assert model.description == "~0.3 tokens per byte"
+
+    def test_tokenizer_ratio_measured_on_samples(self):
+        model = TokenizerModel(str.split, "words")
+        # 4 words in "a bb\nccc dddd" (13 bytes)
+        assert model.ratio(["a bb", "ccc dddd"]) == pytest.approx(4 / 13)
+        assert model.description == "tokens measured with words"
+
+    def test_tokenizer_without_samples_falls_back(self):
+        assert TokenizerModel(str.split, "words", tokens_per_byte=0.5).ratio([]) == 0.5
+
+    def test_tiktoken_model_needs_the_package(self):
+        pytest.importorskip("tiktoken")
+        assert tiktoken_model("cl100k_base").ratio(["hello world"]) > 0
+
+
+# ================================
+# Byte Count Tests
+# ================================
+
+class TestByteCounts:
+
+    def test_byte_length_sql_counts_utf8_text_of_values(self):
+        conn = duckdb.connect()
+        sql = byte_length_sql(["a", "b"])
+        rows = conn.execute(
+            f"SELECT {sql} FROM (VALUES ('é', 12), (NULL, 3)) v(a, b)").fetchall()
+        assert rows == [(4,), (1,)]
+        assert byte_length_sql([]) == "0"
+
+    def test_payload_bytes(self):
+        assert payload_bytes(10, 3, [5, 7]) == 42
+
+    def test_call_payload_tokens(self):
+        payload = CallPayload("c", 400, 100, None, 0.25, True)
+        assert payload.tokens(payload.after_bytes) == 25
+        assert payload.tokens(payload.distinct_bytes) is None
+
+
+# ================================
+# Batch Planning Tests
+# ================================
+
+class TestBatchPlanSql:
+
+    # 10 tuples of 10 tokens (40 bytes) each, and a single 1-token tuple
+    _GROUPS = "SELECT * FROM (VALUES (10, 400), (1, 4)) v(n, b)"
+
+    def test_batches_fill_the_window_next_to_the_prompt(self):
+        conn = duckdb.connect()
+        # 50 tokens left next to the prompt: 5 tuples per batch
+        sql = batch_plan_sql(self._GROUPS, prompt_tokens=10, tokens_per_byte=0.25,
+                             context_window=60, merge=False)
+        assert conn.execute(sql).fetchone() == (2, 11, 404, 3, 2)
+
+    def test_reduce_merges_batch_results(self):
+        conn = duckdb.connect()
+        sql = batch_plan_sql(self._GROUPS, prompt_tokens=10, tokens_per_byte=0.25,
+                             context_window=60, merge=True)
+        assert conn.execute(sql).fetchone() == (2, 11, 404, 4, 3)
+
+    def test_oversized_tuples_get_a_batch_each(self):
+        conn = duckdb.connect()
+        sql = batch_plan_sql(self._GROUPS, prompt_tokens=10, tokens_per_byte=0.25,
+                             context_window=5, merge=False)
+        assert conn.execute(sql).fetchone()[3] == 11
@@ -0,0 +1,193 @@
+"""
+Unit tests for llm_pipeline.py
+"""
+
+import time
+import asyncio
+import threading
+
+import pytest
+import duckdb
+from llm_cache import LlmMemo
+from llm_pipeline import (EndpointError, HttpEndpoint, LlmPipeline, MockEndpoint, ResultCache,
+                          TokenBucket, format_pipeline, serve_mock)
+from mock_flock import MockFlock
+
+_QUERY = """
+SELECT b.id,
+  llm_complete({'model_name': 'm'},
+               {'prompt': 'Summarize', 'context_columns': [{'data': b.title, 'name': 'title'}]}) AS summary,
+  llm_filter({'model_name': 'm'},
+             {'prompt': 'Keep?', 'context_columns': [{'data': b.title, 'name': 'title'}]}) AS keep
+FROM books b JOIN tags t ON t.book_id = b.id
+WHERE t.tag = 'x'
+"""
+
+_COLUMNS = {('llm_complete', 'summary'): ('b.title',), ('llm_filter', 'keep'): ('b.title',)}
+
+# ================================
+# Fixtures
+# ================================
+
+@pytest.fixture
+def conn():
+    """books(id, title) joined with tags(book_id, tag): two distinct titles tagged 'x'."""
+    conn = duckdb.connect()
+    conn.execute("CREATE TABLE books AS SELECT * FROM (VALUES (1, 'Dune'), (2, 'Emma'), (3, 'Dune')) v(id, title)")
+    conn.execute("CREATE TABLE tags AS SELECT * FROM (VALUES (1, 'x'), (1, 'x'), (2, 'x'), (3, 'x'), (3, 'y')) v(book_id, tag)")
+    return conn
+
+
+def _expected(conn):
+    """The query's rows with the mock functions evaluated by DuckDB."""
+    pytest.importorskip("numpy")  # DuckDB Python UDFs need numpy
+    MockFlock().register(conn)
+    return sorted(conn.execute(_QUERY).fetchall())
+
+
+# ================================
+# Rate Limiting and Cache Tests
+# ================================
+
+class TestTokenBucket:
+
+    def test_burst_then_rate(self):
+        async def take(n):
+            bucket = TokenBucket(rate=50, capacity=2)
+            start = time.monotonic()
+            for _ in range(n):
+                await bucket.acquire()
+            return time.monotonic() - start
+
+        assert asyncio.run(take(2)) < 0.02
+        # Two tokens at once, three more at 50 per second
+        assert asyncio.run(take(5)) >= 0.05
+
+
+class TestResultCache:
+
+    def test_results_survive_reopening(self, tmp_path):
+        cache = ResultCache(str(tmp_path / "results.jsonl"))
+        cache.put("a", "x")
+        cache.put("b", [1.0, 2.0])
+        reopened = ResultCache(str(tmp_path / "results.jsonl"))
+        assert len(reopened) == 2
+        assert reopened.get("b") == (True, [1.0, 2.0])
+        assert reopened.get("c") == (False, None)
+
+
+# ================================
+# Pipeline Tests
+# ================================
+
+class TestPipeline:
+
+    def test_results_match_the_query(self, conn):
+        expected = _expected(conn)
+        endpoint = MockEndpoint()
+        result = LlmPipeline(endpoint, concurrency=4, batch_size=1).run(
+            conn, _QUERY, _COLUMNS, output_table="results")
+        assert [(r.alias, r.requests, r.api_calls, r.failures) for r in result.calls] == [
+            ("summary", 2, 2, 0), ("keep", 2, 2, 0)]
+        assert endpoint.requests == 4
+        assert sorted(conn.execute("SELECT * FROM results").fetchall()) == expected
+        assert "llm_complete(" not in result.final
+
+    def test_second_run_sends_nothing(self, conn):
+        pipeline = LlmPipeline(MockEndpoint())
+        pipeline.run(conn, _QUERY, _COLUMNS)
+        result = pipeline.run(conn, _QUERY, _COLUMNS)
+        assert [r.requests for r in result.calls] == [0, 0]
+        assert conn.execute("SELECT COUNT(*) FROM llm_memo").fetchone()[0] == 4
+
+    def test_failures_are_retried(self, conn):
+        endpoint = MockEndpoint(failure_rate=0.5, seed=1)
+        result = LlmPipeline(endpoint, max_retries=10, backoff_s=0).run(conn, _QUERY, _COLUMNS)
+        assert sum(r.retries for r in result.calls) > 0
+        assert sum(r.failures for r in result.calls) == 0
+        assert endpoint.requests == sum(r.api_calls for r in result.calls)
+
+    def test_exhausted_retries_read_as_null(self, conn):
+        result = LlmPipeline(MockEndpoint(failure_rate=1.0), max_retries=1, backoff_s=0).run(
+            conn, _QUERY, _COLUMNS, output_table="results")
+        assert [(r.api_calls, r.retries, r.failures) for r in result.calls] == [(4, 2, 2), (4, 2, 2)]
+        assert conn.execute("SELECT COUNT(*) FROM results WHERE summary IS NULL").fetchone()[0] == 4
+        assert "Failed" in format_pipeline("q", result)
+
+    def test_disk_cache_answers_repeated_requests(self, conn, tmp_path):
+        path = str(tmp_path / "results.jsonl")
+        LlmPipeline(MockEndpoint(), memo=LlmMemo("memo_a"), cache=ResultCache(path)).run(
+            conn, _QUERY, _COLUMNS)
+        endpoint = MockEndpoint()
+        result = LlmPipeline(endpoint, memo=LlmMemo("memo_b"), cache=ResultCache(path)).run(
+            conn, _QUERY, _COLUMNS)
+        assert [r.cached for r in result.calls] == [2, 2]
+        assert endpoint.requests == 0
+
+    def test_results_written_off_the_event_loop(self, conn):
+        class RecordingConnection:
+            def __init__(self, conn):
+                self.conn = conn
+                self.threads = set()
+
+            def __getattr__(self, name):
+                return getattr(self.conn, name)
+
+            def executemany(self, *args):
+                self.threads.add(threading.get_ident())
+                return self.conn.executemany(*args)
+
+        recording = RecordingConnection(conn)
+        LlmPipeline(MockEndpoint(), batch_size=1).run(recording, _QUERY, _COLUMNS)
+        assert recording.threads and threading.get_ident() not in recording.threads
+        assert conn.execute("SELECT COUNT(*) FROM llm_memo").fetchone()[0] == 4
+
+    def test_limit_without_order_by_reads_the_probed_rows(self):
+        conn = duckdb.connect()
+        conn.execute("SET threads = 4")
+        conn.execute("CREATE TABLE t AS SELECT i, i % 1000 AS k FROM range(200000) r(i)")
+        conn.execute("CREATE TABLE u AS SELECT i AS k, 'v' || i AS v FROM range(70000) r(i)")
+        query = ("SELECT t.i, llm_complete({'model_name': 'm'}, {'prompt': 'p', 'context_columns': "
+                 "[{'data': CAST(t.i AS VARCHAR)}]}) AS note FROM t JOIN u ON t.k = u.k LIMIT 1000")
+        result = LlmPipeline(MockEndpoint(), concurrency=16).run(
+            conn, query, {('llm_complete', 'note'): ('t.i',)}, output_table="results")
+        assert [r.failures for r in result.calls] == [0]
+        assert conn.execute("SELECT COUNT(*), COUNT(note) FROM results").fetchone() == (1000, 1000)
+
+    def test_missing_memo_entries_are_failures(self, conn):
+        result = LlmPipeline(MockEndpoint(), memo=LlmMemo(capacity=1)).run(
+            conn, _QUERY, _COLUMNS, output_table="results")
+        # Only one of the four entries survives the eviction
+        assert sum(r.failures for r in result.calls) == 3
+        assert conn.execute("SELECT COUNT(*) FROM results WHERE summary IS NULL OR keep IS NULL"
+                            ).fetchone()[0] > 0
+
+    def test_not_run_reason(self, conn):
+        result = LlmPipeline(MockEndpoint()).run(conn, "SELECT * FROM books", {})
+        assert (result.final, result.reason) == (None, "no LLM calls")
+
+
+# ================================
+# HTTP Endpoint Tests
+# ================================
+
+class TestHttpEndpoint:
+
+    def test_pipeline_over_local_mock_server(self, conn):
+        expected = _expected(conn)
+        server = serve_mock(MockEndpoint())
+        try:
+            url = "http://%s:%d/" % server.server_address
+            LlmPipeline(HttpEndpoint(url), concurrency=2).run(conn, _QUERY, _COLUMNS, output_table="results")
+        finally:
+            server.shutdown()
+        assert sorted(conn.execute("SELECT * FROM results").fetchall()) == expected
+
+    def test_server_failure_raises_endpoint_error(self):
+        server = serve_mock(MockEndpoint(failure_rate=1.0))
+        try:
+            url = "http://%s:%d/" % server.server_address
+            with pytest.raises(EndpointError):
+                asyncio.run(HttpEndpoint(url)("llm_complete", '{"model_name":"m"}', '{"prompt":"p"}'))
+        finally:
+            server.shutdown()
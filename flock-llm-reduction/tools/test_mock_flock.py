@@ -0,0 +1,128 @@
+"""
+Unit tests for mock_flock.py
+"""
+
+import sys
+import json
+from pathlib import Path
+
+import pytest
+import duckdb
+from mock_flock import MockFlock, MockStats, format_runs, main, run_original_and_reduced, run_query
+from reduction_analyzer import QueryReducer
+
+pytest.importorskip("numpy")  # DuckDB Python UDFs need numpy
+
+_MODEL = "{'model_name': 'm'}"
+
+_OPENFLIGHTS = Path(__file__).resolve().parent.parent / "openflights"
+
+
+def _prompt(data: str) -> str:
+    return f"{{'prompt': 'p', 'context_columns': [{{'data': {data}, 'name': 'x'}}]}}"
+
+
+# ================================
+# Fixtures
+# ================================
+
+@pytest.fixture
+def conn():
+    """t(g, x): two groups of three and two rows."""
+    conn = duckdb.connect()
+    conn.execute("CREATE TABLE t AS SELECT * FROM (VALUES (1, 'a'), (1, 'b'), (1, 'c'), "
+                 "(2, 'd'), (2, 'e')) v(g, x)")
+    return conn
+
+
+@pytest.fixture
+def mock(conn):
+    mock = MockFlock(batch_size=2)
+    mock.register(conn)
+    return mock
+
+
+# ================================
+# Mock Function Tests
+# ================================
+
+class TestMockFunctions:
+
+    def test_scalar_calls_counted_per_batch(self, conn, mock):
+        rows = conn.execute(f"SELECT llm_complete({_MODEL}, {_prompt('x')}) FROM t").fetchall()
+        assert len(rows) == 5 and all(r[0].startswith("mock llm_complete ") for r in rows)
+        assert mock.stats() == [MockStats("llm_complete", 5, 3)]
+
+    def test_outputs_are_deterministic(self, conn, mock):
+        query = f"SELECT x, llm_filter({_MODEL}, {_prompt('x')}) FROM t ORDER BY x"
+        assert conn.execute(query).fetchall() == conn.execute(query).fetchall()
+        (embedding,) = conn.execute(f"SELECT llm_embedding({_MODEL}, {_prompt('x')}) "
+                                    f"FROM t WHERE x = 'a'").fetchone()
+        assert len(embedding) == mock.embedding_dim
+
+    def test_reduce_batches_and_merges_per_group(self, conn, mock):
+        rows = conn.execute(f"SELECT g, llm_reduce({_MODEL}, {_prompt('x')}) FROM t "
+                            f"GROUP BY g ORDER BY g").fetchall()
+        assert [g for g, _ in rows] == [1, 2]
+        # Group 1: 2 batches + merge; group 2: 1 batch
+        assert mock.stats() == [MockStats("llm_reduce", 5, 4)]
+
+    def test_rerank_is_independent_of_input_order(self, conn, mock):
+        asc, desc = (conn.execute(
+            f"SELECT llm_rerank({_MODEL}, {_prompt('x')}) FROM (SELECT * FROM t ORDER BY x {order})"
+        ).fetchone()[0] for order in ("ASC", "DESC"))
+        assert asc == desc
+        ranked = [c[0]["data"] for c in json.loads(asc)]
+        assert sorted(ranked) == ["a", "b", "c", "d", "e"]
+        first = conn.execute(f"SELECT llm_first({_MODEL}, {_prompt('x')}) FROM t").fetchone()[0]
+        last = conn.execute(f"SELECT llm_last({_MODEL}, {_prompt('x')}) FROM t").fetchone()[0]
+        assert json.loads(first)[0]["data"] == ranked[0]
+        assert json.loads(last)[0]["data"] == ranked[-1]
+
+    def test_reset(self, conn, mock):
+        conn.execute(f"SELECT llm_complete({_MODEL}, {_prompt('x')}) FROM t").fetchall()
+        mock.reset()
+        assert mock.stats() == []
+
+
+# ================================
+# End-to-End Run Tests
+# ================================
+
+class TestRuns:
+
+    def test_original_and_reduced_make_the_same_calls(self, tmp_path):
+        (tmp_path / "customers.csv").write_text("id,name\n1,Alice\n2,Bob\n3,Carol\n")
+        (tmp_path / "orders.csv").write_text("id,customer_id\n10,1\n11,1\n12,9\n")
+        reducer = QueryReducer()
+        reducer.load_data_dynamic(str(tmp_path))
+        mock = MockFlock()
+        mock.register(reducer.conn)
+        query = (f"SELECT o.id, llm_complete({_MODEL}, {_prompt('c.name')}) AS note "
+                 f"FROM orders o JOIN customers c ON o.customer_id = c.id")
+        original, reduced = run_original_and_reduced(reducer, mock, query)
+        assert (original.variant, reduced.variant) == ("original", "reduced")
+        for run in (original, reduced):
+            assert (run.rows, run.tuples, run.api_calls) == (2, 2, 2)
+        report = format_runs("q.sql", [original, reduced])
+        assert "Query: q.sql" in report
+        assert "   llm_complete: 2 tuples in 2 API calls" in report
+
+    def test_multi_statement_script(self, conn, mock):
+        run = run_query(conn, mock, "CREATE TABLE u AS SELECT 1 AS a; SELECT * FROM u;", "script")
+        assert (run.rows, run.stats) == (1, [])
+
+    def test_load_script_types_apply(self, monkeypatch, capsys):
+        """q05 passes r.stops next to VARCHAR struct fields: only load.sql's
+        all_varchar types bind it (CSV inference makes it BIGINT)."""
+        query = _OPENFLIGHTS / "sql" / "llm_queries" / "q05_rerank_airlines_longhaul.sql"
+        monkeypatch.setattr(sys, "argv", [
+            "mock_flock.py", str(query),
+            "--load-script", str(_OPENFLIGHTS / "sql" / "setup" / "load.sql")])
+        main()
+        out = capsys.readouterr().out
+        assert "Error running" not in out
+        rows = [line.split() for line in out.splitlines()
+                if line.startswith(("original ", "reduced "))]
+        assert [row[0] for row in rows] == ["original", "reduced"]
+        assert rows[0][2:5] == rows[1][2:5] == ["1", "1,068", "1,068"]
@@ -2,9 +2,18 @@
 Comprehensive unit tests for reduction_analyzer.py
 """
 
+import io
+import os
+import json
+import re
 import pytest
 import duckdb
-from reduction_analyzer import JoinGraph, QueryReducer
+from pathlib import Path
+from llm_cache import LlmMemo
+from llm_payload import TokenModel
+from reduction_analyzer import JoinGraph, LoadCache, QueryReducer, _split_conjuncts, setup_statements
+from sql_frontend import LlmCall
+from sql_profile import ProfiledConnection, SqlProfiler
 
 # ================================
 # Fixtures
@@ -129,13 +138,68 @@ class TestJoinGraph:
         """Tree: 3 nodes, 2 edges -> not cyclic."""
         graph.nodes = {"a", "b", "c"}
         graph.edges = [("a", "b", ""), ("b", "c", "")]
-        assert not graph.is_cyclic()  # 2 < 3
+        assert not graph.is_cyclic()
 
     def test_is_cyclic_triangle(self, graph):
         """Triangle: 3 nodes, 3 edges -> cyclic."""
         graph.nodes = {"a", "b", "c"}
         graph.edges = [("a", "b", ""), ("b", "c", ""), ("a", "c", "")]
-        assert graph.is_cyclic()  # 3 >= 3
+        assert graph.is_cyclic()
+
+    def test_is_cyclic_key_triangle(self, graph):
+        """Each pair joined on a different attribute -> cyclic."""
+        graph.nodes = {"a", "b", "c"}
+        graph.edges = [("a", "b", "a.b_id = b.id"), ("b", "c", "b.c_id = c.id"),
+                       ("c", "a", "c.a_id = a.id")]
+        assert graph.is_cyclic()
+        assert graph.join_tree() is None
+
+    def test_shared_attribute_triangle_is_acyclic(self, graph):
+        """All three edges on the same attribute -> α-acyclic despite 3 edges."""
+        graph.nodes = {"a", "b", "c"}
+        graph.edges = [("a", "b", "a.x = b.x"), ("b", "c", "b.x = c.x"),
+                       ("a", "c", "a.x = c.x")]
+        assert not graph.is_cyclic()
+        tree = graph.join_tree()
+        assert set(tree) == {"a", "b", "c"}
+        assert sum(parent is None for parent in tree.values()) == 1
+
+    def test_join_tree_star(self, graph):
+        graph.nodes = {"f", "d1", "d2"}
+        graph.edges = [("f", "d1", "f.d1_id = d1.id"), ("f", "d2", "f.d2_id = d2.id")]
+        tree = graph.join_tree()
+        assert tree["d1"] == "f" and tree["d2"] == "f"
+        assert tree["f"] is None
+
+    def test_join_tree_disconnected_components(self, graph):
+        graph.nodes = {"a", "b", "c"}
+        graph.edges = [("a", "b", "a.id = b.a_id")]
+        tree = graph.join_tree()
+        assert sum(parent is None for parent in tree.values()) == 2
+
+    def test_tree_join_condition_adds_transitive_key(self, graph):
+        """a and c share x only through b: the tree edge gets a derived equality."""
+        graph.nodes = {"a", "b", "c"}
+        graph.edges = [("a", "b", "a.x = b.x"), ("b", "c", "b.x = c.x")]
+        assert graph.tree_join_condition("a", "c") == "a.x = c.x"
+        assert graph.tree_join_condition("a", "b") == "a.x = b.x"
+
+    def test_tree_decomposition_triangle_is_one_bag(self, graph):
+        graph.nodes = {"a", "b", "c"}
+        graph.edges = [("a", "b", "a.b_id = b.id"), ("b", "c", "b.c_id = c.id"),
+                       ("c", "a", "c.a_id = a.id")]
+        assert graph.tree_decomposition() == [{"a", "b", "c"}]
+
+    def test_tree_decomposition_four_cycle_has_width_two(self, graph):
+        graph.nodes = {"a", "b", "c", "d"}
+        graph.edges = [("a", "b", "a.b_id = b.id"), ("b", "c", "b.c_id = c.id"),
+                       ("c", "d", "c.d_id = d.id"), ("d", "a", "d.a_id = a.id")]
+        bags = graph.tree_decomposition()
+        assert len(bags) == 2
+        assert all(len(bag) == 3 for bag in bags)
+        assert len(bags[0] & bags[1]) == 2
+        for t1, t2, _ in graph.edges:
+            assert any({t1, t2} <= bag for bag in bags)
 
     def test_is_cyclic_single_node_no_edge(self, graph):
         graph.nodes = {"a"}
@@ -143,10 +207,40 @@ class TestJoinGraph:
         assert not graph.is_cyclic()
 
     def test_is_cyclic_two_nodes_two_edges(self, graph):
-        """Multi-edge between same pair: 2 nodes, 2 edges -> cyclic."""
+        """Two conditions on the same pair form one composite edge -> not cyclic."""
         graph.nodes = {"a", "b"}
         graph.edges = [("a", "b", "x"), ("a", "b", "y")]
-        assert graph.is_cyclic()  # 2 >= 2
+        assert graph.edges == [("a", "b", "x AND y")]
+        assert not graph.is_cyclic()
+
+    def test_add_edge_merges_composite_key(self, graph):
+        graph.add_edge("r1", "r2", "r1.dst = r2.src")
+        graph.add_edge("r2", "r1", "r1.airline = r2.airline")
+        assert graph.edges == [("r1", "r2", "r1.dst = r2.src AND r1.airline = r2.airline")]
+        assert graph.get_join_condition("r2", "r1") == graph.edges[0][2]
+
+    def test_add_edge_ignores_repeated_conjunct(self, graph):
+        graph.add_edge("a", "b", "a.id = b.a_id")
+        graph.add_edge("a", "b", "a.id = b.a_id")
+        assert graph.edges == [("a", "b", "a.id = b.a_id")]
+
+    def test_get_join_keys_composite(self, graph):
+        graph.add_edge(
+            "r1", "r2",
+            "TRY_CAST(r1.dst AS INTEGER) = TRY_CAST(r2.src AS INTEGER) AND r2.airline = r1.airline"
+        )
+        assert graph.get_join_keys("r1", "r2") == [("dst", "src"), ("airline", "airline")]
+        assert graph.get_join_keys("r2", "r1") == [("src", "dst"), ("airline", "airline")]
+
+    def test_get_join_keys_skips_non_equalities(self, graph):
+        graph.add_edge("b1", "b2", "b1.authors = b2.authors AND b1.book_id < b2.book_id")
+        assert graph.get_join_keys("b1", "b2") == [("authors", "authors")]
+
+    def test_edges_setter_rebuilds_index(self, graph):
+        graph.add_edge("a", "b", "a.id = b.id")
+        graph.edges = [("c", "d", "c.id = d.id")]
+        assert graph.get_neighbors("a") == set()
+        assert graph.get_neighbors("c") == {"d"}
 
     def test_get_neighbors(self, graph):
         graph.nodes = {"a", "b", "c", "d"}
@@ -361,12 +455,101 @@ class TestParseJoinGraph:
         assert "books" in g.nodes
         assert "authors" in g.nodes
 
+    def test_composite_key_join_is_one_edge(self, reducer):
+        q = """
+            SELECT * FROM routes r1
+            JOIN routes r2
+              ON  TRY_CAST(r1.dst_airport_id AS INTEGER) = TRY_CAST(r2.src_airport_id AS INTEGER)
+              AND TRY_CAST(r1.airline_id AS INTEGER)     = TRY_CAST(r2.airline_id AS INTEGER)
+            JOIN airlines al ON TRY_CAST(r1.airline_id AS INTEGER) = TRY_CAST(al.airline_id AS INTEGER)
+        """
+        g = reducer.parse_join_graph(q)
+        assert len(g.edges) == 2
+        assert g.get_join_keys("r1", "r2") == [
+            ("dst_airport_id", "src_airport_id"), ("airline_id", "airline_id")
+        ]
+
+    def test_on_clause_referencing_two_earlier_tables(self, reducer):
+        """Each conjunct becomes an edge between the nodes it references."""
+        q = """
+            SELECT * FROM A a
+            JOIN B b ON a.id = b.a_id
+            JOIN C c ON c.a_id = a.id AND c.b_id = b.id
+        """
+        g = reducer.parse_join_graph(q)
+        assert g.get_join_condition("A", "C") == "C.a_id = A.id"
+        assert g.get_join_condition("B", "C") == "C.b_id = B.id"
+
+    def test_single_table_on_conjunct_kept_on_edge(self, reducer):
+        q = "SELECT * FROM A a JOIN B b ON a.id = b.a_id AND b.flag = 'Y'"
+        g = reducer.parse_join_graph(q)
+        assert g.get_join_condition("A", "B") == "A.id = B.a_id AND B.flag = 'Y'"
+
     def test_as_keyword_alias(self, reducer):
         q = "SELECT * FROM orders AS o JOIN customers AS c ON o.cid = c.id"
         g = reducer.parse_join_graph(q)
         assert g.aliases.get("orders") == "o"
         assert g.aliases.get("customers") == "c"
 
+    def test_outer_join_is_not_an_edge(self, reducer):
+        q = """
+            SELECT * FROM A a LEFT JOIN B b ON a.id = b.a_id
+            JOIN C c ON c.id = a.c_id
+            WHERE b.flag IS NULL AND a.x = 1
+        """
+        g = reducer.parse_join_graph(q)
+        assert [(t1, t2) for t1, t2, _ in g.edges] == [("C", "A")]
+        assert g.outer_joins == 1
+        assert g.nullable == {"B"}
+        assert g.unapplied == ["A.id = B.a_id", "B.flag IS NULL"]
+        assert dict(g.local_predicates) == {"A": ["A.x = 1"]}
+
+    def test_unresolved_on_conjunct_unapplied(self, reducer):
+        q = "SELECT * FROM A a JOIN B b ON a.id = b.a_id AND b.k IN (SELECT k FROM C)"
+        g = reducer.parse_join_graph(q)
+        assert len(g.edges) == 1
+        assert len(g.unapplied) == 1
+
+    def test_regex_fallback_outer_join(self, reducer, monkeypatch):
+        monkeypatch.setattr(reducer, "parse_query", lambda query: None)
+        q = """
+            SELECT * FROM A a LEFT OUTER JOIN B b ON a.id = b.a_id
+            JOIN C c ON c.id = a.c_id
+        """
+        g = reducer.parse_join_graph(q)
+        assert g.nodes == {"A", "B", "C"}
+        assert [(t1, t2) for t1, t2, _ in g.edges] == [("C", "A")]
+        assert g.nullable == {"B"}
+        assert g.unapplied == ["A.id = B.a_id"]
+
+
+# ================================
+# Conjunct Splitting Tests
+# ================================
+
+class TestSplitConjuncts:
+
+    def test_simple_and(self):
+        assert _split_conjuncts("a.x = b.x AND a.y = b.y") == ["a.x = b.x", "a.y = b.y"]
+
+    def test_between_kept_together(self):
+        assert _split_conjuncts("a.x BETWEEN 1 AND 5 AND a.y = 2") == [
+            "a.x BETWEEN 1 AND 5", "a.y = 2"
+        ]
+
+    def test_parenthesised_and_kept(self):
+        assert _split_conjuncts("(a.x = 1 AND a.y = 2) OR a.z = 3") == [
+            "(a.x = 1 AND a.y = 2) OR a.z = 3"
+        ]
+
+    def test_and_inside_string_kept(self):
+        assert _split_conjuncts("a.name = 'Tom AND Jerry' AND a.id = 1") == [
+            "a.name = 'Tom AND Jerry'", "a.id = 1"
+        ]
+
+    def test_identifier_containing_and(self):
+        assert _split_conjuncts("a.brand = b.brand") == ["a.brand = b.brand"]
+
 
 # ================================
 # Alias Resolution Tests
@@ -572,6 +755,196 @@ class TestYannakakisReduction:
         assert reductions["parents"][2] == 0.0
         assert reductions["children"][2] == 0.0
 
+    def test_shared_attribute_triangle_reduced_without_folding(self, reducer):
+        """a.x = b.x = c.x is α-acyclic: the full reducer keeps exactly x in all three."""
+        reducer.conn.execute("CREATE TABLE a (x INT)")
+        reducer.conn.execute("INSERT INTO a VALUES (1), (2), (3)")
+        reducer.conn.execute("CREATE TABLE b (x INT)")
+        reducer.conn.execute("INSERT INTO b VALUES (2), (3), (4)")
+        reducer.conn.execute("CREATE TABLE c (x INT)")
+        reducer.conn.execute("INSERT INTO c VALUES (3), (4), (5)")
+        reducer.table_sizes = {"a": 3, "b": 3, "c": 3}
+
+        g = JoinGraph()
+        for name in ("a", "b", "c"):
+            g.add_node(name)
+        g.add_edge("a", "b", "a.x = b.x")
+        g.add_edge("b", "c", "b.x = c.x")
+        g.add_edge("a", "c", "a.x = c.x")
+
+        assert not g.is_cyclic()
+        reductions = reducer.yannakakis_reduction(g)
+        for name in ("a", "b", "c"):
+            assert reductions[name][1] == 1
+
+
+# ================================
+# Multiway Semi-Join Tests
+# ================================
+
+@pytest.fixture
+def reducer_hub(reducer):
+    """
+    Hub joined to three leaves on different columns:
+    hub(id, code, name), a(hub_id), b(code), c(name).
+    Only hub row 1 is matched by all three leaves.
+    """
+    reducer.conn.execute("CREATE TABLE main.hub AS SELECT * FROM (VALUES "
+                         "(1, 'x', 'p'), (2, 'y', 'p'), (3, 'x', 'q'), (4, 'z', 'r')) v(id, code, name)")
+    reducer.conn.execute("CREATE TABLE main.a AS SELECT * FROM (VALUES (1), (2), (3), (9)) v(hub_id)")
+    reducer.conn.execute("CREATE TABLE main.b AS SELECT * FROM (VALUES ('x'), ('w')) v(code)")
+    reducer.conn.execute("CREATE TABLE main.c AS SELECT * FROM (VALUES ('p'), ('s')) v(name)")
+    reducer.table_sizes = {"hub": 4, "a": 4, "b": 2, "c": 2}
+    return reducer
+
+
+_HUB_QUERY = ("SELECT * FROM hub JOIN a ON hub.id = a.hub_id "
+              "JOIN b ON hub.code = b.code JOIN c ON hub.name = c.name")
+
+
+def _hub_graph():
+    g = JoinGraph()
+    for name in ("hub", "a", "b", "c"):
+        g.add_node(name)
+    g.add_edge("hub", "a", "hub.id = a.hub_id")
+    g.add_edge("hub", "b", "hub.code = b.code")
+    g.add_edge("hub", "c", "hub.name = c.name")
+    return g
+
+
+class TestMultiwaySemiJoin:
+
+    def test_same_reductions_as_pairwise(self, reducer_hub):
+        multiway = reducer_hub.yannakakis_reduction(_hub_graph())
+        reducer_hub._reset_scratch()
+        reducer_hub.multiway = False
+        assert reducer_hub.yannakakis_reduction(_hub_graph()) == multiway
+        assert {t: r[1] for t, r in multiway.items()} == {"hub": 1, "a": 1, "b": 1, "c": 1}
+
+    def test_hub_rewritten_once_per_pass(self, reducer_hub):
+        reducer_hub.conn = ProfiledConnection(reducer_hub.conn, SqlProfiler(), reducer_hub)
+        reducer_hub.yannakakis_reduction(_hub_graph())
+        rewrites = [s.sql for s in reducer_hub.conn._profiler.statements
+                    if s.sql.startswith('CREATE OR REPLACE TABLE _scratch."hub"')]
+        assert len(rewrites) == 1
+        assert rewrites[0].count("EXISTS") == 3
+
+    def test_failing_child_falls_back_to_pairwise(self, reducer_hub, capsys):
+        reducer_hub.semi_join_many("hub", [("a", "l.id = r.hub_id"), ("b", "l.code = r.missing")])
+        out = capsys.readouterr().out
+        assert "Multiway semi-join error (hub ⋉ a, b)" in out
+        assert "Semi-join error (hub ⋉ b)" in out
+        assert reducer_hub.conn.execute("SELECT COUNT(*) FROM hub").fetchone()[0] == 3
+
+    def test_key_only_matches_classic(self, reducer_hub):
+        classic = reducer_hub.yannakakis_reduction(_hub_graph())
+        reducer_hub._reset_scratch()
+        reducer_hub.key_only = True
+        assert reducer_hub.yannakakis_reduction(_hub_graph()) == classic
+
+    def test_reduction_ctes_one_step_per_hub(self, reducer_hub):
+        graph = reducer_hub.parse_join_graph(_HUB_QUERY, encode_keys=False)
+        steps, _ = reducer_hub.reduction_ctes(_HUB_QUERY, graph)
+        hub_steps = [select for name, select in steps if name.startswith("hub")]
+        assert len(hub_steps) == 1
+        assert hub_steps[0].count("EXISTS") == 3
+        reducer_hub.multiway = False
+        pairwise, _ = reducer_hub.reduction_ctes(_HUB_QUERY, graph)
+        assert len(pairwise) == len(steps) + 2
+        assert sorted(reducer_hub.conn.execute(_HUB_QUERY).fetchall()) == sorted(
+            reducer_hub.conn.execute(
+                "WITH " + ", ".join(f"{name} AS ({select})" for name, select in steps)
+                + " SELECT * FROM hub__reduced hub JOIN a__reduced a ON hub.id = a.hub_id "
+                  "JOIN b__reduced b ON hub.code = b.code JOIN c__reduced c ON hub.name = c.name"
+            ).fetchall())
+
+
+# ================================
+# Key-Only Semi-Join Tests
+# ================================
+
+@pytest.fixture
+def key_reducer():
+    """QueryReducer running semi-joins over key-only projections."""
+    return QueryReducer(db_path=":memory:", key_only=True)
+
+
+class TestKeyOnlyReduction:
+
+    def test_key_table_projects_only_join_columns(self, key_reducer):
+        key_reducer.conn.execute("CREATE TABLE orders (id INT, customer_id INT, note VARCHAR)")
+        key_reducer.conn.execute("CREATE TABLE customers (id INT, name VARCHAR)")
+        g = JoinGraph()
+        g.add_node("orders")
+        g.add_node("customers")
+        g.add_edge("orders", "customers", "orders.customer_id = customers.id")
+
+        key_reducer._build_key_tables(g)
+
+        cols = [c[0] for c in key_reducer.conn.execute('DESCRIBE "orders__keys"').fetchall()]
+        assert cols == ["__rid", "customer_id"]
+
+    def test_semi_join_keys_deletes_unmatched(self, key_reducer):
+        key_reducer.conn.execute("CREATE TABLE left_t__keys AS SELECT range AS __rid, range AS id FROM range(5)")
+        key_reducer.conn.execute("CREATE TABLE right_t__keys AS SELECT 0 AS __rid, 3 AS id")
+        key_reducer.semi_join_keys("left_t", "right_t", "l.id = r.id")
+        rows = key_reducer.conn.execute("SELECT __rid FROM left_t__keys").fetchall()
+        assert rows == [(3,)]
+
+    def test_chain_matches_classic_mode(self, key_reducer):
+        """Key-only mode gives the same A -> B -> C reduction as classic mode."""
+        key_reducer.conn.execute("CREATE TABLE C (id INT)")
+        key_reducer.conn.execute("INSERT INTO C VALUES (1), (2)")
+        key_reducer.conn.execute("CREATE TABLE B (id INT, c_id INT)")
+        key_reducer.conn.execute("INSERT INTO B VALUES (10, 1), (11, 2), (12, 3), (13, 999)")
+        key_reducer.conn.execute("CREATE TABLE A (id INT, b_id INT)")
+        key_reducer.conn.execute("""
+            INSERT INTO A VALUES (100, 10), (101, 11), (102, 12),
+                                 (103, 13), (104, 777), (105, 888)
+        """)
+        key_reducer.table_sizes = {"A": 6, "B": 4, "C": 2}
+
+        g = key_reducer.parse_join_graph(
+            "SELECT * FROM A a JOIN B b ON a.b_id = b.id JOIN C c ON b.c_id = c.id"
+        )
+        reductions = key_reducer.yannakakis_reduction(g)
+
+        assert reductions["A"][1] == 2
+        assert reductions["B"][1] == 2
+        assert reductions["C"][1] == 2
+
+    def test_materialize_rebuilds_full_rows(self, key_reducer):
+        key_reducer.conn.execute("CREATE TABLE orders (id INT, customer_id INT, note VARCHAR)")
+        key_reducer.conn.execute("INSERT INTO orders VALUES (1, 1, 'a'), (2, 9, 'b')")
+        key_reducer.conn.execute("CREATE TABLE customers (id INT)")
+        key_reducer.conn.execute("INSERT INTO customers VALUES (1)")
+        key_reducer.table_sizes = {"orders": 2, "customers": 1}
+        g = JoinGraph()
+        g.add_node("orders")
+        g.add_node("customers")
+        g.add_edge("orders", "customers", "orders.customer_id = customers.id")
+
+        reductions = key_reducer.yannakakis_reduction(g, materialize=True)
+
+        assert reductions["orders"] == (2, 1, 50.0)
+        assert key_reducer.conn.execute("SELECT * FROM orders").fetchall() == [(1, 1, 'a')]
+
+    def test_counts_only_leaves_tables_untouched(self, key_reducer):
+        key_reducer.conn.execute("CREATE TABLE orders (id INT, customer_id INT)")
+        key_reducer.conn.execute("INSERT INTO orders VALUES (1, 1), (2, 9)")
+        key_reducer.conn.execute("CREATE TABLE customers (id INT)")
+        key_reducer.conn.execute("INSERT INTO customers VALUES (1)")
+        key_reducer.table_sizes = {"orders": 2, "customers": 1}
+        g = JoinGraph()
+        g.add_node("orders")
+        g.add_node("customers")
+        g.add_edge("orders", "customers", "orders.customer_id = customers.id")
+
+        reductions = key_reducer.yannakakis_reduction(g, materialize=False)
+
+        assert reductions["orders"][1] == 1
+        assert key_reducer.conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0] == 2
+
 
 # ================================
 # Cyclic Graph Folding Tests
@@ -591,13 +964,13 @@ class TestFoldCyclicGraph:
         assert len(result.edges) == 1
 
     def test_triangle_gets_folded(self, reducer):
-        """3 nodes, 3 edges (triangle) -> should be folded to acyclic."""
-        reducer.conn.execute("CREATE TABLE x (id INT, y_id INT, z_id INT)")
-        reducer.conn.execute("INSERT INTO x VALUES (1, 1, 1)")
+        """Each pair joined on a different key (true cycle) -> folded to acyclic."""
+        reducer.conn.execute("CREATE TABLE x (id INT, y_id INT)")
+        reducer.conn.execute("INSERT INTO x VALUES (1, 1)")
         reducer.conn.execute("CREATE TABLE y (id INT, z_id INT)")
         reducer.conn.execute("INSERT INTO y VALUES (1, 1)")
-        reducer.conn.execute("CREATE TABLE z (id INT)")
-        reducer.conn.execute("INSERT INTO z VALUES (1)")
+        reducer.conn.execute("CREATE TABLE z (id INT, x_id INT)")
+        reducer.conn.execute("INSERT INTO z VALUES (1, 1)")
 
         g = JoinGraph()
         g.add_node("x")
@@ -605,13 +978,536 @@ class TestFoldCyclicGraph:
         g.add_node("z")
         g.add_edge("x", "y", "x.y_id = y.id")
         g.add_edge("y", "z", "y.z_id = z.id")
-        g.add_edge("x", "z", "x.z_id = z.id")
+        g.add_edge("z", "x", "z.x_id = x.id")
 
         assert g.is_cyclic()
         result = reducer.fold_cyclic_graph(g)
         assert not result.is_cyclic()
 
 
+@pytest.fixture
+def cycle_reducer(reducer):
+    """x -> y -> z -> x key cycle where y ⋈ z is the smallest estimated pair.
+
+    Tables live in main so analyze_query() can reset the scratch schema.
+    """
+    reducer.conn.execute("CREATE TABLE main.x (id INT, y_id INT, note VARCHAR)")
+    reducer.conn.execute("INSERT INTO main.x SELECT i % 10, i % 2, 'n' || i FROM range(20) t(i)")
+    reducer.conn.execute("CREATE TABLE main.y (id INT, z_id INT)")
+    reducer.conn.execute("INSERT INTO main.y VALUES (0, 0), (1, 1), (2, 2)")
+    reducer.conn.execute("CREATE TABLE main.z (id INT, x_id INT)")
+    reducer.conn.execute("INSERT INTO main.z VALUES (0, 0), (1, 5), (7, 7)")
+    reducer.table_sizes = {"x": 20, "y": 3, "z": 3}
+    return reducer
+
+
+def _cycle_graph() -> JoinGraph:
+    g = JoinGraph()
+    for name in ("x", "y", "z"):
+        g.add_node(name)
+    g.add_edge("x", "y", "x.y_id = y.id")
+    g.add_edge("y", "z", "y.z_id = z.id")
+    g.add_edge("z", "x", "z.x_id = x.id")
+    return g
+
+
+class TestCostBasedFolding:
+
+    def test_folds_smallest_estimated_pair(self, cycle_reducer):
+        result = cycle_reducer.fold_cyclic_graph(_cycle_graph())
+        assert result.nodes == {"x", "y_JOIN_z"}
+        assert result.folded == {"y_JOIN_z": ["y", "z"]}
+
+    def test_folded_table_keeps_row_ids_and_needed_columns(self, cycle_reducer):
+        cycle_reducer.fold_cyclic_graph(_cycle_graph())
+        columns = [row[0] for row in cycle_reducer.conn.execute("DESCRIBE y_JOIN_z").fetchall()]
+        assert sorted(columns) == ["y__id", "y__rid", "z__rid", "z__x_id"]
+
+    def test_remaining_edge_rewritten_to_folded_columns(self, cycle_reducer):
+        result = cycle_reducer.fold_cyclic_graph(_cycle_graph())
+        cond = result.get_join_condition("x", "y_JOIN_z")
+        assert "y_JOIN_z.y__id" in cond and "y_JOIN_z.z__x_id" in cond
+
+    @pytest.mark.parametrize("key_only", [False, True])
+    def test_reductions_reported_per_original_table(self, cycle_reducer, key_only):
+        cycle_reducer.key_only = key_only
+        graph = cycle_reducer.fold_cyclic_graph(_cycle_graph())
+        reductions = cycle_reducer.yannakakis_reduction(graph, materialize=False)
+
+        # Cycles close through x.id 0 (two rows, y0, z0) and 5 (two rows, y1, z1)
+        assert set(reductions) == {"x", "y", "z"}
+        assert reductions["x"][:2] == (20, 4)
+        assert reductions["y"][:2] == (3, 2)
+        assert reductions["z"][:2] == (3, 2)
+
+    def test_analyze_query_applies_predicates_before_folding(self, cycle_reducer, tmp_path, capsys):
+        query = tmp_path / "cycle.sql"
+        query.write_text(
+            "SELECT x.note FROM x JOIN y ON x.y_id = y.id "
+            "JOIN z ON y.z_id = z.id AND z.x_id = x.id WHERE x.note = 'n10'"
+        )
+        cycle_reducer.analyze_query(str(query), show_queries=False)
+        out = capsys.readouterr().out
+
+        assert "CYCLIC" in out
+        for table, original in (("x", 20), ("y", 3), ("z", 3)):
+            assert re.search(rf"^{table}\s+{original}\s+1\s", out, re.MULTILINE)
+
+
+# ================================
+# Tree Decomposition Tests
+# ================================
+
+@pytest.fixture
+def four_cycle_reducer(reducer):
+    """a -> b -> c -> d -> a key cycle plus a leaf e hanging off a."""
+    for name, ref in (("a", "b"), ("b", "c"), ("c", "d"), ("d", "a"), ("e", "a")):
+        reducer.conn.execute(f"CREATE TABLE main.{name} (id INT, {ref}_id INT)")
+    reducer.conn.execute("INSERT INTO main.a SELECT i, i % 4 FROM range(12) t(i)")
+    reducer.conn.execute("INSERT INTO main.b SELECT i, i % 3 FROM range(6) t(i)")
+    reducer.conn.execute("INSERT INTO main.c SELECT i, i % 5 FROM range(6) t(i)")
+    reducer.conn.execute("INSERT INTO main.d SELECT i, i % 6 FROM range(8) t(i)")
+    reducer.conn.execute("INSERT INTO main.e SELECT i, i % 7 FROM range(10) t(i)")
+    reducer.table_sizes = {"a": 12, "b": 6, "c": 6, "d": 8, "e": 10}
+    return reducer
+
+
+def _four_cycle_graph() -> JoinGraph:
+    g = JoinGraph()
+    for name in ("a", "b", "c", "d", "e"):
+        g.add_node(name)
+    g.add_edge("a", "b", "a.b_id = b.id")
+    g.add_edge("b", "c", "b.c_id = c.id")
+    g.add_edge("c", "d", "c.d_id = d.id")
+    g.add_edge("d", "a", "d.a_id = a.id")
+    g.add_edge("e", "a", "e.a_id = a.id")
+    return g
+
+
+def _participating_rows(conn, name: str) -> int:
+    """Rows of ``name`` that appear in the full join, computed directly."""
+    return conn.execute(f"""
+        SELECT COUNT(DISTINCT {name}.rowid) FROM a, b, c, d, e
+        WHERE a.b_id = b.id AND b.c_id = c.id AND c.d_id = d.id
+          AND d.a_id = a.id AND e.a_id = a.id
+    """).fetchone()[0]
+
+
+class TestTreeDecomposition:
+
+    def test_core_replaced_by_bags(self, four_cycle_reducer):
+        graph = four_cycle_reducer.decompose_cyclic_graph(_four_cycle_graph())
+        bags = sorted(n for n in graph.nodes if n in graph.folded)
+        assert graph.nodes == set(bags) | {"e"}
+        assert len(bags) == 2
+        assert not graph.is_cyclic()
+
+    def test_bags_keep_row_ids_and_outer_key_columns(self, four_cycle_reducer):
+        graph = four_cycle_reducer.decompose_cyclic_graph(_four_cycle_graph())
+        (bag,) = graph.get_neighbors("e")
+        columns = {row[0] for row in four_cycle_reducer.conn.execute(f"DESCRIBE {bag}").fetchall()}
+        assert columns == {f"{m}__rid" for m in graph.folded[bag]} | {"a__id"}
+
+    @pytest.mark.parametrize("key_only", [False, True])
+    def test_reduction_matches_full_join(self, four_cycle_reducer, key_only):
+        four_cycle_reducer.key_only = key_only
+        graph = four_cycle_reducer.decompose_cyclic_graph(_four_cycle_graph())
+        reductions = four_cycle_reducer.yannakakis_reduction(graph, materialize=False)
+
+        assert set(reductions) == {"a", "b", "c", "d", "e"}
+        for name in reductions:
+            expected = _participating_rows(four_cycle_reducer.conn, name)
+            assert reductions[name][1] == expected, name
+
+    def test_analyze_query_uses_decomposition(self, four_cycle_reducer, tmp_path, capsys):
+        query = tmp_path / "cycle.sql"
+        query.write_text(
+            "SELECT * FROM a JOIN b ON a.b_id = b.id JOIN c ON b.c_id = c.id "
+            "JOIN d ON c.d_id = d.id AND d.a_id = a.id JOIN e ON e.a_id = a.id"
+        )
+        four_cycle_reducer.analyze_query(str(query), show_queries=False)
+        out = capsys.readouterr().out
+
+        assert "tree decomposition (2 bags, width 2)" in out
+        assert "folding" not in out
+
+
+# ================================
+# Join Result Count Tests
+# ================================
+
+class TestCountJoinResult:
+
+    def test_duplicates_multiply(self, reducer_with_two_tables):
+        r = reducer_with_two_tables
+        graph = r.parse_join_graph(
+            "SELECT * FROM orders o JOIN customers c ON o.customer_id = c.id")
+        # customer 1 has two orders, customer 2 one
+        assert r.count_join_result(graph) == (3, True)
+
+    def test_chain_matches_brute_force(self, reducer_chain):
+        r = reducer_chain
+        r.conn.execute("INSERT INTO A VALUES (106, 10), (107, 10)")
+        graph = r.parse_join_graph(
+            "SELECT * FROM A JOIN B ON A.b_id = B.id JOIN C ON B.c_id = C.id")
+        expected = r.conn.execute(
+            "SELECT COUNT(*) FROM A JOIN B ON A.b_id = B.id JOIN C ON B.c_id = C.id"
+        ).fetchone()[0]
+        assert r.count_join_result(graph) == (expected, True)
+        assert expected == 4
+
+    def test_non_equality_condition_counted_exactly(self, reducer):
+        reducer.conn.execute("CREATE TABLE main.ratings AS SELECT i % 5 AS user_id, i AS book_id FROM range(40) t(i)")
+        reducer.table_sizes = {"ratings": 40}
+        graph = reducer.parse_join_graph(
+            "SELECT * FROM ratings r1 JOIN ratings r2 "
+            "ON r1.user_id = r2.user_id AND r1.book_id < r2.book_id")
+        reducer._prepare_self_join_tables(graph)
+        # 5 users with 8 books each: 28 ordered pairs per user
+        assert reducer.count_join_result(graph) == (5 * 28, True)
+
+    @pytest.mark.parametrize("op", ["<", "<=", ">", ">="])
+    def test_comparison_with_duplicates_and_nulls(self, reducer, op):
+        reducer.conn.execute("""
+            CREATE TABLE main.ratings AS
+            SELECT i % 4 AS user_id, CASE WHEN i % 9 = 0 THEN NULL ELSE i % 6 END AS book_id
+            FROM range(60) t(i)
+        """)
+        reducer.table_sizes = {"ratings": 60}
+        query = (f"SELECT * FROM ratings r1 JOIN ratings r2 "
+                 f"ON r1.user_id = r2.user_id AND r1.book_id {op} r2.book_id")
+        graph = reducer.parse_join_graph(query)
+        reducer._prepare_self_join_tables(graph)
+        expected = reducer.conn.execute(f"SELECT COUNT(*) FROM {query[14:]}").fetchone()[0]
+        assert reducer.count_join_result(graph) == (expected, True)
+
+    def test_cross_product_of_components(self, reducer_with_two_tables):
+        r = reducer_with_two_tables
+        graph = r.parse_join_graph("SELECT * FROM orders o CROSS JOIN customers c")
+        assert r.count_join_result(graph) == (20, True)
+
+    def test_key_tables_after_reduction(self, reducer_chain):
+        r = reducer_chain
+        r.key_only = True
+        graph = r.parse_join_graph(
+            "SELECT * FROM A JOIN B ON A.b_id = B.id JOIN C ON B.c_id = C.id")
+        r.yannakakis_reduction(graph, materialize=False)
+        assert r.count_join_result(graph, key_tables=True) == (2, True)
+
+    def test_decomposed_cycle(self, four_cycle_reducer):
+        r = four_cycle_reducer
+        expected = r.conn.execute("""
+            SELECT COUNT(*) FROM a, b, c, d, e
+            WHERE a.b_id = b.id AND b.c_id = c.id AND c.d_id = d.id
+              AND d.a_id = a.id AND e.a_id = a.id
+        """).fetchone()[0]
+        graph = r.decompose_cyclic_graph(_four_cycle_graph())
+        assert r.count_join_result(graph) == (expected, True)
+
+    def test_work_tables_dropped(self, reducer_chain):
+        r = reducer_chain
+        graph = r.parse_join_graph(
+            "SELECT * FROM A JOIN B ON A.b_id = B.id JOIN C ON B.c_id = C.id")
+        r.count_join_result(graph)
+        tables = r.conn.execute(
+            "SELECT table_name FROM duckdb_tables() WHERE table_name LIKE '%__w'").fetchall()
+        assert tables == []
+
+    def test_count_groups_single_node(self, reducer_with_two_tables):
+        r = reducer_with_two_tables
+        graph = r.parse_join_graph(
+            "SELECT * FROM orders o JOIN customers c ON o.customer_id = c.id")
+        r.yannakakis_reduction(graph)
+        assert r.count_groups(graph, ["customers.id"]) == (2, True)
+        assert r.count_groups(graph, ["customers.id", "orders.id"]) == (None, False)
+
+    @pytest.mark.parametrize("key_only", [False, True])
+    def test_count_distinct_contexts(self, reducer_chain, key_only):
+        r = reducer_chain
+        r.key_only = key_only
+        graph = r.parse_join_graph(
+            "SELECT * FROM A JOIN B ON A.b_id = B.id JOIN C ON B.c_id = C.id")
+        r.yannakakis_reduction(graph, materialize=not key_only)
+        assert r.count_distinct_contexts(graph, ["A.id"]) == 2
+        assert r.count_distinct_contexts(graph, ["C.id * 0"]) == 1
+        # A and C are joined through B
+        assert r.count_distinct_contexts(graph, ["A.id", "C.id"]) == 2
+        assert r.count_distinct_contexts(graph, ["'constant'"]) is None
+
+    def test_estimate_payload(self, loaded_reducer):
+        r = loaded_reducer
+        graph = r.parse_join_graph(
+            "SELECT * FROM orders o JOIN customers c ON o.customer_id = c.id")
+        r.yannakakis_reduction(graph)
+        call = LlmCall("llm_complete", "SELECT", "note", "Hi", ("c.name", "o.id"), "",
+                       ("customers.name", "CAST(orders.id AS VARCHAR)"))
+        (payload,) = r.estimate_payload(graph, [call], [], TokenModel(2.0))
+        # The join sends (Alice, 10) and (Alice, 11), the prompt once per
+        # join row, both over the base tables and over the reduced ones
+        assert payload.before_bytes == 2 * 2 + 10 + 4
+        assert payload.after_bytes == 2 * 2 + 10 + 4
+        assert payload.distinct_bytes == 2 * 2 + 10 + 4
+        assert payload.tokens(payload.after_bytes) == 36
+        assert payload.exact
+
+    def test_estimate_payload_fan_out(self, loaded_reducer):
+        r = loaded_reducer
+        graph = r.parse_join_graph(
+            "SELECT * FROM orders o JOIN customers c ON o.customer_id = c.id")
+        r.yannakakis_reduction(graph)
+        call = LlmCall("llm_complete", "SELECT", "note", "Hi", ("c.name",), "",
+                       ("customers.name",))
+        (payload,) = r.estimate_payload(graph, [call], [], TokenModel(2.0))
+        # Alice's two orders send her name twice, but it is one context
+        assert payload.after_bytes == 2 * 2 + 2 * 5
+        assert payload.distinct_bytes == 2 + 5
+        assert payload.before_bytes >= payload.after_bytes > payload.distinct_bytes
+
+    def test_estimate_payload_aggregate_per_group(self, loaded_reducer):
+        r = loaded_reducer
+        graph = r.parse_join_graph(
+            "SELECT * FROM orders o JOIN customers c ON o.customer_id = c.id")
+        r.yannakakis_reduction(graph)
+        call = LlmCall("llm_reduce", "SELECT", "summary", "Hi", ("c.name",), "",
+                       ("customers.name",))
+        # Alice twice, the prompt once per order id or once in total
+        (grouped,) = r.estimate_payload(graph, [call], ["orders.id"], TokenModel(2.0))
+        (single,) = r.estimate_payload(graph, [call], [], TokenModel(2.0))
+        assert grouped.after_bytes == 2 * 2 + 2 * 5
+        assert single.after_bytes == 2 + 2 * 5
+        assert grouped.distinct_bytes is None
+
+    def test_plan_batches(self, loaded_reducer):
+        r = loaded_reducer
+        query = ("SELECT c.name, llm_reduce({'model_name': 'm'}, {'prompt': 'p', 'context_columns': "
+                 "[{'data': CAST(o.id AS VARCHAR)}]}) AS summary "
+                 "FROM orders o JOIN customers c ON o.customer_id = c.id {where} GROUP BY c.name")
+        for where, tuples in (("", 2), ("WHERE o.id + c.id > 11", 1)):
+            graph = r.parse_join_graph(query.replace("{where}", where))
+            r.yannakakis_reduction(graph)
+            calls = r.parse_query(query.replace("{where}", where)).llm_calls
+            (plan,) = r.plan_batches(graph, calls, ["customers.name"], TokenModel(1.0), 100)
+            assert (plan.label, plan.groups, plan.tuples, plan.api_calls, plan.exact) == (
+                "summary", 1, tuples, 1, True)
+            # The prompt plus two bytes per order id
+            assert plan.tokens == 1 + 2 * tuples
+            r._reset_scratch()
+
+    def test_report_marks_unapplied_condition(self, loaded_reducer, tmp_path, capsys):
+        r = loaded_reducer
+        r.conn.execute("CREATE TABLE main.regions AS SELECT 1 AS id, 'Alice' AS owner")
+        r.table_sizes["regions"] = 1
+        query_file = tmp_path / "q.sql"
+        query_file.write_text(
+            "SELECT * FROM orders o JOIN customers c ON o.customer_id = c.id "
+            "JOIN regions g ON g.id = c.id WHERE g.owner != o.customer_id::VARCHAR"
+        )
+        r.analyze_query(str(query_file), show_queries=False)
+        out = capsys.readouterr().out
+        assert re.search(r"^JOIN RESULT +2 +rows \(upper bound, 1 condition", out, re.MULTILINE)
+
+    def test_report_marks_groups_upper_bound(self, loaded_reducer, tmp_path, capsys):
+        r = loaded_reducer
+        query_file = tmp_path / "q.sql"
+        query_file.write_text(
+            "SELECT c.name, COUNT(*) FROM orders o JOIN customers c ON o.customer_id = c.id "
+            "WHERE o.id + c.id > 11 GROUP BY c.name"
+        )
+        report = r.analyze_query(str(query_file), show_queries=False)
+        out = capsys.readouterr().out
+        assert (report.groups, report.groups_exact) == (1, False)
+        assert re.search(r"^GROUPS +1 +GROUP BY groups \(upper bound, 1 condition", out, re.MULTILINE)
+
+    def test_outer_join_count_not_exact(self, loaded_reducer, tmp_path, capsys):
+        r = loaded_reducer
+        query = "SELECT * FROM customers c LEFT JOIN orders o ON c.id = o.customer_id"
+        assert r.count_join_result(r.parse_join_graph(query)) == (9, False)
+        query_file = tmp_path / "q.sql"
+        query_file.write_text(query)
+        report = r.analyze_query(str(query_file), show_queries=False)
+        out = capsys.readouterr().out
+        assert (report.join_exact, report.outer_joins) == (False, 1)
+        assert re.search(r"^JOIN RESULT +9 +rows \(estimate, 1 outer join", out, re.MULTILINE)
+
+    def test_dropped_on_conjunct_count_not_exact(self, loaded_reducer):
+        r = loaded_reducer
+        graph = r.parse_join_graph(
+            "SELECT * FROM orders o JOIN customers c ON o.customer_id = c.id "
+            "AND c.id IN (SELECT 1)"
+        )
+        assert r.count_join_result(graph) == (2, False)
+
+
+# ================================
+# Reduced Query Rewrite Tests
+# ================================
+
+class TestRewriteReducedQuery:
+
+    def _rewrite(self, r, query):
+        graph = r.parse_join_graph(r.remove_llm_calls(query), encode_keys=False)
+        return r.rewrite_reduced_query(query, graph)
+
+    def test_tables_replaced_and_llm_call_kept(self, loaded_reducer):
+        query = (
+            "SELECT o.id, llm_complete({'model_name': 'm'}, "
+            "{'prompt': 'p', 'context_columns': [{'data': c.name}]}) AS note "
+            "FROM orders o JOIN customers c ON o.customer_id = c.id WHERE c.name <> 'Bob'"
+        )
+        rewritten, replaced = self._rewrite(loaded_reducer, query)
+        assert replaced == ["customers", "orders"]
+        assert "FROM orders__reduced o JOIN customers__reduced c" in rewritten
+        assert "llm_complete({'model_name': 'm'}" in rewritten
+        assert rewritten.startswith("WITH customers__0 AS MATERIALIZED (")
+
+    def test_same_rows_as_baseline_with_duplicates(self, loaded_reducer):
+        r = loaded_reducer
+        r.conn.execute("INSERT INTO main.orders VALUES (10, 1)")
+        baseline = "SELECT o.id, c.name FROM orders o JOIN customers c ON o.customer_id = c.id"
+        rewritten, _ = self._rewrite(r, baseline)
+        assert r.verify_reduced_query(baseline, rewritten) == (3, 3, 0)
+
+    @pytest.mark.parametrize("script, pattern, rows", [
+        ("q1_reduce.sql", r"CREATE TEMP TABLE res_base AS\s*(.*?);", 15),
+        ("q2_reduce.sql", r"CREATE TEMP TABLE res2_base AS\s*(.*?);", 2),
+    ])
+    def test_manual_reduction_toy_db(self, reducer, script, pattern, rows):
+        """The baselines of manual-reduction/ over its toy_db.sql."""
+        manual = Path(__file__).resolve().parents[2] / "manual-reduction"
+        reducer.run_load_script(str(manual / "toy_db.sql"))
+        baseline = re.search(pattern, (manual / script).read_text(), re.DOTALL).group(1)
+        rewritten, replaced = self._rewrite(reducer, baseline)
+        assert replaced == ["d", "edges", "s"]
+        assert reducer.verify_reduced_query(baseline, rewritten) == (rows, rows, 0)
+
+    def test_unaliased_table_gets_alias(self, loaded_reducer):
+        r = loaded_reducer
+        query = ("SELECT customers.name FROM orders "
+                 "JOIN customers ON orders.customer_id = customers.id")
+        rewritten, _ = self._rewrite(r, query)
+        assert "FROM orders__reduced AS orders" in rewritten
+        assert "JOIN customers__reduced AS customers ON" in rewritten
+        assert sorted(r.conn.execute(rewritten).fetchall()) == [("Alice",), ("Alice",)]
+
+    def test_existing_with_clause_extended(self, loaded_reducer):
+        r = loaded_reducer
+        query = ("WITH paid AS (SELECT o.id, c.name FROM orders o "
+                 "JOIN customers c ON o.customer_id = c.id) SELECT * FROM paid")
+        rewritten, replaced = self._rewrite(r, query)
+        assert replaced == ["customers", "orders"]
+        assert rewritten.startswith("WITH orders__reduced AS MATERIALIZED (")
+        assert ",\npaid AS (SELECT o.id, c.name FROM orders__reduced o" in rewritten
+        assert sorted(r.conn.execute(rewritten).fetchall()) == [(10, "Alice"), (11, "Alice")]
+
+    def test_query_cte_joined_as_table_not_rewritten(self, loaded_reducer):
+        query = ("WITH named AS (SELECT * FROM customers WHERE customers.name IS NOT NULL) "
+                 "SELECT o.id FROM orders o JOIN named n ON o.customer_id = n.id")
+        assert self._rewrite(loaded_reducer, query) == (None, [])
+
+    def test_table_also_read_by_subquery_kept(self, loaded_reducer):
+        query = ("SELECT o.id FROM orders o JOIN customers c ON o.customer_id = c.id "
+                 "WHERE o.customer_id IN (SELECT id FROM customers)")
+        rewritten, replaced = self._rewrite(loaded_reducer, query)
+        assert replaced == ["orders"]
+        assert "(SELECT id FROM customers)" in rewritten
+        assert "JOIN customers c" in rewritten
+
+    def test_self_join_occurrences_mapped_by_alias(self, loaded_reducer):
+        r = loaded_reducer
+        query = ("SELECT o1.id, o2.id FROM orders o1 JOIN orders o2 "
+                 "ON o1.customer_id = o2.customer_id WHERE o2.id > 10")
+        rewritten, replaced = self._rewrite(r, query)
+        assert replaced == ["o1", "o2"]
+        assert "FROM orders AS o2 WHERE o2.id > 10" in rewritten
+        assert "FROM o1__reduced o1 JOIN o2__reduced o2" in rewritten
+        assert sorted(r.conn.execute(rewritten).fetchall()) == [(10, 11), (11, 11), (12, 12)]
+
+    def test_analyze_query_writes_and_verifies(self, loaded_reducer, tmp_path, capsys):
+        r = loaded_reducer
+        r.rewrite = r.verify = True
+        query_file = tmp_path / "queries" / "q.sql"
+        query_file.parent.mkdir()
+        query_file.write_text(
+            "SELECT c.name, llm_complete({'model_name': 'm'}, "
+            "{'prompt': 'p', 'context_columns': [{'data': c.name}]}) AS note "
+            "FROM orders o JOIN customers c ON o.customer_id = c.id LIMIT 1"
+        )
+        r.analyze_query(str(query_file), show_queries=False)
+        out = capsys.readouterr().out
+        written = (tmp_path / "queries" / "reduced" / "q.sql").read_text()
+        assert written.startswith("-- Semi-join reduced form of ../q.sql")
+        assert "llm_complete(" in written
+        assert "(2 of 2 tables reduced)" in out
+        assert "✅ Same result as the baseline without LIMIT (2 rows)" in out
+
+    def test_left_join_preserved_side_not_reduced(self, loaded_reducer):
+        r = loaded_reducer
+        query = "SELECT * FROM customers c LEFT JOIN orders o ON c.id = o.customer_id"
+        assert self._rewrite(r, query) == (None, [])
+        query += " WHERE c.name <> 'Bob'"
+        rewritten, replaced = self._rewrite(r, query)
+        assert replaced == ["customers"]
+        assert r.verify_reduced_query(query, rewritten) == (3, 3, 0)
+
+    def test_outer_join_unknown_to_graph_not_rewritten(self, loaded_reducer):
+        r = loaded_reducer
+        query = ("SELECT * FROM orders o LEFT JOIN customers c ON o.customer_id = c.id "
+                 "WHERE o.id > 10")
+        graph = r.parse_join_graph("SELECT * FROM orders o JOIN customers c "
+                                   "ON o.customer_id = c.id WHERE o.id > 10", encode_keys=False)
+        assert r.rewrite_reduced_query(query, graph) == (None, [])
+
+    def test_analyze_query_does_not_write_unverified(self, loaded_reducer, tmp_path,
+                                                     capsys, monkeypatch):
+        r = loaded_reducer
+        r.rewrite = r.verify = True
+        monkeypatch.setattr(r, "verify_reduced_query", lambda baseline, reduced: (3, 1, 2))
+        query_file = tmp_path / "queries" / "q.sql"
+        query_file.parent.mkdir()
+        query_file.write_text("SELECT * FROM orders o JOIN customers c ON o.customer_id = c.id")
+        r.analyze_query(str(query_file), show_queries=False)
+        out = capsys.readouterr().out
+        assert not (tmp_path / "queries" / "reduced" / "q.sql").exists()
+        assert "REDUCED QUERY: not written (2 of 2 tables reduced)" in out
+        assert "❌ Result differs from the baseline: 1 rows vs 3, 2 not in both" in out
+
+    def test_analyze_query_writes_memoized_reduced_query(self, loaded_reducer, tmp_path, capsys):
+        r = loaded_reducer
+        r.rewrite = True
+        r.memo = LlmMemo(table="memo")
+        query_file = tmp_path / "queries" / "q.sql"
+        query_file.parent.mkdir()
+        query_file.write_text(
+            "SELECT o.id, llm_complete({'model_name': 'm'}, "
+            "{'prompt': 'p', 'context_columns': [{'data': c.name}]}) AS note "
+            "FROM orders o JOIN customers c ON o.customer_id = c.id"
+        )
+        r.analyze_query(str(query_file), show_queries=False)
+        out = capsys.readouterr().out
+        written = (tmp_path / "queries" / "memoized" / "q.sql").read_text()
+        assert "MEMOIZED QUERY:" in out and "(note looked up in memo)" in out
+        assert "CREATE TABLE IF NOT EXISTS memo (" in written
+        assert "FROM orders__reduced o JOIN customers__reduced c" in written
+
+    def test_analyze_query_reports_and_deduplicates_contexts(self, loaded_reducer, tmp_path, capsys):
+        r = loaded_reducer
+        r.dedup = True
+        query_file = tmp_path / "queries" / "q.sql"
+        query_file.parent.mkdir()
+        query_file.write_text(
+            "SELECT o.id, llm_complete({'model_name': 'm'}, "
+            "{'prompt': 'p', 'context_columns': [{'data': c.name}]}) AS note "
+            "FROM orders o JOIN customers c ON o.customer_id = c.id"
+        )
+        r.analyze_query(str(query_file), show_queries=False)
+        out = capsys.readouterr().out
+        assert "CONTEXTS             1            distinct for note (llm_complete), 2.00 rows each" in out
+        written = (tmp_path / "queries" / "deduplicated" / "q.sql").read_text()
+        assert "(note once per distinct context)" in out
+        assert written.startswith("-- ../q.sql with each LLM call run once per distinct context")
+        assert "WITH note__contexts AS MATERIALIZED (" in written
+
+
 # ================================
 # Selection Pushdown Tests
 # ================================
@@ -757,6 +1653,573 @@ class TestHavingAwareReduction:
         assert reductions["children"][1] == 3
 
 
+# ================================
+# Per-Query Isolation Tests
+# ================================
+
+@pytest.fixture
+def loaded_reducer(reducer, tmp_path):
+    """QueryReducer with orders/customers loaded from CSV into the base schema."""
+    (tmp_path / "customers.csv").write_text("id,name\n1,Alice\n2,Bob\n3,Carol\n")
+    (tmp_path / "orders.csv").write_text("id,customer_id\n10,1\n11,1\n12,9\n")
+    reducer.load_data_dynamic(str(tmp_path))
+    return reducer
+
+
+class TestQueryIsolation:
+
+    def test_semi_join_leaves_base_table_untouched(self, loaded_reducer):
+        r = loaded_reducer
+        r.semi_join("orders", "customers", "l.customer_id = r.id")
+        assert r.conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0] == 2
+        assert r.conn.execute("SELECT COUNT(*) FROM main.orders").fetchone()[0] == 3
+
+    def test_reset_scratch_restores_base_view(self, loaded_reducer):
+        r = loaded_reducer
+        r.semi_join("orders", "customers", "l.customer_id = r.id")
+        r._reset_scratch()
+        assert r.conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0] == 3
+
+    def test_no_snapshot_copies_created(self, loaded_reducer):
+        tables = {
+            row[0] for row in loaded_reducer.conn.execute(
+                "SELECT table_name FROM information_schema.tables"
+            ).fetchall()
+        }
+        assert tables == {"orders", "customers"}
+
+    def test_repeated_analysis_is_isolated(self, loaded_reducer, tmp_path, capsys):
+        query_file = tmp_path / "q.sql"
+        query_file.write_text(
+            "SELECT * FROM orders o JOIN customers c ON o.customer_id = c.id "
+            "WHERE c.name = 'Bob'"
+        )
+        loaded_reducer.analyze_query(str(query_file), show_queries=False)
+        first = capsys.readouterr().out
+        loaded_reducer.analyze_query(str(query_file), show_queries=False)
+        second = capsys.readouterr().out
+        assert first == second
+        assert loaded_reducer.conn.execute("SELECT COUNT(*) FROM main.customers").fetchone()[0] == 3
+
+
+# ================================
+# Load Cache Tests
+# ================================
+
+class TestLoadCache:
+
+    def _load(self, data_dir, cache_dir):
+        r = QueryReducer(db_path=":memory:")
+        r.load_data_dynamic(str(data_dir), cache_dir=str(cache_dir))
+        return r
+
+    def test_second_load_hits_cache(self, tmp_path):
+        data = tmp_path / "data"
+        data.mkdir()
+        (data / "items.csv").write_text("id,price\n1,5.0\n2,7.5\n")
+        first = self._load(data, tmp_path / "cache")
+        second = self._load(data, tmp_path / "cache")
+        assert first.load_stats["items"]["source"] == "csv"
+        assert second.load_stats["items"]["source"] == "cache"
+        assert second.table_sizes == {"items": 2}
+        assert (second.conn.execute("SELECT * FROM items ORDER BY id").fetchall()
+                == first.conn.execute("SELECT * FROM items ORDER BY id").fetchall())
+
+    def test_cached_types_match_csv(self, tmp_path):
+        data = tmp_path / "data"
+        data.mkdir()
+        (data / "items.csv").write_text("id,price,name\n1,5.0,a\n2,7.5,b\n")
+        first = self._load(data, tmp_path / "cache")
+        second = self._load(data, tmp_path / "cache")
+        assert (second.conn.execute("DESCRIBE items").fetchall()
+                == first.conn.execute("DESCRIBE items").fetchall())
+
+    def test_changed_file_is_reparsed(self, tmp_path):
+        data = tmp_path / "data"
+        data.mkdir()
+        csv = data / "items.csv"
+        csv.write_text("id\n1\n")
+        self._load(data, tmp_path / "cache")
+        csv.write_text("id\n1\n2\n3\n")
+        r = self._load(data, tmp_path / "cache")
+        assert r.load_stats["items"]["source"] == "csv"
+        assert r.table_sizes == {"items": 3}
+        assert len(list((tmp_path / "cache").glob("items-*.parquet"))) == 1
+
+    def test_touched_but_unchanged_file_hits_cache(self, tmp_path):
+        data = tmp_path / "data"
+        data.mkdir()
+        csv = data / "items.csv"
+        csv.write_text("id\n1\n")
+        self._load(data, tmp_path / "cache")
+        st = csv.stat()
+        os.utime(csv, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        r = self._load(data, tmp_path / "cache")
+        assert r.load_stats["items"]["source"] == "cache"
+
+    def test_manifest_records_hash(self, tmp_path):
+        data = tmp_path / "data"
+        data.mkdir()
+        csv = data / "items.csv"
+        csv.write_text("id\n1\n")
+        self._load(data, tmp_path / "cache")
+        entry = LoadCache(str(tmp_path / "cache")).entries[str(csv.resolve())]
+        assert entry["sha256"] == LoadCache.file_hash(csv)
+        assert entry["size"] == csv.stat().st_size
+
+
+# ================================
+# Typed Join Key Tests
+# ================================
+
+@pytest.fixture
+def varchar_reducer(reducer):
+    """Routes/airports with VARCHAR keys, like the all_varchar load scripts."""
+    reducer.conn.execute("""
+        CREATE TABLE main.airports AS
+        SELECT * FROM (VALUES ('1', 'JFK', 'US'), ('2', 'CDG', 'FR'), ('3', 'LHR', 'UK'))
+            t(airport_id, iata, country)
+    """)
+    reducer.conn.execute("""
+        CREATE TABLE main.routes AS
+        SELECT * FROM (VALUES ('1', 'JFK', '2', 'CDG'), ('2', 'CDG', '3', 'LHR'),
+                              ('1', 'JFK', '\\N', 'XXX'))
+            t(src_airport_id, src_code, dst_airport_id, dst_code)
+    """)
+    reducer.table_sizes = {"airports": 3, "routes": 3}
+    return reducer
+
+
+class TestTypedJoinKeys:
+
+    def _query_file(self, tmp_path, sql):
+        f = tmp_path / "q.sql"
+        f.write_text(sql)
+        return str(f)
+
+    def test_cast_keys_become_integer_columns(self, varchar_reducer, tmp_path):
+        q = self._query_file(tmp_path, """
+            SELECT * FROM routes r
+            JOIN airports ap ON TRY_CAST(r.dst_airport_id AS INTEGER) = TRY_CAST(ap.airport_id AS INTEGER)
+        """)
+        encodings = varchar_reducer.encode_join_keys([q])
+        assert encodings[("routes", "dst_airport_id", "INTEGER")] == "dst_airport_id__integer"
+        types = varchar_reducer._column_types("routes")
+        assert types["dst_airport_id__integer"] == "INTEGER"
+
+    def test_string_keys_share_dictionary(self, varchar_reducer, tmp_path):
+        q = self._query_file(tmp_path, """
+            SELECT * FROM routes r JOIN airports ap ON r.dst_code = ap.iata
+        """)
+        varchar_reducer.encode_join_keys([q])
+        rows = varchar_reducer.conn.execute("""
+            SELECT r.dst_code, r.dst_code__dict, ap.iata__dict
+            FROM routes r JOIN airports ap ON r.dst_code = ap.iata
+            ORDER BY 1
+        """).fetchall()
+        assert [row[0] for row in rows] == ["CDG", "LHR"]
+        assert all(row[1] == row[2] for row in rows)
+
+    def test_self_join_dictionary_keeps_row_count(self, varchar_reducer, tmp_path):
+        """A single-column dictionary must not repeat values ('JFK' occurs twice)."""
+        q = self._query_file(tmp_path, """
+            SELECT * FROM routes r1 JOIN routes r2 ON r1.src_code = r2.src_code
+        """)
+        varchar_reducer.encode_join_keys([q])
+        assert varchar_reducer.conn.execute("SELECT COUNT(*) FROM routes").fetchone()[0] == 3
+
+    def test_join_condition_rewritten(self, varchar_reducer, tmp_path):
+        sql = """
+            SELECT * FROM routes r
+            JOIN airports ap ON TRY_CAST(r.dst_airport_id AS INTEGER) = TRY_CAST(ap.airport_id AS INTEGER)
+        """
+        varchar_reducer.encode_join_keys([self._query_file(tmp_path, sql)])
+        g = varchar_reducer.parse_join_graph(sql)
+        assert g.edges[0][2] == "routes.dst_airport_id__integer = airports.airport_id__integer"
+
+    def test_reduction_unchanged_by_encoding(self, varchar_reducer, tmp_path):
+        sql = """
+            SELECT * FROM routes r
+            JOIN airports ap ON TRY_CAST(r.dst_airport_id AS INTEGER) = TRY_CAST(ap.airport_id AS INTEGER)
+            WHERE ap.country = 'FR'
+        """
+        before = varchar_reducer.parse_join_graph(sql)
+        varchar_reducer._apply_local_predicates(sql, before)
+        expected = varchar_reducer.yannakakis_reduction(before)
+        varchar_reducer._reset_scratch()
+
+        varchar_reducer.encode_join_keys([self._query_file(tmp_path, sql)])
+        after = varchar_reducer.parse_join_graph(sql)
+        varchar_reducer._apply_local_predicates(sql, after)
+        assert varchar_reducer.yannakakis_reduction(after) == expected
+
+    def test_second_call_keeps_existing_encodings(self, varchar_reducer, tmp_path):
+        q = self._query_file(tmp_path, """
+            SELECT * FROM routes r
+            JOIN airports ap ON TRY_CAST(r.dst_airport_id AS INTEGER) = TRY_CAST(ap.airport_id AS INTEGER)
+            JOIN airports a2 ON r.dst_code = a2.iata
+        """)
+        first = dict(varchar_reducer.encode_join_keys([q]))
+        columns = varchar_reducer._column_types("routes")
+        assert varchar_reducer.encode_join_keys([q]) == first
+        assert varchar_reducer._column_types("routes") == columns
+
+    def test_dictionary_extended_by_later_query(self, varchar_reducer, tmp_path):
+        first = tmp_path / "q1.sql"
+        first.write_text("SELECT * FROM routes r JOIN airports ap ON r.dst_code = ap.iata")
+        varchar_reducer.encode_join_keys([str(first)])
+        # Joins airports.iata, and through it routes.dst_code, with airports.country
+        second = tmp_path / "q2.sql"
+        second.write_text("SELECT * FROM airports a1 JOIN airports a2 ON a1.iata = a2.country")
+        varchar_reducer.encode_join_keys([str(second)])
+        assert varchar_reducer.conn.execute("""
+            SELECT COUNT(*), bool_and(r.dst_code__dict = ap.iata__dict)
+            FROM routes r JOIN airports ap ON r.dst_code = ap.iata
+        """).fetchone() == (2, True)
+
+    def test_base_tables_not_modified(self, varchar_reducer, tmp_path):
+        r = varchar_reducer
+        columns = {t: r._column_types(t) for t in ("routes", "airports")}
+        r.encode_join_keys([self._query_file(tmp_path, """
+            SELECT * FROM routes r
+            JOIN airports ap ON TRY_CAST(r.dst_airport_id AS INTEGER) = TRY_CAST(ap.airport_id AS INTEGER)
+            JOIN routes r2 ON r.src_code = r2.src_code
+        """)])
+        assert r.base_schema == "_keys"
+        for table, types in columns.items():
+            assert {row[0]: row[1] for row in r.conn.execute(
+                f"DESCRIBE main.{table}").fetchall()} == types
+        assert "src_code__dict" in r._column_types("routes")
+
+    def test_attached_database(self, production_db, tmp_path):
+        r = QueryReducer(out=io.StringIO())
+        r.attach_database(production_db)
+        sql = ("SELECT * FROM orders o JOIN customers c "
+               "ON CAST(o.customer_id AS BIGINT) = CAST(c.id AS BIGINT) WHERE c.name = 'Alice'")
+        encodings = r.encode_join_keys([self._query_file(tmp_path, sql)])
+        assert encodings[("orders", "customer_id", "BIGINT")] == "customer_id__bigint"
+        assert "customer_id__bigint" not in {
+            row[0] for row in r.conn.execute("DESCRIBE source.main.orders").fetchall()}
+        graph = r.parse_join_graph(sql)
+        r._apply_local_predicates(sql, graph)
+        assert graph.edges[0][2] == "orders.customer_id__bigint = customers.id__bigint"
+        assert r.yannakakis_reduction(graph) == {
+            "orders": (3, 2, pytest.approx(100 / 3)), "customers": (3, 1, pytest.approx(200 / 3))}
+
+    def test_mixed_cast_left_alone(self, varchar_reducer, tmp_path):
+        sql = "SELECT * FROM routes r JOIN airports ap ON TRY_CAST(r.dst_airport_id AS INTEGER) = ap.airport_id"
+        assert varchar_reducer.encode_join_keys([self._query_file(tmp_path, sql)]) == {}
+
+
+# ================================
+# Parallel Analysis Tests
+# ================================
+
+class TestParallelAnalysis:
+
+    def _write_queries(self, tmp_path):
+        files = []
+        for i, name in enumerate(["Alice", "Bob", "Carol", "Nobody"]):
+            f = tmp_path / f"q{i}.sql"
+            f.write_text(
+                "SELECT * FROM orders o JOIN customers c ON o.customer_id = c.id "
+                f"WHERE c.name = '{name}'"
+            )
+            files.append(str(f))
+        return files
+
+    def test_spawn_worker_shares_base_tables(self, loaded_reducer):
+        worker = loaded_reducer.spawn_worker(0)
+        assert worker.scratch_schema != loaded_reducer.scratch_schema
+        assert worker.table_sizes == loaded_reducer.table_sizes
+        assert worker.conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0] == 3
+
+    def test_worker_scratch_is_private(self, loaded_reducer):
+        worker = loaded_reducer.spawn_worker(0)
+        worker.semi_join("orders", "customers", "l.customer_id = r.id")
+        assert worker.conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0] == 2
+        assert loaded_reducer.conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0] == 3
+
+    def test_parallel_reports_match_sequential_order(self, loaded_reducer, tmp_path):
+        files = self._write_queries(tmp_path)
+        sequential = list(loaded_reducer.analyze_queries(files, jobs=1))
+        parallel = list(loaded_reducer.analyze_queries(files, jobs=3))
+        assert parallel == sequential
+        for f, report in zip(files, parallel):
+            assert f"Query: {f.rsplit('/', 1)[-1]}" in report
+
+    def test_missing_file_reported_in_place(self, loaded_reducer, tmp_path):
+        files = self._write_queries(tmp_path)[:2]
+        files.insert(1, str(tmp_path / "missing.sql"))
+        reports = list(loaded_reducer.analyze_queries(files, jobs=2))
+        assert "File not found" in reports[1]
+        assert "TUPLE REDUCTION ANALYSIS" in reports[2]
+
+    def test_reports_in_input_order(self, loaded_reducer, tmp_path):
+        files = self._write_queries(tmp_path)
+        files.insert(1, str(tmp_path / "missing.sql"))
+        loaded_reducer.text = False
+        reports = list(loaded_reducer.analyze_reports(files, jobs=2))
+        assert [r.query for r in reports] == ["q0.sql", "missing.sql", "q1.sql", "q2.sql", "q3.sql"]
+        assert reports[1].error.startswith("File not found")
+        assert [(n.table, n.original, n.reduced) for n in reports[0].nodes] == [
+            ("customers", 3, 1), ("orders", 3, 2)]
+        assert reports[0].mode == 'semi-join'
+        assert reports[0].join_rows == 2
+
+    def test_text_off_prints_nothing(self, loaded_reducer, tmp_path, capsys):
+        query = tmp_path / "q.sql"
+        query.write_text("SELECT * FROM orders o CROSS JOIN customers c LIMIT 5")
+        loaded_reducer.text = False
+        report = loaded_reducer.analyze_query(str(query))
+        assert capsys.readouterr().out == ""
+        assert report.warnings == ["Query contains LIMIT 5.", "Query contains a CROSS JOIN."]
+        assert report.timings is loaded_reducer.timings
+
+    def test_profile_summary_and_files(self, tmp_path):
+        (tmp_path / "customers.csv").write_text("id,name\n1,Alice\n2,Bob\n")
+        (tmp_path / "orders.csv").write_text("id,customer_id\n10,1\n11,9\n")
+        reducer = QueryReducer(profile=True, profile_dir=str(tmp_path / "profiles"))
+        reducer.load_data_dynamic(str(tmp_path))
+        query = self._write_queries(tmp_path)[0]
+        (report,) = reducer.analyze_queries([query])
+        assert "SQL PROFILE (" in report
+        assert "yannakakis_reduction;semi_join" in report
+        statements = json.loads((tmp_path / "profiles" / "q0.profile.json").read_text())
+        assert any(s['stack'].endswith("semi_join") for s in statements)
+
+    def test_analyze_records_phase_timings(self, loaded_reducer, tmp_path):
+        query = self._write_queries(tmp_path)[0]
+        list(loaded_reducer.analyze_queries([query]))
+        timings = loaded_reducer.timings
+        for phase in ('strip_llm', 'parse', 'local_predicates', 'semi_join_bottom_up',
+                      'semi_join_top_down', 'counting', 'report'):
+            assert timings[phase] >= 0
+        assert 'fold' not in timings
+
+
+# ================================
+# Estimate Mode Tests
+# ================================
+
+@pytest.fixture
+def sampled_reducer(reducer):
+    """
+    fact(id, dim_id, tag_id) -> dim(id, flag) and fact -> tag(id): 4,000
+    fact rows over 400 dims (every other one flagged) and 50 tags, so the
+    two join attributes need separate sample passes.
+    """
+    reducer.conn.execute("CREATE TABLE main.dim AS SELECT i AS id, i % 2 AS flag FROM range(400) t(i)")
+    reducer.conn.execute("CREATE TABLE main.tag AS SELECT i AS id FROM range(0, 50) t(i)")
+    reducer.conn.execute("""
+        CREATE TABLE main.fact AS
+        SELECT i AS id, (i * 7) % 450 AS dim_id, i % 60 AS tag_id FROM range(4000) t(i)
+    """)
+    reducer.table_sizes = {"fact": 4000, "dim": 400, "tag": 50}
+    return reducer
+
+
+_SAMPLED_QUERY = """
+    SELECT * FROM fact f
+    JOIN dim d ON f.dim_id = d.id
+    JOIN tag t ON f.tag_id = t.id
+    WHERE d.flag = 1
+"""
+
+
+def _exact_reductions(reducer, query):
+    reducer._reset_scratch()
+    graph = reducer.parse_join_graph(query)
+    reducer._apply_local_predicates(query, graph)
+    return reducer.yannakakis_reduction(graph, materialize=False)
+
+
+class TestEstimateReduction:
+
+    def test_full_rate_is_exact(self, sampled_reducer):
+        exact = _exact_reductions(sampled_reducer, _SAMPLED_QUERY)
+        estimate, intervals = sampled_reducer.estimate_reduction(_SAMPLED_QUERY, 1.0)
+        assert estimate == exact
+        assert all(low == high == estimate[t][1] for t, (low, high) in intervals.items())
+
+    @pytest.mark.parametrize("rate", [0.1, 0.3])
+    def test_exact_counts_inside_intervals(self, sampled_reducer, rate):
+        exact = _exact_reductions(sampled_reducer, _SAMPLED_QUERY)
+        estimate, intervals = sampled_reducer.estimate_reduction(_SAMPLED_QUERY, rate)
+        assert set(estimate) == {"fact", "dim", "tag"}
+        for table, (_, reduced, _) in exact.items():
+            low, high = intervals[table]
+            assert low <= reduced <= high, table
+
+    def test_sample_keeps_whole_key_groups(self, sampled_reducer):
+        graph = sampled_reducer.parse_join_graph(_SAMPLED_QUERY)
+        sampled_reducer._reset_scratch()
+        sampled_reducer._build_sampled_tables(
+            graph, {}, {"fact": "fact.dim_id", "dim": "dim.id"}, 0.25)
+        conn = sampled_reducer.conn
+        kept = {row[0] for row in conn.execute("SELECT id FROM dim").fetchall()}
+        assert 0 < len(kept) < 400
+        # Every fact row of a kept dim is kept, and no other
+        facts = conn.execute("SELECT dim_id, COUNT(*) FROM fact GROUP BY 1").fetchall()
+        assert {d for d, _ in facts} <= kept | set(range(400, 450))
+        full = dict(conn.execute("SELECT dim_id, COUNT(*) FROM main.fact GROUP BY 1").fetchall())
+        assert all(full[d] == n for d, n in facts)
+
+    def test_analyze_query_prints_intervals(self, sampled_reducer, tmp_path, capsys):
+        query_file = tmp_path / "q.sql"
+        query_file.write_text(_SAMPLED_QUERY)
+        sampled_reducer.sample_rate = 0.3
+        sampled_reducer.analyze_query(str(query_file), show_queries=False)
+        out = capsys.readouterr().out
+        assert "hash sample of the join keys" in out
+        assert "95% CI" in out
+        assert re.search(r"^OVERALL .*\[\d+\.\d%, \d+\.\d%\]$", out, re.MULTILINE)
+
+
+# ================================
+# Resource Control Tests
+# ================================
+
+def _write_orders(data_dir):
+    (data_dir / "customers.csv").write_text("id,name\n1,Alice\n2,Bob\n3,Carol\n")
+    (data_dir / "orders.csv").write_text("id,customer_id\n10,1\n11,1\n12,9\n")
+    query = data_dir / "q.sql"
+    query.write_text("SELECT * FROM orders o JOIN customers c ON o.customer_id = c.id")
+    return str(query)
+
+
+class TestResourceControls:
+
+    def test_settings_applied_to_database(self, tmp_path):
+        reducer = QueryReducer(memory_limit="100MB", threads=2, temp_directory=str(tmp_path),
+                               preserve_insertion_order=False)
+        settings = reducer.resource_settings()
+        assert settings['memory_limit'].startswith("95.3")
+        assert settings['threads'] == 2
+        assert settings['temp_directory'] == str(tmp_path)
+        assert settings['preserve_insertion_order'] is False
+
+    def test_defaults_leave_duckdb_settings(self, reducer):
+        assert reducer.resources == {}
+        assert reducer.resource_settings()['preserve_insertion_order'] is True
+
+    def test_out_of_core_uses_temporary_database_file(self, tmp_path):
+        query = _write_orders(tmp_path)
+        reducer = QueryReducer(out_of_core=True, memory_limit="100MB", out=io.StringIO())
+        reducer.load_data_dynamic(str(tmp_path))
+        assert Path(reducer.db_path).exists()
+        assert reducer.resource_settings()['preserve_insertion_order'] is False
+        report = reducer.analyze_query(query, show_queries=False)
+        assert [(n.table, n.reduced) for n in report.nodes] == [("customers", 1), ("orders", 2)]
+        reducer.close()
+        assert not Path(reducer.spill_dir).exists()
+
+    def test_database_file_keeps_loaded_tables(self, tmp_path):
+        _write_orders(tmp_path)
+        db_file = str(tmp_path / "reduction.duckdb")
+        reducer = QueryReducer(db_path=db_file, out=io.StringIO())
+        reducer.load_data_dynamic(str(tmp_path))
+        reducer.close()
+        reopened = QueryReducer(db_path=db_file)
+        assert reopened.conn.execute("SELECT COUNT(*) FROM main.orders").fetchone()[0] == 3
+        assert reopened.spill_dir is None
+        reopened.close()
+        assert Path(db_file).exists()
+
+    def test_workers_share_the_settings(self, tmp_path):
+        query = _write_orders(tmp_path)
+        reducer = QueryReducer(out_of_core=True, threads=1, out=io.StringIO())
+        reducer.load_data_dynamic(str(tmp_path))
+        worker = reducer.spawn_worker(0)
+        assert worker.resource_settings() == reducer.resource_settings()
+        assert worker.db_path == reducer.db_path
+        (first, second) = reducer.analyze_reports([query, query], jobs=2)
+        assert first.to_dict()['nodes'] == second.to_dict()['nodes']
+        reducer.close()
+
+
+# ================================
+# Database and Load Script Tests
+# ================================
+
+@pytest.fixture
+def production_db(tmp_path):
+    """A DuckDB file with orders/customers, as the Flock jobs would use."""
+    path = str(tmp_path / "production.duckdb")
+    conn = duckdb.connect(path)
+    conn.execute("CREATE TABLE customers AS SELECT * FROM (VALUES (1, 'Alice'), (2, 'Bob'), (3, 'Carol')) v(id, name)")
+    conn.execute("CREATE TABLE orders AS SELECT * FROM (VALUES (10, 1), (11, 1), (12, 9)) v(id, customer_id)")
+    conn.close()
+    return path
+
+
+_LOAD_SCRIPT = """INSTALL flock FROM community;
+LOAD flock;
+
+.read '.\\local\\secrets.sql'
+
+-- Orders and their customers
+CREATE OR REPLACE TABLE customers AS
+SELECT * FROM read_csv_auto('data/original_data/customers.csv', all_varchar=true);
+
+CREATE OR REPLACE TABLE orders AS
+SELECT * FROM read_csv_auto('data/original_data/orders.csv', all_varchar=true);"""
+
+
+class TestExternalSources:
+
+    def test_setup_statements_skip_flock_and_secrets(self):
+        statements, skipped = setup_statements(_LOAD_SCRIPT + "\nCREATE SECRET s (TYPE openai, API_KEY 'k');")
+        assert [s.split()[4] for s in statements] == ["customers", "orders"]
+        assert skipped == [".read '.\\local\\secrets.sql'", "INSTALL flock FROM community",
+                           "LOAD flock", "CREATE SECRET s (TYPE openai, API_KEY 'k')"]
+
+    def test_attach_database_reads_tables_in_place(self, production_db, tmp_path):
+        reducer = QueryReducer(out=io.StringIO())
+        reducer.attach_database(production_db)
+        assert reducer.table_sizes == {"customers": 3, "orders": 3}
+        assert reducer.load_stats["orders"]["source"] == "catalog"
+        query = tmp_path / "q.sql"
+        query.write_text("SELECT * FROM orders o JOIN customers c ON o.customer_id = c.id")
+        report = reducer.analyze_query(str(query), show_queries=False)
+        assert [(n.table, n.reduced) for n in report.nodes] == [("customers", 1), ("orders", 2)]
+        # Only reduced tables were written, to the scratch schema
+        assert {row[0] for row in reducer.conn.execute(
+            "SELECT schema_name FROM duckdb_tables() WHERE database_name <> 'source'").fetchall()} == {"_scratch"}
+        with pytest.raises(duckdb.Error):
+            reducer.conn.execute("DELETE FROM source.main.orders")
+
+    def test_attached_database_with_workers(self, production_db, tmp_path):
+        reducer = QueryReducer(out=io.StringIO())
+        reducer.attach_database(production_db)
+        files = []
+        for name in ("Alice", "Bob"):
+            query = tmp_path / f"{name}.sql"
+            query.write_text("SELECT * FROM orders o JOIN customers c ON o.customer_id = c.id "
+                             f"WHERE c.name = '{name}'")
+            files.append(str(query))
+        reports = list(reducer.analyze_reports(files, jobs=2))
+        assert [r.total_reduced for r in reports] == [3, 0]
+
+    def test_missing_database(self, reducer, tmp_path):
+        with pytest.raises(ValueError, match="Database not found"):
+            reducer.attach_database(str(tmp_path / "missing.duckdb"))
+
+    def test_load_script_keeps_production_types(self, tmp_path):
+        dataset = tmp_path / "shop"
+        (dataset / "data" / "original_data").mkdir(parents=True)
+        _write_orders(dataset / "data" / "original_data")
+        (dataset / "sql" / "setup").mkdir(parents=True)
+        (dataset / "sql" / "setup" / "load.sql").write_text(_LOAD_SCRIPT)
+        out = io.StringIO()
+        reducer = QueryReducer(out=out)
+        reducer.run_load_script(str(dataset / "sql" / "setup" / "load.sql"))
+        assert reducer.table_sizes == {"customers": 3, "orders": 3}
+        assert set(reducer._column_types("orders").values()) == {"VARCHAR"}
+        assert "Skipped: LOAD flock" in out.getvalue()
+        assert reducer.conn.execute("SELECT COUNT(*) FROM main.orders").fetchone()[0] == 3
+
+
 # ================================
 # Integration / End-to-End Tests
 # ================================
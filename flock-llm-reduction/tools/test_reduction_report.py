@@ -0,0 +1,99 @@
+"""
+Unit tests for reduction_report.py
+"""
+
+import io
+import json
+
+import duckdb
+import pytest
+from llm_payload import BatchPlan
+from reduction_report import (REPORT_COLUMNS, ContextCount, NodeReduction, ReductionReport,
+                              write_json, write_parquet, write_reports)
+
+
+def _report(name="q1.sql"):
+    report = ReductionReport(name)
+    report.mode = 'semi-join'
+    report.nodes = [NodeReduction("orders", "orders", 100, 10),
+                    NodeReduction("c2", "customers", 50, 0)]
+    report.graph_nodes, report.graph_edges = 2, 1
+    report.join_rows, report.join_exact = 10, True
+    report.contexts = [ContextCount("summary", "llm_complete", 4)]
+    report.batch_plans = [BatchPlan("r (llm_reduce)", 2, 10, 500, 2, 1, True)]
+    report.warnings = ["Query contains LIMIT 5."]
+    report.timings = {'parse': 0.5, 'report': 0.25}
+    return report
+
+
+# ================================
+# Report Tests
+# ================================
+
+class TestReductionReport:
+
+    def test_totals(self):
+        report = _report()
+        assert (report.total_original, report.total_reduced) == (150, 10)
+        assert report.overall_pct == pytest.approx(93.333, abs=1e-3)
+        assert NodeReduction("t", "t", 0, 0).pct == 0.0
+
+    def test_slots(self):
+        assert not hasattr(_report(), '__dict__')
+        assert not hasattr(NodeReduction("t", "t", 1, 1), '__dict__')
+
+    def test_to_dict_is_json(self):
+        data = json.loads(json.dumps(_report().to_dict()))
+        assert data['nodes'][1] == {'node': 'c2', 'base_table': 'customers', 'original': 50,
+                                    'reduced': 0, 'pct': 100.0, 'reduced_low': None, 'reduced_high': None}
+        assert data['contexts'] == [{'label': 'summary', 'function': 'llm_complete', 'distinct': 4}]
+
+
+# ================================
+# Output Tests
+# ================================
+
+class TestOutput:
+
+    def test_json_lines_read_back(self, tmp_path):
+        path = tmp_path / "reports.json"
+        assert write_reports([_report("q1.sql"), _report("q2.sql")], 'json', str(path)) == 2
+        rows = duckdb.sql(f"SELECT query, nodes[1].reduced, timings.parse FROM read_json('{path}') "
+                          f"ORDER BY query").fetchall()
+        assert rows == [("q1.sql", 10, 0.5), ("q2.sql", 10, 0.5)]
+
+    def test_json_to_stream(self):
+        out = io.StringIO()
+        assert write_json([_report()], out) == 1
+        assert out.getvalue().count("\n") == 1
+
+    def test_parquet_read_back(self, tmp_path):
+        failed = ReductionReport("bad.sql")
+        failed.error = "File not found: bad.sql"
+        path = tmp_path / "reports.parquet"
+        assert write_parquet([_report(), failed], str(path)) == 2
+        rows = duckdb.sql(f"""
+            SELECT query, error, len(nodes), contexts[1].distinct, batch_plans[1].api_calls,
+                   timings['report'], warnings
+            FROM read_parquet('{path}') ORDER BY query
+        """).fetchall()
+        assert rows == [
+            ("bad.sql", "File not found: bad.sql", 0, None, None, None, []),
+            ("q1.sql", None, 2, 4, 2, 0.25, ["Query contains LIMIT 5."]),
+        ]
+
+    def test_parquet_streamed_with_report_columns(self, tmp_path):
+        path = tmp_path / "reports.parquet"
+        assert write_parquet((_report(f"q{i}.sql") for i in range(3)), str(path)) == 3
+        described = duckdb.sql(f"DESCRIBE SELECT * FROM read_parquet('{path}')").fetchall()
+        assert [name for name, *_ in described] == list(REPORT_COLUMNS)
+        assert duckdb.sql(f"SELECT COUNT(*) FROM read_parquet('{path}')").fetchone()[0] == 3
+
+    def test_parquet_without_reports(self, tmp_path):
+        path = tmp_path / "reports.parquet"
+        assert write_parquet([], str(path)) == 0
+        assert duckdb.sql(f"SELECT COUNT(*) FROM read_parquet('{path}')").fetchone()[0] == 0
+
+    def test_parquet_needs_path(self):
+        with pytest.raises(ValueError):
+            write_reports([_report()], 'parquet')
@@ -0,0 +1,211 @@
+"""
+Unit tests for sql_frontend.py
+"""
+
+import pytest
+import duckdb
+from sql_frontend import SqlFrontend, bind_literals, normalize_query
+
+# ================================
+# Fixtures
+# ================================
+
+@pytest.fixture
+def conn():
+    return duckdb.connect()
+
+
+@pytest.fixture
+def frontend():
+    return SqlFrontend()
+
+
+# ================================
+# Normalization Tests
+# ================================
+
+class TestNormalizeQuery:
+
+    def test_literals_become_parameters(self):
+        template, literals = normalize_query("SELECT * FROM t WHERE a = 'x' AND b >= 10")
+        assert template == "SELECT * FROM t WHERE a = $1 AND b >= $2"
+        assert literals == ["'x'", "10"]
+
+    def test_comments_and_whitespace_normalized(self):
+        template, _ = normalize_query("SELECT *  -- everything\n  FROM t /* block */ WHERE a")
+        assert template == "SELECT * FROM t WHERE a"
+
+    def test_struct_keys_and_type_parameters_kept(self):
+        template, literals = normalize_query(
+            "SELECT {'prompt': 'hi'}, x::DECIMAL(3,2) FROM t1"
+        )
+        assert "{'prompt': $1}" in template
+        assert "DECIMAL(3,2)" in template
+        assert "t1" in template
+        assert literals == ["'hi'"]
+
+    def test_comment_markers_inside_strings_kept(self):
+        template, literals = normalize_query("SELECT * FROM t WHERE a = '-- not a comment'")
+        assert literals == ["'-- not a comment'"]
+
+    def test_bind_literals_round_trip(self):
+        query = "SELECT * FROM t WHERE a IN ('x', 'y') AND b = 2"
+        template, literals = normalize_query(query)
+        assert bind_literals(template, literals) == query
+
+
+# ================================
+# Parse Tests
+# ================================
+
+class TestParse:
+
+    def test_tables_aliases_and_join_conjuncts(self, frontend, conn):
+        parsed = frontend.parse(
+            "SELECT * FROM books b JOIN tags t ON t.book_id = b.id AND t.n > 3", conn
+        )
+        assert [(r.node, r.table, r.alias) for r in parsed.tables] == [
+            ("books", "books", "b"), ("tags", "tags", "t")]
+        assert parsed.joins == [[(("tags", "books"), "tags.book_id = books.id"),
+                                 (("tags",), "tags.n > 3")]]
+
+    def test_self_join_occurrences_are_separate_nodes(self, frontend, conn):
+        parsed = frontend.parse(
+            "SELECT * FROM routes r1 JOIN routes r2 ON r1.dst = r2.src", conn
+        )
+        assert [r.node for r in parsed.tables] == ["r1", "r2"]
+        assert parsed.joins[0][0].sql == "r1.dst = r2.src"
+
+    def test_between_and_or_stay_single_conjuncts(self, frontend, conn):
+        parsed = frontend.parse("""
+            SELECT * FROM a
+            WHERE a.x BETWEEN 1 AND 5
+              AND (a.y = 'p' OR a.y = 'q')
+        """, conn)
+        assert [c.sql for c in parsed.where] == [
+            "a.x BETWEEN 1 AND 5", "(a.y = 'p') OR (a.y = 'q')"]
+
+    def test_comment_inside_clause(self, frontend, conn):
+        parsed = frontend.parse("""
+            SELECT * FROM a JOIN b ON a.id = b.a_id
+            WHERE a.x = 1 -- AND b.y = 2
+              AND b.z = 3
+        """, conn)
+        assert [c.sql for c in parsed.where] == ["a.x = 1", "b.z = 3"]
+
+    def test_cte_and_subquery_wrappers_unwrapped(self, frontend, conn):
+        parsed = frontend.parse("""
+            WITH c AS (SELECT * FROM a JOIN b ON a.id = b.a_id WHERE b.v > 1)
+            SELECT * FROM (SELECT * FROM c) s
+        """, conn)
+        assert [r.node for r in parsed.tables] == ["a", "b"]
+        assert [c.sql for c in parsed.where] == ["b.v > 1"]
+
+    def test_subquery_and_llm_predicates_skipped(self, frontend, conn):
+        parsed = frontend.parse("""
+            SELECT * FROM a
+            WHERE a.id IN (SELECT id FROM b)
+              AND llm_filter({'model_name': 'm'}, {'prompt': 'p', 'context_columns': [{'data': a.t}]})
+              AND a.k = 1
+        """, conn)
+        assert [c.sql for c in parsed.where] == ["a.k = 1"]
+        assert len(parsed.skipped) == 2
+        assert parsed.skipped[0].startswith("a.id = ANY(SELECT")
+
+    def test_join_types_and_nullable_nodes(self, frontend, conn):
+        parsed = frontend.parse("""
+            SELECT * FROM a LEFT JOIN b ON a.id = b.a_id
+            JOIN c ON c.id = a.c_id FULL JOIN d ON d.id = c.d_id
+        """, conn)
+        assert parsed.join_types == ["LEFT", "INNER", "FULL"]
+        assert parsed.nullable == ["b", "a", "c", "d"]
+
+    def test_inner_join_has_no_nullable_nodes(self, frontend, conn):
+        parsed = frontend.parse("SELECT * FROM a JOIN b ON a.id = b.a_id, c", conn)
+        assert parsed.join_types == ["INNER", "INNER"]
+        assert parsed.nullable == []
+
+    def test_unresolved_on_conjuncts_skipped(self, frontend, conn):
+        parsed = frontend.parse("""
+            SELECT * FROM a JOIN b ON a.id = b.a_id AND b.k IN (SELECT k FROM c)
+            WHERE a.x = 1
+        """, conn)
+        assert parsed.joins == [[(("a", "b"), "a.id = b.a_id")]]
+        assert len(parsed.skipped) == 1
+        assert parsed.skipped[0].startswith("b.k = ANY(SELECT")
+
+    def test_group_by_and_having(self, frontend, conn):
+        parsed = frontend.parse("""
+            SELECT t.genre, count(*) FROM tags t JOIN books b ON b.tag_id = t.id
+            GROUP BY t.genre HAVING count(DISTINCT b.id) >= 7
+        """, conn)
+        assert parsed.group_by == ["tags.genre"]
+        assert parsed.having_min_count == 7
+
+    def test_llm_call_sites(self, frontend, conn):
+        parsed = frontend.parse("""
+            SELECT b.title,
+                   llm_complete({'model_name': 'gpt-4o'},
+                                {'prompt': 'Summarize', 'context_columns': [{'data': b.title}]}) AS summary
+            FROM books b
+        """, conn)
+        (call,) = parsed.llm_calls
+        assert (call.function, call.clause, call.alias) == ("llm_complete", "SELECT", "summary")
+        assert call.prompt == "Summarize"
+        assert call.context_columns == ("b.title",)
+        assert call.context_expressions == ("books.title",)
+
+    def test_llm_context_expressions_are_node_qualified(self, frontend, conn):
+        parsed = frontend.parse("""
+            SELECT llm_complete({'model_name': 'm'},
+                                {'prompt': 'Compare', 'context_columns': [
+                                  {'data': b1.title, 'name': 'first'},
+                                  {'data': CAST(b2.rating AS VARCHAR), 'name': 'second'}]}) AS c
+            FROM books b1 JOIN books b2 ON b1.author = b2.author
+            WHERE b1.id IN (SELECT llm_complete({'model_name': 'm'},
+                                                {'prompt': 'p', 'context_columns': [{'data': t.x}]}) FROM t)
+        """, conn)
+        outer, inner = parsed.llm_calls
+        assert outer.context_expressions == ("b1.title", "CAST(b2.rating AS VARCHAR)")
+        # Only calls of the base SELECT are resolved
+        assert inner.context_expressions == ()
+
+    def test_unparseable_returns_none(self, frontend, conn):
+        assert frontend.parse("SELECT FROM WHERE", conn) is None
+
+
+# ================================
+# Plan Cache Tests
+# ================================
+
+class TestPlanCache:
+
+    def test_template_parsed_once(self, frontend, conn):
+        first = frontend.parse("SELECT * FROM a WHERE a.x = 'one' AND a.n >= 5", conn)
+        second = frontend.parse("SELECT *\nFROM a  WHERE a.x = 'two' AND a.n >= 9", conn)
+        assert (frontend.misses, frontend.hits) == (1, 1)
+        assert [c.sql for c in first.where] == ["a.x = 'one'", "a.n >= 5"]
+        assert [c.sql for c in second.where] == ["a.x = 'two'", "a.n >= 9"]
+
+    def test_having_threshold_bound_per_query(self, frontend, conn):
+        sql = "SELECT a.g FROM a GROUP BY a.g HAVING count(*) >= {}"
+        assert frontend.parse(sql.format(3), conn).having_min_count == 3
+        assert frontend.parse(sql.format(8), conn).having_min_count == 8
+
+    def test_literal_that_cannot_be_a_parameter(self, frontend, conn):
+        parsed = frontend.parse("SELECT * FROM a WHERE a.d >= DATE '2024-01-01'", conn)
+        assert [c.sql for c in parsed.where] == ["a.d >= CAST('2024-01-01' AS DATE)"]
+
+    def test_own_parameters_not_confused_with_literals(self, frontend, conn):
+        for parameter in ("$1", "?"):
+            parsed = frontend.parse(
+                f"SELECT * FROM a JOIN b ON a.id = b.a_id WHERE a.x = {parameter} AND b.id > 7",
+                conn)
+            assert [c.sql for c in parsed.where] == ["b.id > 7"]
+            assert parsed.skipped == ["a.x = $1"]
+
+    def test_own_parameters_bypass_template_cache(self, frontend, conn):
+        bound = frontend.parse("SELECT * FROM a WHERE a.x = 7 AND a.y = '$1 ?'", conn)
+        raw = frontend.parse("SELECT * FROM a WHERE a.x = $1", conn)
+        assert [c.sql for c in bound.where] == ["a.x = 7", "a.y = '$1 ?'"]
+        assert raw.where == [] and frontend.misses == 2
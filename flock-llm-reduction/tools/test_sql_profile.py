@@ -0,0 +1,74 @@
+"""
+Unit tests for sql_profile.py
+"""
+
+import duckdb
+from sql_profile import ProfiledConnection, SqlProfiler, format_profile
+
+
+class _Owner:
+    """Stands in for the reducer whose methods issue the statements."""
+
+    def __init__(self):
+        self.profiler = SqlProfiler()
+        self.conn = ProfiledConnection(duckdb.connect(), self.profiler, self)
+
+    def load(self):
+        self.conn.execute("CREATE TABLE t AS SELECT range AS i FROM range(1000)")
+
+    def reduce(self):
+        self._filter()
+
+    def _filter(self):
+        self.conn.execute("CREATE TABLE u AS SELECT * FROM t WHERE i % ? = 0", [10])
+
+
+# ================================
+# Profiled Connection Tests
+# ================================
+
+class TestProfiledConnection:
+
+    def test_records_stack_rows_and_memory(self):
+        owner = _Owner()
+        owner.load()
+        owner.reduce()
+        load, reduce = owner.profiler.statements
+        assert load.stack == "load"
+        assert reduce.stack == "reduce;_filter"
+        assert (reduce.rows_in, reduce.rows_out) == (1000, 100)
+        assert reduce.memory_bytes > 0
+        assert reduce.profile['query_name'].startswith("CREATE TABLE u")
+        assert owner.profiler.peak_memory_bytes >= reduce.memory_bytes
+
+    def test_results_stay_fetchable(self):
+        owner = _Owner()
+        owner.load()
+        assert owner.conn.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 1000
+        assert owner.profiler.statements[-1].rows_out == 1
+
+    def test_ddl_has_no_profile(self):
+        owner = _Owner()
+        owner.conn.execute("DROP TABLE IF EXISTS missing")
+        (statement,) = owner.profiler.statements
+        assert statement.profile is None
+        assert statement.stack == "(direct)"
+
+
+# ================================
+# Summary Tests
+# ================================
+
+class TestFormatProfile:
+
+    def test_stacks_below_shared_frames(self):
+        owner = _Owner()
+        owner.load()
+        owner.reduce()
+        text = format_profile(owner.profiler)
+        assert text.startswith("SQL PROFILE (2 statements")
+        assert "reduce;_filter" in text
+        assert "CREATE TABLE u AS SELECT * FROM t WHERE i % ? = 0" in text
+
+    def test_empty(self):
+        assert format_profile(SqlProfiler()).startswith("SQL PROFILE: no statements")